@@ -0,0 +1,128 @@
+"""
+Compares time-to-first-token of the state machine deployment mode against the
+direct WebSocket-to-Lambda mode, using local stand-ins with configurable hop
+latencies. The hop defaults are rough figures; override them with measured ones.
+
+    python bench_fast_path.py --iterations 20 --retrieve-ms 150 --first-token-ms 400
+"""
+
+import argparse
+import statistics
+import time
+
+import boto3
+from moto import mock_aws
+
+import local_env
+import stubs
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+
+def seed_history(connection_id: str, turns: int) -> None:
+    import history_codec
+
+    dynamodb = boto3.client("dynamodb")
+    for t in range(turns):
+        dynamodb.put_item(
+            TableName=local_env.CONTEXT_TABLE_NAME,
+            Item={
+                "PK": {"S": connection_id},
+                "SK": {"N": str(1700000000000 + t * 1000)},
+                "question": {"B": history_codec.encode_text(local_env.synthetic_markdown(20, t))},
+                "answer": {"B": history_codec.encode_text(local_env.synthetic_markdown(400, t))},
+            },
+        )
+
+
+def run_state_machine(args, bedrock_interface, dynamodb, apigw, connection_id, request_id):
+    """API Gateway -> StartExecution -> Fetch history -> Ask bedrock (-> Update history)."""
+    start = time.perf_counter()
+    stubs.sleep_ms(args.start_execution_ms)
+    stubs.sleep_ms(args.state_transition_ms)
+    records = local_env.fetch_history(local_env.CONTEXT_TABLE_NAME, connection_id, 5)
+    stubs.sleep_ms(args.dynamodb_ms)
+    stubs.sleep_ms(args.state_transition_ms + args.lambda_invoke_ms)
+    stubs.configure_handler_environment(DEPLOYMENT_MODE="state_machine")
+    bedrock_interface.handler(
+        {
+            "data": {"message": "What is the deadline for NSF 24-553?"},
+            "timestamp": str(request_id),
+            "ConnectionID": connection_id,
+            "contentResults": {"Items": records},
+        },
+        stubs.FakeLambdaContext(),
+    )
+    return start, time.perf_counter()
+
+
+def run_direct(args, bedrock_interface, dynamodb, apigw, connection_id, request_id):
+    """API Gateway -> asynchronous Lambda invoke, history handled in the function."""
+    start = time.perf_counter()
+    stubs.sleep_ms(args.lambda_invoke_ms)
+    stubs.configure_handler_environment(DEPLOYMENT_MODE="direct")
+    bedrock_interface.handler(
+        {
+            "data": {"message": "What is the deadline for NSF 24-553?"},
+            "timestamp": str(request_id),
+            "ConnectionID": connection_id,
+        },
+        stubs.FakeLambdaContext(),
+    )
+    return start, time.perf_counter()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--history-turns", type=int, default=4)
+    parser.add_argument("--start-execution-ms", type=float, default=30)
+    parser.add_argument("--state-transition-ms", type=float, default=10)
+    parser.add_argument("--lambda-invoke-ms", type=float, default=20)
+    parser.add_argument("--dynamodb-ms", type=float, default=6)
+    parser.add_argument("--retrieve-ms", type=float, default=150)
+    parser.add_argument("--first-token-ms", type=float, default=400)
+    parser.add_argument("--tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    stubs.configure_handler_environment()
+    with mock_aws():
+        local_env.create_context_table()
+        import bedrock_interface
+
+        apigw = stubs.FakeApiGatewayManagement(latency_ms=5)
+        dynamodb = stubs.DelayedClient(boto3.client("dynamodb"), args.dynamodb_ms)
+        stubs.install_fakes(
+            bedrock_interface,
+            stubs.FakeBedrockRuntime(args.first_token_ms, 5, args.tokens),
+            stubs.FakeAgentRuntime(args.retrieve_ms),
+            apigw,
+            dynamodb,
+        )
+
+        results = {}
+        for name, run in (("state_machine", run_state_machine), ("direct", run_direct)):
+            ttft, total = [], []
+            for i in range(args.iterations):
+                connection_id = f"{name}-{i}"
+                seed_history(connection_id, args.history_turns)
+                start, end = run(args, bedrock_interface, dynamodb, apigw, connection_id, 1800000000000 + i)
+                ttft.append((apigw.first_frame_at(connection_id) - start) * 1000)
+                total.append((end - start) * 1000)
+            results[name] = (ttft, total)
+
+    print(f"{'mode':>14} {'TTFT p50':>10} {'TTFT p95':>10} {'total p50':>10}")
+    for name, (ttft, total) in results.items():
+        print(
+            f"{name:>14} {percentile(ttft, 50):>8.0f}ms {percentile(ttft, 95):>8.0f}ms {statistics.median(total):>8.0f}ms"
+        )
+    print("(the state machine total excludes its \"Update history\" state; the direct total includes the history write)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Drives the inference ``handler`` across a grid of history lengths, retrieved
+document counts and answer sizes. Bedrock, retrieve and API Gateway are local
+stand-ins, and history lives in moto DynamoDB. For each scenario the script reports:
+
+- latency percentiles (time to first frame and total)
+- frames posted per answer
+- prompt size
+- peak Python memory
+
+Results can be saved as a baseline and later runs checked against it. A run
+that regresses past the thresholds exits with status 1, so it can gate a change.
+
+    python bench_handler.py --save-baseline
+    python bench_handler.py --check
+    python bench_handler.py --history-turns 0 5 10 --documents 5 --answer-tokens 800
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import boto3
+from moto import mock_aws
+
+import local_env
+import stubs
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baselines", "bench_handler.json"
+)
+
+# metric: (relative tolerance, absolute slack). A value regresses when it exceeds
+# baseline * (1 + tolerance) + slack. The slack keeps sub-millisecond noise on
+# fast scenarios from failing the check.
+THRESHOLDS = {
+    "ttft_p50_ms": (0.15, 10),
+    "ttft_p90_ms": (0.25, 15),
+    "total_p50_ms": (0.15, 10),
+    "total_p90_ms": (0.25, 15),
+    "posts_per_answer": (0, 0),
+    "prompt_characters": (0.05, 0),
+    "peak_memory_kib": (0.25, 64),
+}
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def seed_history(connection_id: str, turns: int, answer_words: int) -> None:
+    import history_codec
+
+    dynamodb = boto3.client("dynamodb")
+    for t in range(turns):
+        dynamodb.put_item(
+            TableName=local_env.CONTEXT_TABLE_NAME,
+            Item={
+                "PK": {"S": connection_id},
+                "SK": {"N": str(1700000000000 + t * 1000)},
+                "question": {"B": history_codec.encode_text(local_env.synthetic_markdown(20, t))},
+                "answer": {"B": history_codec.encode_text(local_env.synthetic_markdown(answer_words, t))},
+                "expires_at": {"N": "1700604800"},
+            },
+        )
+
+
+def invoke(bedrock_interface, args, connection_id: str, request_id: int) -> None:
+    """Calls the handler with the event the deployed integration would send."""
+    event = {
+        "data": {"message": "What is the deadline for NSF 24-553?"},
+        "timestamp": str(request_id),
+        "ConnectionID": connection_id,
+    }
+    if args.mode == "state_machine":
+        event["contentResults"] = {
+            "Items": local_env.fetch_history(
+                local_env.CONTEXT_TABLE_NAME, connection_id, args.history_limit
+            )
+        }
+    bedrock_interface.handler(event, stubs.FakeLambdaContext())
+
+
+def run_scenario(args, bedrock_interface, history_turns, documents, answer_tokens) -> dict:
+    apigw = stubs.FakeApiGatewayManagement(latency_ms=args.post_ms)
+    bedrock = stubs.FakeBedrockRuntime(args.first_token_ms, args.token_interval_ms, answer_tokens)
+    stubs.install_fakes(
+        bedrock_interface,
+        bedrock,
+        stubs.FakeAgentRuntime(args.retrieve_ms, results=documents),
+        apigw,
+        stubs.DelayedClient(boto3.client("dynamodb"), args.dynamodb_ms),
+    )
+    stubs.configure_handler_environment(
+        DEPLOYMENT_MODE=args.mode,
+        RETRIEVAL_RESULTS=str(documents),
+        HISTORY_LIMIT=str(args.history_limit),
+    )
+    name = f"h{history_turns}-d{documents}-a{answer_tokens}"
+
+    ttft, total, posts = [], [], []
+    for i in range(args.warmup + args.iterations):
+        connection_id = f"{name}-{i}"
+        seed_history(connection_id, history_turns, args.history_answer_words)
+        start = time.perf_counter()
+        invoke(bedrock_interface, args, connection_id, 1800000000000 + i)
+        end = time.perf_counter()
+        if i < args.warmup:
+            continue
+        ttft.append((apigw.first_frame_at(connection_id) - start) * 1000)
+        total.append((end - start) * 1000)
+        posts.append(len(apigw.frames_for(connection_id)))
+
+    # Memory is measured on a separate, untimed invocation: tracing allocations slows
+    # the handler down enough to distort the latencies above
+    connection_id = f"{name}-memory"
+    seed_history(connection_id, history_turns, args.history_answer_words)
+    tracemalloc.start()
+    invoke(bedrock_interface, args, connection_id, 1900000000000)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "ttft_p50_ms": percentile(ttft, 50),
+        "ttft_p90_ms": percentile(ttft, 90),
+        "ttft_p99_ms": percentile(ttft, 99),
+        "total_p50_ms": percentile(total, 50),
+        "total_p90_ms": percentile(total, 90),
+        "total_p99_ms": percentile(total, 99),
+        "posts_per_answer": max(posts),
+        "prompt_characters": len(bedrock.requests[-1]["body"]["system"]),
+        "peak_memory_kib": peak / 1024,
+    }
+
+
+def check(results, baseline) -> list:
+    """Returns a description of every metric that regressed against the baseline."""
+    if baseline.get("config") != results["config"]:
+        print("warning: baseline was recorded with different settings; comparing anyway")
+    expected = {row["scenario"]: row for row in baseline["scenarios"]}
+    failures = []
+    for row in results["scenarios"]:
+        if row["scenario"] not in expected:
+            print(f"warning: {row['scenario']} is not in the baseline")
+            continue
+        for metric, (tolerance, slack) in THRESHOLDS.items():
+            limit = expected[row["scenario"]][metric] * (1 + tolerance) + slack
+            if row[metric] > limit:
+                failures.append(
+                    f"{row['scenario']} {metric}: {row[metric]:.1f} > {limit:.1f} "
+                    f"(baseline {expected[row['scenario']][metric]:.1f})"
+                )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history-turns", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--documents", type=int, nargs="+", default=[3, 10])
+    parser.add_argument("--answer-tokens", type=int, nargs="+", default=[50, 400])
+    parser.add_argument("--mode", choices=["state_machine", "direct"], default="state_machine")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--history-limit", type=int, default=5)
+    parser.add_argument("--history-answer-words", type=int, default=400)
+    parser.add_argument("--first-token-ms", type=float, default=100)
+    parser.add_argument("--token-interval-ms", type=float, default=1)
+    parser.add_argument("--retrieve-ms", type=float, default=50)
+    parser.add_argument("--post-ms", type=float, default=1)
+    parser.add_argument("--dynamodb-ms", type=float, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--check", action="store_true", help="fail if the results regress against --baseline")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    stubs.configure_handler_environment()
+    with mock_aws():
+        local_env.create_context_table()
+        import bedrock_interface
+
+        scenarios = [
+            run_scenario(args, bedrock_interface, *scenario)
+            for scenario in itertools.product(args.history_turns, args.documents, args.answer_tokens)
+        ]
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("baseline", "save_baseline", "check", "json")
+    }
+    results = {"config": config, "scenarios": scenarios}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(
+            f"{'scenario':>16} {'TTFT p50':>9} {'p90':>7} {'p99':>7} {'total p50':>10} {'p90':>7} {'p99':>7}"
+            f" {'posts':>6} {'prompt chars':>13} {'peak KiB':>9}"
+        )
+        for r in scenarios:
+            print(
+                f"{r['scenario']:>16} {r['ttft_p50_ms']:>7.0f}ms {r['ttft_p90_ms']:>5.0f}ms {r['ttft_p99_ms']:>5.0f}ms"
+                f" {r['total_p50_ms']:>8.0f}ms {r['total_p90_ms']:>5.0f}ms {r['total_p99_ms']:>5.0f}ms"
+                f" {r['posts_per_answer']:>6} {r['prompt_characters']:>13} {r['peak_memory_kib']:>9.0f}"
+            )
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline) as f:
+            failures = check(results, json.load(f))
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            return 1
+        print("no regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
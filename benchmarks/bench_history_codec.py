@@ -0,0 +1,110 @@
+"""
+Compares plain-string history items against compressed binary items: bytes per
+item, read units per history fetch and fetch + decode latency.
+
+    python bench_history_codec.py --answer-words 200 1000 3000 6000
+"""
+
+import argparse
+import math
+import statistics
+import time
+
+import boto3
+from moto import mock_aws
+
+import local_env
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+
+def item_size(item: dict) -> int:
+    """Approximates the DynamoDB item size used for capacity accounting."""
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode("utf-8"))
+        if "S" in value:
+            size += len(value["S"].encode("utf-8"))
+        elif "B" in value:
+            size += len(value["B"])
+        elif "N" in value:
+            size += math.ceil(len(value["N"].lstrip("-")) / 2) + 1
+    return size
+
+
+def run(args, answer_words: int) -> dict:
+    import bedrock_interface
+    import history_codec
+
+    dynamodb = boto3.client("dynamodb")
+    results = {}
+    for mode in ("plain", "compressed"):
+        connection_id = f"{mode}-{answer_words}"
+        sizes = []
+        for t in range(args.history_limit):
+            question = local_env.synthetic_markdown(20, t)
+            answer = local_env.synthetic_markdown(answer_words, t)
+            if mode == "plain":
+                item = {"question": {"S": question}, "answer": {"S": answer}}
+            else:
+                item = {
+                    "question": {"B": history_codec.encode_text(question)},
+                    "answer": {"B": history_codec.encode_text(answer)},
+                }
+            item.update(
+                {
+                    "PK": {"S": connection_id},
+                    "SK": {"N": str(1700000000000 + t * 1000)},
+                    "expires_at": {"N": "1700604800"},
+                }
+            )
+            sizes.append(item_size(item))
+            dynamodb.put_item(TableName=local_env.CONTEXT_TABLE_NAME, Item=item)
+
+        latencies = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            records = local_env.fetch_history(
+                local_env.CONTEXT_TABLE_NAME, connection_id, args.history_limit
+            )
+            bedrock_interface.get_history_from_records(records)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        results[mode] = {
+            "bytes": statistics.mean(sizes),
+            # Eventually consistent query: 0.5 RCU per 4 KB of the whole result
+            "rcu": math.ceil(sum(sizes) / 4096) * 0.5,
+            # Standard writes: 1 WCU per 1 KB of each item
+            "wcu": statistics.mean(math.ceil(s / 1024) for s in sizes),
+            "p50_ms": statistics.median(latencies),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--answer-words", type=int, nargs="+", default=[200, 1000, 3000, 6000])
+    parser.add_argument("--history-limit", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    with mock_aws():
+        local_env.create_context_table()
+        rows = [(words, run(args, words)) for words in args.answer_words]
+
+    print(
+        f"{'words':>6} {'bytes/item':>18} {'WCU/item':>12} {'RCU/fetch':>12} {'fetch p50 ms':>16}"
+    )
+    for words, r in rows:
+        plain, compressed = r["plain"], r["compressed"]
+        print(
+            f"{words:>6} {plain['bytes']:>8.0f} → {compressed['bytes']:<7.0f} "
+            f"{plain['wcu']:>4.0f} → {compressed['wcu']:<5.0f} "
+            f"{plain['rcu']:>4.1f} → {compressed['rcu']:<5.1f} "
+            f"{plain['p50_ms']:>6.2f} → {compressed['p50_ms']:<7.2f}"
+        )
+    print("(fetch latency is against moto and includes decoding; compare the two columns, not the absolute values)")
+
+
+if __name__ == "__main__":
+    main()
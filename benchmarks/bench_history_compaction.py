@@ -0,0 +1,119 @@
+"""
+Measures the prompt tokens sent per turn on long synthetic sessions, comparing
+re-sending every prior Q&A against the bounded window plus rolling summary.
+
+    python bench_history_compaction.py --turns 10 25 50 --answer-words 600
+"""
+
+import argparse
+import time
+
+from moto import mock_aws
+
+import local_env
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+
+def fake_summarize(budget_tokens: int):
+    """A stand-in for the Bedrock summarizer that returns a summary of bounded size."""
+
+    def summarize(previous_summary, turns):
+        text = previous_summary
+        for t in turns:
+            text += f" Q: {t['question']} A: {t['answer'][:400]}"
+        return text[-budget_tokens * 4 :]
+
+    return summarize
+
+
+def run_session(args, turns: int) -> dict:
+    import bedrock_interface
+    import history_codec
+    import history_compaction
+
+    connection_id = f"session-{turns}"
+    all_turns = []
+    full_tokens = []
+    compacted_tokens = []
+    compactions = 0
+    for t in range(turns):
+        # Prompt the model would receive for this turn in both designs
+        full_prompt = bedrock_interface.generate_system_prompt(None, all_turns)
+        records = local_env.fetch_history(
+            local_env.CONTEXT_TABLE_NAME, connection_id, args.history_limit
+        )
+        window_prompt = bedrock_interface.generate_system_prompt(
+            None,
+            bedrock_interface.get_history_from_records(records),
+            bedrock_interface.get_summary_from_records(records),
+        )
+        full_tokens.append(history_compaction.estimate_tokens(full_prompt))
+        compacted_tokens.append(history_compaction.estimate_tokens(window_prompt))
+
+        # "Update history" followed by the asynchronous compaction
+        turn = {
+            "question": local_env.synthetic_text(15, t),
+            "answer": local_env.synthetic_text(args.answer_words, t),
+        }
+        all_turns.append(turn)
+        history_compaction.dynamodb_client.put_item(
+            TableName=local_env.CONTEXT_TABLE_NAME,
+            Item={
+                "PK": {"S": connection_id},
+                "SK": {"N": str(1700000000000 + t * 1000)},
+                "question": {"B": history_codec.encode_text(turn["question"])},
+                "answer": {"B": history_codec.encode_text(turn["answer"])},
+            },
+        )
+        result = history_compaction.compact_session(
+            table_name=local_env.CONTEXT_TABLE_NAME,
+            connection_id=connection_id,
+            summarize=fake_summarize(args.summary_tokens),
+            token_threshold=args.threshold,
+            max_turns=args.history_limit - 1,
+            keep_turns=2,
+            ttl_seconds=3600,
+        )
+        compactions += int(result["compacted"])
+
+    return {
+        "turns": turns,
+        "full": sum(full_tokens),
+        "compacted": sum(compacted_tokens),
+        "full_last": full_tokens[-1],
+        "compacted_last": compacted_tokens[-1],
+        "compactions": compactions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 25, 50])
+    parser.add_argument("--answer-words", type=int, default=600)
+    parser.add_argument("--history-limit", type=int, default=5)
+    parser.add_argument("--threshold", type=int, default=6000)
+    parser.add_argument("--summary-tokens", type=int, default=1000)
+    args = parser.parse_args()
+
+    with mock_aws():
+        local_env.create_context_table()
+        start = time.perf_counter()
+        results = [run_session(args, turns) for turns in args.turns]
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{'turns':>6} {'full tokens':>12} {'compacted':>10} {'saved':>7} "
+        f"{'last turn full':>15} {'last turn compacted':>20} {'compactions':>12}"
+    )
+    for r in results:
+        saved = 1 - r["compacted"] / r["full"] if r["full"] else 0.0
+        print(
+            f"{r['turns']:>6} {r['full']:>12} {r['compacted']:>10} {saved:>7.1%} "
+            f"{r['full_last']:>15} {r['compacted_last']:>20} {r['compactions']:>12}"
+        )
+    print(f"({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
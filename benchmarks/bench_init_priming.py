@@ -0,0 +1,87 @@
+"""
+Measures the init time of the inference function and the client overhead of
+its first request, with and without priming (PRIME_ON_INIT, see
+src/bedrock_interface/priming.py). Every sample is a fresh interpreter, like a
+new execution environment. Requests never leave the process: the first
+request replays the calls of a turn with the network short-circuited, so the
+numbers are the client-side cost only.
+
+The "cold start" columns add up what the first user waits for: init plus the
+first request on demand, and only the first request when init ran ahead of
+traffic (SnapStart snapshot or provisioned concurrency).
+
+    python bench_init_priming.py --samples 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import local_env
+import stubs
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+
+def child() -> None:
+    stubs.configure_handler_environment(KNOWLEDGE_BASE_ID="KBLOCAL000")
+    started_at = time.perf_counter()
+    import bedrock_interface
+    import priming
+
+    init_ms = (time.perf_counter() - started_at) * 1000
+    first = priming.prime_clients(bedrock_interface.priming_calls())
+    second = priming.prime_clients(bedrock_interface.priming_calls())
+    print(json.dumps({"init_ms": init_ms, "first_ms": sum(first.values()), "second_ms": sum(second.values())}))
+
+
+def sample(primed: bool) -> dict:
+    environment = dict(os.environ, PRIME_ON_INIT="true" if primed else "false")
+    # Keep the "Primed AWS clients" log line off the output
+    environment["POWERTOOLS_LOG_LEVEL"] = "WARNING"
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    # Alternate the modes so that drift on the machine affects both alike
+    results = {False: [], True: []}
+    for _ in range(args.samples):
+        for primed in (False, True):
+            results[primed].append(sample(primed))
+
+    print(
+        f"{'':>10} {'init':>9} {'1st request':>12} {'2nd request':>12}"
+        f" {'cold start on demand':>21} {'cold start, init ahead':>23}"
+    )
+    for primed, runs in results.items():
+        init = statistics.median(r["init_ms"] for r in runs)
+        first = statistics.median(r["first_ms"] for r in runs)
+        second = statistics.median(r["second_ms"] for r in runs)
+        print(
+            f"{'primed' if primed else 'unprimed':>10} {init:>7.1f}ms {first:>10.1f}ms {second:>10.1f}ms"
+            f" {init + first:>19.1f}ms {first:>21.1f}ms"
+        )
+    print("(medians; requests are the client-side cost of one turn's AWS calls, without network)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Compares sending every question to the strong model against routing by
+complexity (see src/bedrock_interface/model_routing.py). It replays the
+conversations in corpus/nsf_questions.jsonl through the handler, with history
+kept in moto DynamoDB. The fast tier can be told to refuse a fraction of its
+questions, to price in escalations. It also checks that an opening question
+with nothing retrieved costs one fast-tier call: its refusal is the answer,
+not a reason to escalate.
+
+    python bench_model_routing.py --fast-first-token-ms 250 --strong-first-token-ms 600 --refusal-rate 0.1
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+import boto3
+from moto import mock_aws
+
+import local_env
+import stubs
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+FAST_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+STRONG_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "nsf_questions.jsonl")
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def run(args, routing: bool, conversations) -> dict:
+    import bedrock_interface
+
+    bedrock = stubs.FakeBedrockRuntime(
+        tokens=args.tokens,
+        model_latencies={
+            FAST_MODEL_ID: (args.fast_first_token_ms, args.fast_token_interval_ms),
+            STRONG_MODEL_ID: (args.strong_first_token_ms, args.strong_token_interval_ms),
+        },
+        refusal_models=(FAST_MODEL_ID,),
+        refusal_rate=args.refusal_rate,
+    )
+    apigw = stubs.FakeApiGatewayManagement(latency_ms=1)
+    stubs.install_fakes(
+        bedrock_interface,
+        bedrock,
+        stubs.FakeAgentRuntime(args.retrieve_ms, results=5, chunk_words=120),
+        apigw,
+        boto3.client("dynamodb"),
+    )
+    stubs.configure_handler_environment(
+        DEPLOYMENT_MODE="direct",
+        BEDROCK_MODEL_ID=STRONG_MODEL_ID,
+        STRONG_MODEL_ID=STRONG_MODEL_ID,
+        FAST_MODEL_ID=FAST_MODEL_ID if routing else "",
+    )
+
+    ttft, total, answered_by = [], [], Counter()
+    request_id = 1800000000000
+    for c, questions in enumerate(conversations):
+        connection_id = f"{'routed' if routing else 'strong'}-{c}"
+        for question in questions:
+            request_id += 1000
+            before = len(bedrock.requests)
+            start = time.perf_counter()
+            bedrock_interface.handler(
+                {"data": {"message": question}, "timestamp": str(request_id), "ConnectionID": connection_id},
+                stubs.FakeLambdaContext(),
+            )
+            end = time.perf_counter()
+            first_frame = next(f for f in apigw.frames_for(connection_id) if f["sent_at"] >= start)
+            ttft.append((first_frame["sent_at"] - start) * 1000)
+            total.append((end - start) * 1000)
+            models = [r["modelId"] for r in bedrock.requests[before:]]
+            answered_by["escalated" if len(models) > 1 else ("fast" if models[0] == FAST_MODEL_ID else "strong")] += 1
+    return {"ttft": ttft, "total": total, "answered_by": answered_by}
+
+
+def check_no_context(args, questions) -> list:
+    """Opening questions with no documents, answered by a fast tier that always refuses."""
+    import bedrock_interface
+
+    bedrock = stubs.FakeBedrockRuntime(
+        tokens=args.tokens,
+        model_latencies={
+            FAST_MODEL_ID: (args.fast_first_token_ms, args.fast_token_interval_ms),
+            STRONG_MODEL_ID: (args.strong_first_token_ms, args.strong_token_interval_ms),
+        },
+        refusal_models=(FAST_MODEL_ID,),
+        refusal_rate=1.0,
+    )
+    stubs.install_fakes(
+        bedrock_interface,
+        bedrock,
+        stubs.FakeAgentRuntime(args.retrieve_ms, results=0),
+        stubs.FakeApiGatewayManagement(latency_ms=1),
+        boto3.client("dynamodb"),
+    )
+    stubs.configure_handler_environment(
+        DEPLOYMENT_MODE="direct",
+        BEDROCK_MODEL_ID=STRONG_MODEL_ID,
+        STRONG_MODEL_ID=STRONG_MODEL_ID,
+        FAST_MODEL_ID=FAST_MODEL_ID,
+    )
+    problems = []
+    for q, question in enumerate(questions):
+        before = len(bedrock.requests)
+        bedrock_interface.handler(
+            {"data": {"message": question}, "timestamp": str(1900000000000 + q), "ConnectionID": f"no-context-{q}"},
+            stubs.FakeLambdaContext(),
+        )
+        models = [r["modelId"] for r in bedrock.requests[before:]]
+        if models != [FAST_MODEL_ID]:
+            problems.append(f"{question!r} invoked {models}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=12)
+    parser.add_argument("--fast-first-token-ms", type=float, default=250)
+    parser.add_argument("--fast-token-interval-ms", type=float, default=4)
+    parser.add_argument("--strong-first-token-ms", type=float, default=600)
+    parser.add_argument("--strong-token-interval-ms", type=float, default=12)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--retrieve-ms", type=float, default=50)
+    parser.add_argument("--refusal-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open(CORPUS) as f:
+        conversations = [json.loads(line)["turns"] for line in f][: args.conversations]
+
+    stubs.configure_handler_environment()
+    with mock_aws():
+        local_env.create_context_table()
+        results = {"strong only": run(args, False, conversations), "routed": run(args, True, conversations)}
+        no_context_problems = check_no_context(args, [turns[0] for turns in conversations])
+
+    print(f"{'':>12} {'TTFT p50':>9} {'p90':>7} {'total p50':>10} {'p90':>7}  answered by")
+    for name, r in results.items():
+        print(
+            f"{name:>12} {percentile(r['ttft'], 50):>7.0f}ms {percentile(r['ttft'], 90):>5.0f}ms"
+            f" {statistics.median(r['total']):>8.0f}ms {percentile(r['total'], 90):>5.0f}ms"
+            f"  {', '.join(f'{k}={v}' for k, v in sorted(r['answered_by'].items()))}"
+        )
+    print(f"{'FAIL' if no_context_problems else 'ok':>4}  an opening question with nothing retrieved makes one fast-tier call")
+    for problem in no_context_problems:
+        print(f"      {problem}")
+    sys.exit(1 if no_context_problems else 0)
+
+
+if __name__ == "__main__":
+    main()
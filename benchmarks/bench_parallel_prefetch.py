@@ -0,0 +1,99 @@
+"""
+Compares the state machine fetching history and then letting the inference
+function retrieve documents, against the "Prefetch context" Parallel state that
+does both at once and hands the retrieval results to the function.
+
+    python bench_parallel_prefetch.py --iterations 20 --retrieve-ms 150
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from moto import mock_aws
+
+import local_env
+import stubs
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+
+def as_sdk_integration_output(response):
+    """Shapes a boto3 retrieve response like the Step Functions SDK integration returns it."""
+    return {
+        "RetrievalResults": [
+            {
+                "Content": {"Text": r["content"]["text"]},
+                "Location": {
+                    "Type": r["location"]["type"],
+                    "S3Location": {"Uri": r["location"]["s3Location"]["uri"]},
+                },
+                "Score": r["score"],
+            }
+            for r in response["retrievalResults"]
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--state-transition-ms", type=float, default=10)
+    parser.add_argument("--dynamodb-ms", type=float, default=6)
+    parser.add_argument("--retrieve-ms", type=float, default=150)
+    parser.add_argument("--first-token-ms", type=float, default=400)
+    args = parser.parse_args()
+
+    stubs.configure_handler_environment()
+    with mock_aws():
+        local_env.create_context_table()
+        import bedrock_interface
+
+        apigw = stubs.FakeApiGatewayManagement(latency_ms=5)
+        agent_runtime = stubs.FakeAgentRuntime(args.retrieve_ms)
+        stubs.install_fakes(
+            bedrock_interface,
+            stubs.FakeBedrockRuntime(args.first_token_ms, 5, 20),
+            agent_runtime,
+            apigw,
+            boto3.client("dynamodb"),
+        )
+
+        def fetch(connection_id):
+            stubs.sleep_ms(args.dynamodb_ms)
+            return {"Items": local_env.fetch_history(local_env.CONTEXT_TABLE_NAME, connection_id, 5)}
+
+        def retrieve(question):
+            return as_sdk_integration_output(
+                agent_runtime.retrieve({"text": question}, "KBLOCAL", {"vectorSearchConfiguration": {"numberOfResults": 10}})
+            )
+
+        question = "What is the deadline for NSF 24-553?"
+        results = {"sequential": [], "parallel": []}
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for i in range(args.iterations):
+                for mode in results:
+                    connection_id = f"{mode}-{i}"
+                    event = {"data": {"message": question}, "timestamp": str(i), "ConnectionID": connection_id}
+                    start = time.perf_counter()
+                    stubs.sleep_ms(args.state_transition_ms)
+                    if mode == "sequential":
+                        event["contentResults"] = fetch(connection_id)
+                    else:
+                        history = pool.submit(fetch, connection_id)
+                        retrieval = pool.submit(retrieve, question)
+                        event["contentResults"] = history.result()
+                        event["retrievalResults"] = retrieval.result()
+                    stubs.sleep_ms(args.state_transition_ms)
+                    bedrock_interface.handler(event, stubs.FakeLambdaContext())
+                    results[mode].append((apigw.first_frame_at(connection_id) - start) * 1000)
+
+    print(f"{'mode':>11} {'TTFT p50':>10} {'TTFT max':>10}")
+    for mode, ttft in results.items():
+        print(f"{mode:>11} {statistics.median(ttft):>8.0f}ms {max(ttft):>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Sends the same opening question from many connections at once, with and
+without request coalescing. It reports model invocations, retrievals and
+time-to-first-token, and checks that every connection received the complete
+answer followed by [[END]]. History and the flight items live in moto
+DynamoDB, and the model is a fake stream.
+
+    python bench_request_coalescing.py --connections 20 --stagger-ms 50
+"""
+
+import argparse
+import statistics
+import threading
+import time
+
+import boto3
+from moto import mock_aws
+
+import local_env
+import stubs
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def run(args, coalescing: bool) -> dict:
+    import bedrock_interface
+
+    bedrock = stubs.FakeBedrockRuntime(args.first_token_ms, args.token_interval_ms, args.tokens)
+    agent_runtime = stubs.FakeAgentRuntime(args.retrieve_ms, results=5)
+    apigw = stubs.FakeApiGatewayManagement(latency_ms=2)
+    stubs.install_fakes(
+        bedrock_interface,
+        bedrock,
+        agent_runtime,
+        apigw,
+        stubs.DelayedClient(boto3.client("dynamodb"), args.dynamodb_ms),
+    )
+    stubs.configure_handler_environment(
+        DEPLOYMENT_MODE="direct",
+        COALESCING_ENABLED="true" if coalescing else "false",
+        COALESCING_POLL_MS=str(args.poll_ms),
+        COALESCING_FLUSH_MS=str(args.flush_ms),
+    )
+
+    prefix = "coalesced" if coalescing else "independent"
+    starts, errors = {}, []
+
+    def ask(i):
+        connection_id = f"{prefix}-{i}"
+        starts[connection_id] = time.perf_counter()
+        try:
+            bedrock_interface.handler(
+                {
+                    "data": {"message": "What is the deadline for NSF 24-553?" if i % 2 else "what is the deadline for NSF 24-553"},
+                    "timestamp": str(1800000000000 + i),
+                    "ConnectionID": connection_id,
+                },
+                stubs.FakeLambdaContext(),
+            )
+        except Exception as e:
+            errors.append(f"{connection_id}: {e}")
+
+    threads = []
+    for i in range(args.connections):
+        thread = threading.Thread(target=ask, args=(i,))
+        thread.start()
+        threads.append(thread)
+        stubs.sleep_ms(args.stagger_ms)
+    for thread in threads:
+        thread.join()
+
+    ttft, answers = [], set()
+    for connection_id, start in starts.items():
+        frames = apigw.frames_for(connection_id)
+        if not frames or frames[-1]["data"] != "[[END]]":
+            errors.append(f"{connection_id}: answer did not end with [[END]]")
+            continue
+        ttft.append((frames[0]["sent_at"] - start) * 1000)
+        answers.add("".join(f["data"] for f in frames[:-1]))
+    return {
+        "model_invocations": len(bedrock.requests),
+        "retrievals": agent_runtime.calls,
+        "ttft": ttft,
+        "distinct_answers": len(answers),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--stagger-ms", type=float, default=50, help="delay between connections asking")
+    parser.add_argument("--first-token-ms", type=float, default=400)
+    parser.add_argument("--token-interval-ms", type=float, default=10)
+    parser.add_argument("--tokens", type=int, default=150)
+    parser.add_argument("--retrieve-ms", type=float, default=100)
+    parser.add_argument("--dynamodb-ms", type=float, default=5)
+    parser.add_argument("--poll-ms", type=int, default=100)
+    parser.add_argument("--flush-ms", type=int, default=100)
+    args = parser.parse_args()
+
+    stubs.configure_handler_environment()
+    with mock_aws():
+        local_env.create_context_table()
+        results = {"independent": run(args, False), "coalesced": run(args, True)}
+
+    print(f"{'':>12} {'model calls':>12} {'retrievals':>11} {'TTFT p50':>9} {'p90':>7} {'max':>7} {'answers':>8}")
+    for name, r in results.items():
+        print(
+            f"{name:>12} {r['model_invocations']:>12} {r['retrievals']:>11}"
+            f" {statistics.median(r['ttft']):>7.0f}ms {percentile(r['ttft'], 90):>5.0f}ms {max(r['ttft']):>5.0f}ms"
+            f" {r['distinct_answers']:>8}"
+        )
+        for error in r["errors"]:
+            print(f"  ERROR {error}")
+    print("(\"answers\" counts distinct answer texts; coalesced connections must all receive the same one)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,648 @@
+"""
+Evaluates retrieval quality and cost against the golden question set in
+corpus/golden_retrieval.json. Each question there is labelled with the
+documents and pages of ../data that answer it. For every cut-off k the script
+reports:
+
+- recall@k: fraction of questions with a relevant chunk in the top k
+- MRR@k: mean reciprocal rank of the first relevant chunk
+- context tokens: estimated tokens the top k chunks add to the prompt
+
+It also reports retrieve latency percentiles. With --compression-ratio, the
+top chunks at the deepest k are also compressed like the inference function
+does (see src/bedrock_interface/context_compression.py). It then reports the
+context tokens left and how many of the questions whose labelled answer
+(for example a deadline or a funding amount) was retrieved still have that
+answer in the compressed context. With --adaptive, the top chunks are first
+cut to an adaptive depth like the inference function does (see
+src/bedrock_interface/retrieval_depth.py), and recall, documents and context
+tokens are reported for the cut list, along with how many of the golden
+set's unanswerable questions get no documents at all. All backends implement
+the same interface:
+
+- stub: ``vector_db_retrieve`` against a local BM25 index of the PDFs. The
+  PDFs are chunked like the knowledge base data source (fixed size, with
+  overlap). Offline, and fast enough to sweep chunking settings.
+- knowledge-base: ``vector_db_retrieve`` against a deployed knowledge base.
+- pgvector: a pgvector table laid out like aws_managed.kb (see data/vector.sql).
+  This can be a local Postgres loaded with --pg-load, or the cluster the
+  knowledge base writes to.
+
+Results are written as JSON with the golden set version, corpus hashes and
+backend settings. --compare prints the difference to an earlier run.
+
+    python bench_retrieval.py --backend stub --k 1 3 5 10 --output stub-300.json
+    python bench_retrieval.py --backend stub --chunk-tokens 600 --compare stub-300.json
+    python bench_retrieval.py --backend stub --compression-ratio 0.35
+    python bench_retrieval.py --backend stub --k 1 3 5 10 20 --adaptive --score-floor 13
+    python bench_retrieval.py --backend knowledge-base --knowledge-base-id ABCDEFGHIJ
+    python bench_retrieval.py --backend pgvector --pg-dsn postgresql://localhost/kb --pg-load --embedding hashing
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import local_env
+
+local_env.add_lambda_to_path("bedrock_interface")
+
+DATA_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+DEFAULT_GOLDEN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "corpus", "golden_retrieval.json"
+)
+# Metadata keys the knowledge base attaches to every chunk it stores and returns
+SOURCE_URI_KEY = "x-amz-bedrock-kb-source-uri"
+PAGE_NUMBER_KEY = "x-amz-bedrock-kb-document-page-number"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:-[0-9]+)?")
+
+
+def estimate_tokens(text: str) -> int:
+    # Same estimate as the inference function's PromptTokensEstimated metric
+    return len(text) // 4
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def load_pages(documents: List[str]) -> Dict[str, List[str]]:
+    """Extracts the text of every page of the given PDFs in ../data."""
+    from pypdf import PdfReader
+
+    # Some of the PDFs have broken cross-references that pypdf recovers from noisily
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+    pages = {}
+    for document in documents:
+        reader = PdfReader(os.path.join(DATA_ROOT, document))
+        pages[document] = [" ".join((page.extract_text() or "").split()) for page in reader.pages]
+    return pages
+
+
+def chunk_pages(pages: Dict[str, List[str]], chunk_tokens: int, overlap_percentage: int) -> List[Dict[str, Any]]:
+    """
+    Splits every page into fixed-size, overlapping chunks, like the knowledge base's
+    FIXED_SIZE chunking strategy. Each chunk remembers its document and page.
+    """
+    # About three quarters of a word per token for this kind of English prose
+    size = max(1, int(chunk_tokens * 0.75))
+    step = max(1, size - size * overlap_percentage // 100)
+    chunks = []
+    for document, texts in pages.items():
+        for number, text in enumerate(texts, start=1):
+            words = text.split()
+            for start in range(0, max(len(words) - size + step, 1), step):
+                chunks.append(
+                    {"document": document, "page": number, "text": " ".join(words[start : start + size])}
+                )
+    return chunks
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class Bm25Index:
+    """A small in-memory BM25 index, standing in for the vector store."""
+
+    def __init__(self, chunks: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.terms = [Counter(tokenize(c["text"])) for c in chunks]
+        self.lengths = [sum(t.values()) for t in self.terms]
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1)
+        frequencies = Counter(term for terms in self.terms for term in terms)
+        n = len(chunks)
+        self.idf = {t: math.log(1 + (n - f + 0.5) / (f + 0.5)) for t, f in frequencies.items()}
+
+    def search(self, query: str, k: int) -> List[tuple]:
+        query_terms = [t for t in tokenize(query) if t in self.idf]
+        scores = []
+        for i, terms in enumerate(self.terms):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.average_length)
+            for t in query_terms:
+                tf = terms.get(t)
+                if tf:
+                    score += self.idf[t] * tf * (self.k1 + 1) / (tf + norm)
+            if score:
+                scores.append((score, i))
+        scores.sort(reverse=True)
+        return [(self.chunks[i], score) for score, i in scores[:k]]
+
+
+class LocalAgentRuntime:
+    """Answers ``retrieve`` from a Bm25Index, in the response shape of bedrock-agent-runtime."""
+
+    def __init__(self, index: Bm25Index, latency_ms: float = 0):
+        self.index = index
+        self.latency_ms = latency_ms
+
+    def retrieve(self, retrievalQuery, knowledgeBaseId, retrievalConfiguration=None):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        k = retrievalConfiguration["vectorSearchConfiguration"]["numberOfResults"]
+        return {
+            "retrievalResults": [
+                {
+                    "content": {"text": chunk["text"]},
+                    "location": {"type": "S3", "s3Location": {"uri": f"s3://local/{chunk['document']}"}},
+                    "score": score,
+                    "metadata": {
+                        SOURCE_URI_KEY: f"s3://local/{chunk['document']}",
+                        PAGE_NUMBER_KEY: chunk["page"],
+                    },
+                }
+                for chunk, score in self.index.search(retrievalQuery["text"], k)
+            ]
+        }
+
+
+class RetrievalBackend:
+    """Common interface: the top k chunks for a question, as hits with document and page."""
+
+    name = "backend"
+
+    def retrieve(self, question: str, k: int) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def describe(self) -> Dict[str, Any]:
+        """The settings that make results of this backend comparable."""
+        return {"backend": self.name}
+
+
+def hits_from_retrieve_response(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Converts a boto3-shaped retrieve response into hits."""
+    hits = []
+    for result in response["retrievalResults"]:
+        metadata = result.get("metadata") or {}
+        uri = metadata.get(SOURCE_URI_KEY) or result["location"]["s3Location"]["uri"]
+        page = metadata.get(PAGE_NUMBER_KEY)
+        hits.append(
+            {
+                "document": uri.rsplit("/", 1)[-1],
+                "page": int(page) if page is not None else None,
+                "text": result["content"]["text"],
+                "score": result.get("score"),
+            }
+        )
+    return hits
+
+
+class VectorDbRetrieveBackend(RetrievalBackend):
+    """Goes through ``bedrock_interface.vector_db_retrieve``, the function the handler uses."""
+
+    def __init__(self, knowledge_base_id: str):
+        import bedrock_interface
+
+        self.bedrock_interface = bedrock_interface
+        self.knowledge_base_id = knowledge_base_id
+
+    def retrieve(self, question, k):
+        response = self.bedrock_interface.vector_db_retrieve(
+            question, self.knowledge_base_id, numberOfResults=k
+        )
+        return hits_from_retrieve_response(response)
+
+
+class KnowledgeBaseBackend(VectorDbRetrieveBackend):
+    name = "knowledge-base"
+
+    def describe(self):
+        return {"backend": self.name, "knowledge_base_id": self.knowledge_base_id}
+
+
+class StubBackend(VectorDbRetrieveBackend):
+    name = "stub"
+
+    def __init__(self, documents: List[str], chunk_tokens: int, overlap_percentage: int, latency_ms: float):
+        super().__init__("KBLOCAL")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_percentage = overlap_percentage
+        self.latency_ms = latency_ms
+        self.chunks = chunk_pages(load_pages(documents), chunk_tokens, overlap_percentage)
+        self.bedrock_interface.bedrock_agent_runtime = LocalAgentRuntime(Bm25Index(self.chunks), latency_ms)
+
+    def describe(self):
+        return {
+            "backend": self.name,
+            "chunk_tokens": self.chunk_tokens,
+            "overlap_percentage": self.overlap_percentage,
+            "latency_ms": self.latency_ms,
+            "chunks": len(self.chunks),
+        }
+
+
+def hashing_embedding(text: str, dimensions: int = 1536) -> List[float]:
+    """
+    A deterministic, offline embedding: hashed unigrams and bigrams, L2-normalised.
+    Far weaker than Titan, but it lets the pgvector path run without AWS.
+    """
+    vector = [0.0] * dimensions
+    tokens = tokenize(text)
+    for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dimensions] += 1.0 if value >> 63 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def titan_embedding(text: str) -> List[float]:
+    """The embedding model the knowledge base is configured with."""
+    import boto3
+
+    response = boto3.client("bedrock-runtime").invoke_model(
+        modelId="amazon.titan-embed-text-v1", body=json.dumps({"inputText": text})
+    )
+    return json.loads(response["body"].read())["embedding"]
+
+
+class PgvectorBackend(RetrievalBackend):
+    """Cosine-distance search over a table laid out like aws_managed.kb."""
+
+    name = "pgvector"
+
+    def __init__(self, dsn: str, table: str, embedding: str):
+        import psycopg2
+
+        self.connection = psycopg2.connect(dsn)
+        self.connection.autocommit = True
+        self.table = table
+        self.embedding = embedding
+        self.embed = hashing_embedding if embedding == "hashing" else titan_embedding
+
+    def load(self, documents: List[str], chunk_tokens: int, overlap_percentage: int) -> int:
+        """Replaces the table's contents with freshly chunked and embedded PDFs."""
+        import uuid
+
+        chunks = chunk_pages(load_pages(documents), chunk_tokens, overlap_percentage)
+        schema = self.table.split(".")[0] if "." in self.table else "public"
+        with self.connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(id uuid PRIMARY KEY, embedding vector(1536), chunks text, metadata jsonb, tenantid bigint)"
+            )
+            cursor.execute(f"TRUNCATE {self.table}")
+            for chunk in chunks:
+                cursor.execute(
+                    f"INSERT INTO {self.table} (id, embedding, chunks, metadata) VALUES (%s, %s::vector, %s, %s)",
+                    (
+                        str(uuid.uuid4()),
+                        str(self.embed(chunk["text"])),
+                        chunk["text"],
+                        json.dumps(
+                            {
+                                SOURCE_URI_KEY: f"s3://local/{chunk['document']}",
+                                PAGE_NUMBER_KEY: chunk["page"],
+                            }
+                        ),
+                    ),
+                )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table.replace('.', '_')}_embedding_idx "
+                f"ON {self.table} USING hnsw (embedding vector_cosine_ops)"
+            )
+        return len(chunks)
+
+    def retrieve(self, question, k):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT chunks, metadata, 1 - (embedding <=> %s::vector) FROM {self.table} "
+                "ORDER BY embedding <=> %s::vector LIMIT %s",
+                (str(self.embed(question)),) * 2 + (k,),
+            )
+            rows = cursor.fetchall()
+        hits = []
+        for text, metadata, score in rows:
+            page = metadata.get(PAGE_NUMBER_KEY)
+            hits.append(
+                {
+                    "document": metadata.get(SOURCE_URI_KEY, "").rsplit("/", 1)[-1],
+                    "page": int(page) if page is not None else None,
+                    "text": text,
+                    "score": score,
+                }
+            )
+        return hits
+
+    def describe(self):
+        return {"backend": self.name, "table": self.table, "embedding": self.embedding}
+
+
+def is_relevant(hit: Dict[str, Any], labels: List[Dict[str, Any]], match: str) -> bool:
+    for label in labels:
+        if hit["document"] != label["document"]:
+            continue
+        # A hit without a page number only counts at document level
+        if match == "document" or not label.get("pages") or hit["page"] in label["pages"]:
+            return True
+    return False
+
+
+def compress(question: str, hits: List[Dict[str, Any]]) -> tuple:
+    """Compresses the hits' text like the inference function, timing it."""
+    import context_compression
+
+    docs = {"retrievalResults": [{"content": {"text": h["text"]}} for h in hits]}
+    start = time.perf_counter()
+    compressed, _ = context_compression.compress_docs(question, docs)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return " ".join(r["content"]["text"] for r in compressed["retrievalResults"]), elapsed_ms
+
+
+def adapt(hits: List[Dict[str, Any]]) -> tuple:
+    """Cuts the hits to an adaptive depth like the inference function."""
+    import retrieval_depth
+
+    docs = {"retrievalResults": [dict(h, content={"text": h["text"]}) for h in hits]}
+    adapted, decision = retrieval_depth.adapt_results(docs)
+    return adapted["retrievalResults"], decision
+
+
+def evaluate(
+    backend: RetrievalBackend,
+    golden: Dict[str, Any],
+    ks: List[int],
+    match: str,
+    compression: bool = False,
+    adaptive: bool = False,
+) -> Dict[str, Any]:
+    depth = max(ks)
+    per_question = []
+    latencies = []
+    compression_latencies = []
+    for item in golden["questions"]:
+        start = time.perf_counter()
+        hits = backend.retrieve(item["question"], depth)
+        latencies.append((time.perf_counter() - start) * 1000)
+        rank = next(
+            (i + 1 for i, hit in enumerate(hits) if is_relevant(hit, item["relevant"], match)), None
+        )
+        result = {
+            "id": item["id"],
+            "rank": rank,
+            "tokens": [estimate_tokens(" ".join(h["text"] for h in hits[:k])) for k in ks],
+            "top": [f"{h['document']}#{h['page']}" for h in hits[:3]],
+        }
+        if adaptive:
+            hits, decision = adapt(hits)
+            result["adaptive"] = {
+                "kept": decision["kept"],
+                "reason": decision["reason"],
+                "top_score": decision["top_score"],
+                "found": any(is_relevant(h, item["relevant"], match) for h in hits),
+                "tokens": estimate_tokens(" ".join(h["text"] for h in hits)),
+            }
+        if compression:
+            text, elapsed_ms = compress(item["question"], hits)
+            compression_latencies.append(elapsed_ms)
+            retrieved = " ".join(h["text"] for h in hits)
+            answers = item.get("answers", [])
+            result["compressed_tokens"] = estimate_tokens(text)
+            # None when there is no labelled answer in the retrieved chunks to keep
+            result["answer_kept"] = (
+                any(a in text for a in answers) if any(a in retrieved for a in answers) else None
+            )
+        per_question.append(result)
+
+    n = len(per_question)
+    cutoffs = []
+    for j, k in enumerate(ks):
+        ranks = [q["rank"] for q in per_question]
+        tokens = [q["tokens"][j] for q in per_question]
+        cutoffs.append(
+            {
+                "k": k,
+                "recall": sum(1 for r in ranks if r is not None and r <= k) / n,
+                "mrr": sum(1 / r for r in ranks if r is not None and r <= k) / n,
+                "context_tokens_mean": sum(tokens) / n,
+                "context_tokens_p90": percentile(tokens, 90),
+            }
+        )
+    results = {
+        "cutoffs": cutoffs,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p90_ms": percentile(latencies, 90),
+        "latency_p99_ms": percentile(latencies, 99),
+        "questions": per_question,
+    }
+    if adaptive:
+        cut = [q["adaptive"] for q in per_question]
+        unanswerable = []
+        for item in golden.get("unanswerable", []):
+            _, decision = adapt(backend.retrieve(item["question"], depth))
+            unanswerable.append(decision)
+        found_scores = [c["top_score"] for c in cut if c["found"]]
+        results["adaptive"] = {
+            "k": depth,
+            "recall": sum(c["found"] for c in cut) / n,
+            "documents_mean": sum(c["kept"] for c in cut) / n,
+            "context_tokens_mean": sum(c["tokens"] for c in cut) / n,
+            "reasons": dict(Counter(c["reason"] for c in cut)),
+            "answerable_skipped": sum(1 for c in cut if not c["kept"]),
+            "unanswerable_skipped": sum(1 for d in unanswerable if not d["kept"]),
+            "unanswerable": len(unanswerable),
+            # A score floor between these skips the unanswerable questions but none that found an answer
+            "top_score_unanswerable_max": max((d["top_score"] or 0 for d in unanswerable), default=None),
+            "top_score_found_min": min(found_scores, default=None),
+        }
+    if compression:
+        kept = [q["answer_kept"] for q in per_question if q["answer_kept"] is not None]
+        results["compression"] = {
+            "k": depth,
+            "context_tokens_mean": sum(q["compressed_tokens"] for q in per_question) / n,
+            "answers_retrieved": len(kept),
+            "answer_retention": sum(kept) / len(kept) if kept else None,
+            "latency_p50_ms": percentile(compression_latencies, 50),
+            "latency_p99_ms": percentile(compression_latencies, 99),
+        }
+    return results
+
+
+def check_corpus(golden: Dict[str, Any]) -> List[str]:
+    """Returns the documents whose contents no longer match the golden set's labels."""
+    changed = []
+    for document, info in golden["documents"].items():
+        path = os.path.join(DATA_ROOT, document)
+        if not os.path.exists(path):
+            changed.append(f"{document} (missing)")
+            continue
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != info["sha256"]:
+                changed.append(document)
+    return changed
+
+
+def print_results(results: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> None:
+    print(
+        f"golden set v{results['golden_version']}, {results['question_count']} questions, "
+        f"{results['match']}-level match, {json.dumps(results['settings'])}"
+    )
+    before = {c["k"]: c for c in previous["cutoffs"]} if previous else {}
+
+    def delta(value, old, fmt):
+        return f" ({value - old:+{fmt}})" if old is not None else ""
+
+    print(f"{'k':>4} {'recall@k':>18} {'MRR@k':>18} {'context tokens':>22}")
+    for c in results["cutoffs"]:
+        old = before.get(c["k"], {})
+        print(
+            f"{c['k']:>4} {c['recall']:>8.3f}{delta(c['recall'], old.get('recall'), '.3f'):<10}"
+            f" {c['mrr']:>8.3f}{delta(c['mrr'], old.get('mrr'), '.3f'):<10}"
+            f" {c['context_tokens_mean']:>10.0f}{delta(c['context_tokens_mean'], old.get('context_tokens_mean'), '.0f'):<12}"
+        )
+    latency = f"retrieve latency p50 {results['latency_p50_ms']:.1f}ms p90 {results['latency_p90_ms']:.1f}ms p99 {results['latency_p99_ms']:.1f}ms"
+    if previous:
+        latency += f" (p50 before: {previous['latency_p50_ms']:.1f}ms)"
+    print(latency)
+    adaptive = results.get("adaptive")
+    if adaptive:
+        full = next(c for c in results["cutoffs"] if c["k"] == adaptive["k"])
+        old = (previous or {}).get("adaptive") or {}
+        print(
+            f"adaptive depth up to k={adaptive['k']}: recall {adaptive['recall']:.3f}"
+            f"{delta(adaptive['recall'], old.get('recall'), '.3f')} (fixed {full['recall']:.3f}),"
+            f" documents {adaptive['documents_mean']:.1f}, context tokens {adaptive['context_tokens_mean']:.0f}"
+            f"{delta(adaptive['context_tokens_mean'], old.get('context_tokens_mean'), '.0f')}"
+            f" (fixed {full['context_tokens_mean']:.0f}), cuts {json.dumps(adaptive['reasons'])}"
+        )
+        print(
+            f"no documents for {adaptive['unanswerable_skipped']} of {adaptive['unanswerable']} unanswerable"
+            f" and {adaptive['answerable_skipped']} answerable questions; top scores: unanswerable max"
+            f" {adaptive['top_score_unanswerable_max'] or 0:.3f}, answer found min {adaptive['top_score_found_min'] or 0:.3f}"
+        )
+    compression = results.get("compression")
+    if compression:
+        full = next(c["context_tokens_mean"] for c in results["cutoffs"] if c["k"] == compression["k"])
+        old = (previous or {}).get("compression") or {}
+        retention = compression["answer_retention"]
+        print(
+            f"compressed at k={compression['k']}: context tokens {compression['context_tokens_mean']:.0f}"
+            f" (from {full:.0f}, {1 - compression['context_tokens_mean'] / full:.0%} fewer)"
+            f"{delta(compression['context_tokens_mean'], old.get('context_tokens_mean'), '.0f')},"
+            f" answers kept {retention if retention is None else format(retention, '.3f')}"
+            f" of {compression['answers_retrieved']} retrieved"
+            f"{delta(retention, old.get('answer_retention'), '.3f') if retention is not None else ''},"
+            f" compression p50 {compression['latency_p50_ms']:.1f}ms p99 {compression['latency_p99_ms']:.1f}ms"
+        )
+        lost = [q["id"] for q in results["questions"] if q.get("answer_kept") is False]
+        if lost:
+            print(f"answer retrieved but compressed away for: {', '.join(lost)}")
+    missed = [q["id"] for q in results["questions"] if q["rank"] is None]
+    if missed:
+        print(f"no relevant chunk retrieved for: {', '.join(missed)}")
+
+
+def retrieval_depth_settings() -> Dict[str, Any]:
+    import retrieval_depth
+
+    return retrieval_depth.depth_settings()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["stub", "knowledge-base", "pgvector"], default="stub")
+    parser.add_argument("--golden", default=DEFAULT_GOLDEN)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    parser.add_argument("--match", choices=["page", "document"], default="page")
+    parser.add_argument("--chunk-tokens", type=int, default=300, help="stub and --pg-load chunk size")
+    parser.add_argument("--overlap-percentage", type=int, default=20, help="stub and --pg-load chunk overlap")
+    parser.add_argument("--stub-latency-ms", type=float, default=0, help="added to every stub retrieve")
+    parser.add_argument("--knowledge-base-id", default=os.getenv("KNOWLEDGE_BASE_ID"))
+    parser.add_argument("--pg-dsn", default=os.getenv("PG_DSN", "postgresql://localhost/postgres"))
+    parser.add_argument("--pg-table", default="aws_managed.kb")
+    parser.add_argument("--pg-load", action="store_true", help="chunk, embed and load the PDFs first")
+    parser.add_argument("--embedding", choices=["titan", "hashing"], default="titan")
+    parser.add_argument(
+        "--compression-ratio",
+        type=float,
+        help="also compress the deepest k chunks, keeping this fraction of their text",
+    )
+    parser.add_argument("--adaptive", action="store_true", help="also cut the deepest k chunks adaptively")
+    parser.add_argument("--max-results", type=int, help="adaptive: RETRIEVAL_RESULTS")
+    parser.add_argument("--min-results", type=int, help="adaptive: RETRIEVAL_MIN_RESULTS")
+    parser.add_argument("--relative-score", type=float, help="adaptive: RETRIEVAL_RELATIVE_SCORE")
+    parser.add_argument("--score-gap", type=float, help="adaptive: RETRIEVAL_SCORE_GAP")
+    parser.add_argument("--score-floor", type=float, help="adaptive: RETRIEVAL_SCORE_FLOOR")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    with open(args.golden) as f:
+        golden = json.load(f)
+    documents = sorted(golden["documents"])
+    changed = check_corpus(golden)
+    if changed:
+        print(f"warning: the page labels were made for other versions of: {', '.join(changed)}")
+
+    if args.compression_ratio is not None:
+        os.environ["CONTEXT_COMPRESSION_RATIO"] = str(args.compression_ratio)
+    # The deepest k is what the inference function fetches; it keeps at most --max-results
+    os.environ["RETRIEVAL_FETCH_RESULTS"] = str(max(args.k))
+    for option, variable in (
+        ("max_results", "RETRIEVAL_RESULTS"),
+        ("min_results", "RETRIEVAL_MIN_RESULTS"),
+        ("relative_score", "RETRIEVAL_RELATIVE_SCORE"),
+        ("score_gap", "RETRIEVAL_SCORE_GAP"),
+        ("score_floor", "RETRIEVAL_SCORE_FLOOR"),
+    ):
+        if getattr(args, option) is not None:
+            os.environ[variable] = str(getattr(args, option))
+    if args.backend == "stub":
+        backend = StubBackend(documents, args.chunk_tokens, args.overlap_percentage, args.stub_latency_ms)
+    elif args.backend == "knowledge-base":
+        if not args.knowledge_base_id:
+            parser.error("--knowledge-base-id (or KNOWLEDGE_BASE_ID) is required")
+        backend = KnowledgeBaseBackend(args.knowledge_base_id)
+    else:
+        backend = PgvectorBackend(args.pg_dsn, args.pg_table, args.embedding)
+        if args.pg_load:
+            loaded = backend.load(documents, args.chunk_tokens, args.overlap_percentage)
+            print(f"loaded {loaded} chunks into {args.pg_table}")
+
+    results = {
+        "golden_version": golden["version"],
+        "question_count": len(golden["questions"]),
+        "match": args.match,
+        "settings": dict(
+            backend.describe(),
+            compression_ratio=args.compression_ratio,
+            adaptive=args.adaptive and retrieval_depth_settings(),
+        ),
+        "changed_documents": changed,
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        **evaluate(
+            backend, golden, sorted(args.k), args.match, args.compression_ratio is not None, args.adaptive
+        ),
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous["golden_version"] != results["golden_version"] or previous["match"] != results["match"]:
+            print("warning: the earlier run used another golden set version or match level")
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
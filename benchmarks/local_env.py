@@ -0,0 +1,110 @@
+"""Shared setup for running the lambdas in ``src`` against local AWS stand-ins."""
+
+import os
+import random
+import sys
+
+import boto3
+
+SRC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+CONTEXT_TABLE_NAME = "aaa-context"
+
+# The lambdas build their boto3 clients at import, so credentials and a region
+# have to exist before they are imported. Nothing here ever reaches AWS.
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_SESSION_TOKEN", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def add_lambda_to_path(name: str) -> None:
+    """Makes the modules of ``src/<name>`` importable the way the Lambda runtime sees them."""
+    path = os.path.join(SRC_ROOT, name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def create_context_table(table_name: str = CONTEXT_TABLE_NAME) -> None:
+    """Creates the context table with the same key schema as ``ContextStack``. Call inside ``mock_aws``."""
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {"AttributeName": "PK", "KeyType": "HASH"},
+            {"AttributeName": "SK", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "PK", "AttributeType": "S"},
+            {"AttributeName": "SK", "AttributeType": "N"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def fetch_history(table_name: str, connection_id: str, limit: int) -> list:
+    """Runs the same query as the "Fetch history" state of the state machine."""
+    dynamodb = boto3.client("dynamodb")
+    response = dynamodb.query(
+        TableName=table_name,
+        KeyConditionExpression="PK = :pk",
+        ExpressionAttributeValues={":pk": {"S": connection_id}},
+        ExpressionAttributeNames={
+            "#question": "question",
+            "#answer": "answer",
+            "#summary": "summary",
+        },
+        ProjectionExpression="#question, #answer, #summary",
+        ScanIndexForward=False,
+        Limit=limit,
+    )
+    return response["Items"]
+
+
+def synthetic_text(words: int, seed: int) -> str:
+    """Deterministic filler text of roughly ``words`` words."""
+    vocabulary = (
+        "the proposal solicitation deadline budget award program research "
+        "eligibility review criteria institution investigator project funding "
+        "NSF directorate submission letter intent collaborative innovation"
+    ).split()
+    return " ".join(
+        vocabulary[(seed * 31 + i * 7) % len(vocabulary)] for i in range(words)
+    )
+
+
+def synthetic_markdown(words: int, seed: int) -> str:
+    """Deterministic markdown answer of roughly ``words`` words, shaped like the model's output."""
+    rng = random.Random(seed)
+    vocabulary = (
+        "the a of to and in for is on that with as by be are this from at or an "
+        "proposal proposals solicitation deadline deadlines budget award awards program "
+        "programs research researchers eligibility eligible review criteria merit broader "
+        "impacts institution institutions investigator principal co-investigator project "
+        "projects funding funded NSF directorate division submission submit letter intent "
+        "collaborative innovation postdoctoral fellowship graduate undergraduate education "
+        "mentoring plan data management outcomes report annual required optional must should "
+        "may within days months years estimated number anticipated total amount maximum "
+        "minimum limit page pages description summary narrative references cited biographical "
+        "sketch current pending support facilities equipment resources partner partners "
+        "organization organizations community communities science engineering computing "
+        "climate energy health security infrastructure network networks training workforce"
+    ).split()
+    lines = []
+    written = 0
+    while written < words:
+        kind = rng.random()
+        length = rng.randint(8, 30)
+        text = " ".join(rng.choice(vocabulary) for _ in range(length))
+        if kind < 0.1:
+            lines.append(f"## {text[:60].title()}")
+        elif kind < 0.45:
+            lines.append(f"- **{rng.choice(vocabulary)}**: {text}")
+        elif kind < 0.55:
+            number = rng.choice(["22-594", "23-532", "24-553", "24-569", "25-523"])
+            lines.append(
+                f"See [NSF {number}](s3://aaa-data/NSF_{number.replace('-', '_')}.pdf) for {text}."
+            )
+        else:
+            lines.append(text.capitalize() + ".")
+        written += length
+    return "\n".join(lines)
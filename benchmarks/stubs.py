@@ -0,0 +1,262 @@
+"""Local stand-ins for the AWS clients used by ``bedrock_interface``."""
+
+import io
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import local_env
+
+
+def sleep_ms(ms: float) -> None:
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+
+class DelayedClient:
+    """Wraps a (moto) boto3 client and adds a fixed network latency to every call."""
+
+    def __init__(self, client: Any, latency_ms: float):
+        self._client = client
+        self._latency_ms = latency_ms
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name in ("get_paginator", "exceptions"):
+            return attribute
+
+        def call(*args, **kwargs):
+            sleep_ms(self._latency_ms)
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+class FakeBedrockRuntime:
+    """
+    Streams a synthetic answer in the event format of invoke_model_with_response_stream.
+    - first_token_ms: Delay before the first content event.
+    - token_interval_ms: Delay between content events.
+    - tokens: Number of content events per answer.
+    - model_latencies: Per model ID (first_token_ms, token_interval_ms), overriding the defaults.
+    - refusal_models: Model IDs that answer "I'm sorry, I don't know" to a refusal_rate fraction of requests.
+    - refusal_rate: See refusal_models.
+    """
+
+    def __init__(
+        self,
+        first_token_ms: float = 400,
+        token_interval_ms: float = 15,
+        tokens: int = 200,
+        model_latencies: Optional[Dict[str, tuple]] = None,
+        refusal_models: tuple = (),
+        refusal_rate: float = 0.0,
+    ):
+        self.first_token_ms = first_token_ms
+        self.token_interval_ms = token_interval_ms
+        self.tokens = tokens
+        self.model_latencies = model_latencies or {}
+        self.refusal_models = refusal_models
+        self.refusal_rate = refusal_rate
+        self.requests: List[Dict[str, Any]] = []
+
+    def _events(self, seed: int, model_id: str):
+        def event(payload):
+            return {"chunk": {"bytes": json.dumps(payload).encode("utf-8")}}
+
+        first_token_ms, token_interval_ms = self.model_latencies.get(
+            model_id, (self.first_token_ms, self.token_interval_ms)
+        )
+        # Deterministic per request, so runs with the same seed refuse the same questions
+        refuses = model_id in self.refusal_models and (seed * 7919 % 1000) / 1000 < self.refusal_rate
+        # Bedrock sends message_start once the model starts producing output
+        sleep_ms(first_token_ms)
+        yield event({"type": "message_start", "message": {"role": "assistant"}})
+        if refuses:
+            words = "I'm sorry, I don't know. The documents provided do not cover this.".split(" ")
+        else:
+            words = local_env.synthetic_markdown(self.tokens, seed).split(" ")
+        for i in range(len(words) if refuses else self.tokens):
+            if i:
+                sleep_ms(token_interval_ms)
+            text = (words[i % len(words)] if words else "x") + " "
+            yield event(
+                {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": text},
+                }
+            )
+        yield event({"type": "content_block_stop", "index": 0})
+        yield event(
+            {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn"},
+                "usage": {"output_tokens": len(words) if refuses else self.tokens},
+            }
+        )
+        yield event({"type": "message_stop"})
+
+    def invoke_model_with_response_stream(self, body: str, modelId: str) -> Dict[str, Any]:
+        self.requests.append({"modelId": modelId, "body": json.loads(body)})
+        return {"body": self._events(len(self.requests), modelId)}
+
+
+class FakeSqlModel:
+    """
+    Answers the SQL-generation requests of the analytics path with a known query per question,
+    in the response format of invoke_model.
+    - queries: The query returned for each question; unknown questions get no query.
+    - latency_ms: Time the generation takes.
+    """
+
+    def __init__(self, queries: Dict[str, str], latency_ms: float = 300):
+        self.queries = queries
+        self.latency_ms = latency_ms
+        self.requests: List[Dict[str, Any]] = []
+
+    def invoke_model(self, body: str, modelId: str) -> Dict[str, Any]:
+        request = json.loads(body)
+        self.requests.append({"modelId": modelId, "body": request})
+        sleep_ms(self.latency_ms)
+        sql = self.queries.get(request["messages"][-1]["content"], "")
+        text = json.dumps({"content": [{"type": "text", "text": f"<sql>{sql}</sql>"}]})
+        return {"body": io.BytesIO(text.encode("utf-8"))}
+
+
+class FakeAgentRuntime:
+    """
+    Answers retrieve with synthetic chunks.
+    - latency_ms: Time the retrieval takes.
+    - results: Maximum number of results returned.
+    - chunk_words: Approximate size of each chunk.
+    """
+
+    def __init__(self, latency_ms: float = 150, results: int = 10, chunk_words: int = 220):
+        self.latency_ms = latency_ms
+        self.results = results
+        self.chunk_words = chunk_words
+        self.calls = 0
+
+    def retrieve(self, retrievalQuery, knowledgeBaseId, retrievalConfiguration=None):
+        self.calls += 1
+        sleep_ms(self.latency_ms)
+        requested = self.results
+        if retrievalConfiguration:
+            requested = retrievalConfiguration["vectorSearchConfiguration"][
+                "numberOfResults"
+            ]
+        count = min(requested, self.results)
+        return {
+            "retrievalResults": [
+                {
+                    "content": {"text": local_env.synthetic_markdown(self.chunk_words, i)},
+                    "location": {
+                        "type": "S3",
+                        "s3Location": {"uri": f"s3://aaa-data/NSF_fake_{i}.pdf"},
+                    },
+                    "score": round(0.9 - i * 0.03, 4),
+                }
+                for i in range(count)
+            ]
+        }
+
+
+class FakeApiGatewayManagement:
+    """Records every frame posted to a connection, with its timestamp and post latency."""
+
+    def __init__(self, latency_ms: float = 5):
+        self.latency_ms = latency_ms
+        self.frames: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def post_to_connection(self, Data, ConnectionId):
+        start = time.perf_counter()
+        sleep_ms(self.latency_ms)
+        end = time.perf_counter()
+        with self._lock:
+            self.frames.append(
+                {
+                    "connection_id": ConnectionId,
+                    "data": Data,
+                    "sent_at": end,
+                    "latency_ms": (end - start) * 1000,
+                }
+            )
+        return {}
+
+    def first_frame_at(self, connection_id: str) -> Optional[float]:
+        for frame in self.frames:
+            if frame["connection_id"] == connection_id:
+                return frame["sent_at"]
+        return None
+
+    def frames_for(self, connection_id: str) -> List[Dict[str, Any]]:
+        return [f for f in self.frames if f["connection_id"] == connection_id]
+
+
+class FakeLambda:
+    """Records asynchronous invocations instead of running them."""
+
+    def __init__(self):
+        self.invocations: List[Dict[str, Any]] = []
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b""):
+        self.invocations.append(
+            {"FunctionName": FunctionName, "InvocationType": InvocationType, "Payload": Payload}
+        )
+        return {"StatusCode": 202}
+
+
+class FakeLambdaContext:
+    """The attributes of the Lambda context object read by Powertools."""
+
+    function_name = "aaa-inference"
+    function_version = "$LATEST"
+    invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:aaa-inference"
+    memory_limit_in_mb = 128
+    aws_request_id = "00000000-0000-0000-0000-000000000000"
+    log_group_name = "/aws/lambda/aaa-inference"
+    log_stream_name = "local"
+
+    def get_remaining_time_in_millis(self) -> int:
+        return 120000
+
+
+def configure_handler_environment(**overrides: str) -> None:
+    """Sets the environment variables InferenceStack gives the inference function."""
+    environment = {
+        "BEDROCK_MODEL_ID": "anthropic.claude-3-sonnet-20240229-v1:0",
+        "ANTHROPIC_VERSION": "bedrock-2023-05-31",
+        "MAX_TOKENS": "8000",
+        "KNOWLEDGE_BASE_ID": "KBLOCAL",
+        "HISTORY_TTL_SECONDS": "3600",
+        "CONTEXT_TABLE_NAME": local_env.CONTEXT_TABLE_NAME,
+        "HISTORY_LIMIT": "5",
+        "COMPACTION_FUNCTION_NAME": "compaction",
+        "DEPLOYMENT_MODE": "state_machine",
+        "POWERTOOLS_SERVICE_NAME": "aaa-inference",
+        "POWERTOOLS_METRICS_NAMESPACE": "aaa",
+        # Keep EMF blobs off stdout unless a benchmark asks for them
+        "POWERTOOLS_METRICS_DISABLED": "true",
+    }
+    environment.update(overrides)
+    os.environ.update(environment)
+
+
+def install_fakes(
+    module: Any,
+    bedrock: FakeBedrockRuntime,
+    agent_runtime: FakeAgentRuntime,
+    apigw: FakeApiGatewayManagement,
+    dynamodb: Any,
+    lambda_client: Optional[FakeLambda] = None,
+) -> None:
+    """Points the module-level clients of ``bedrock_interface`` at the stand-ins."""
+    module.bedrock_client = bedrock
+    module.bedrock_agent_runtime = agent_runtime
+    module.apigatewaymanagementapi_client = apigw
+    module.dynamodb_client = dynamodb
+    module.lambda_client = lambda_client or FakeLambda()
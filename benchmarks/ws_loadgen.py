@@ -0,0 +1,223 @@
+"""
+Load generator for the WebSocketAPI of InferenceStack. It replays multi-turn
+conversations from a question corpus over many concurrent WebSocket sessions.
+For each concurrency level it reports:
+
+- time-to-first-token (TTFT)
+- total answer latency
+- error rates
+
+Each session sends a question as {"message": ...} and reads frames until
+"[[END]]". The next question goes out only after that, like a user waiting for
+the answer. A turn counts as an error if it gets the error message, times out,
+or loses its connection.
+
+    # against the local mock server, started in-process
+    python ws_loadgen.py --mock --concurrency 1 10 50
+
+    # against a deployed stage
+    python ws_loadgen.py --url wss://<api-id>.execute-api.<region>.amazonaws.com/<stage> \\
+        --concurrency 1 5 10 --sessions-per-level 20
+
+The corpus is a JSON-lines file with one conversation per line
+({"id": ..., "turns": ["question", ...]}). A plain text file with one
+question per line also works; its questions are grouped into conversations
+of --turns questions.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import websockets
+
+import ws_mock_server
+
+DEFAULT_CORPUS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "corpus", "nsf_questions.jsonl"
+)
+
+
+def load_corpus(path: str, turns: int) -> List[List[str]]:
+    """Returns the conversations in the corpus as lists of questions."""
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if path.endswith(".jsonl"):
+        conversations = [json.loads(line)["turns"] for line in lines]
+    else:
+        conversations = [lines[i : i + turns] for i in range(0, len(lines), turns)]
+    return [c[:turns] for c in conversations if c]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def ask(websocket, question: str, timeout: float) -> Dict[str, Optional[float]]:
+    """Sends one question and reads the streamed answer; returns its timings and outcome."""
+    start = time.perf_counter()
+    await websocket.send(json.dumps({"message": question}))
+    first_frame_at = None
+    frames = 0
+    deadline = start + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise asyncio.TimeoutError
+        frame = await asyncio.wait_for(websocket.recv(), remaining)
+        now = time.perf_counter()
+        if frame == ws_mock_server.ERROR_MESSAGE:
+            return {"error": "error_message", "ttft_ms": None, "total_ms": (now - start) * 1000}
+        if frame == ws_mock_server.END_MARKER:
+            return {
+                "error": None,
+                "ttft_ms": ((first_frame_at or now) - start) * 1000,
+                "total_ms": (now - start) * 1000,
+                "frames": frames,
+            }
+        if first_frame_at is None:
+            first_frame_at = now
+        frames += 1
+
+
+async def run_session(url: str, questions: List[str], args, results: List[dict]) -> None:
+    """Runs one conversation on its own connection, appending a result per turn."""
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=args.timeout) as websocket:
+            connect_ms = (time.perf_counter() - start) * 1000
+            for turn, question in enumerate(questions):
+                try:
+                    result = await ask(websocket, question, args.timeout)
+                except asyncio.TimeoutError:
+                    result = {"error": "timeout", "ttft_ms": None, "total_ms": None}
+                    # The rest of a timed-out answer would be read as the next one
+                    results.append(dict(result, turn=turn, connect_ms=connect_ms))
+                    return
+                results.append(dict(result, turn=turn, connect_ms=connect_ms))
+                if args.think_time_ms:
+                    await asyncio.sleep(args.think_time_ms / 1000)
+    except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+        error = "connection_closed" if isinstance(e, websockets.exceptions.ConnectionClosed) else "connect_failed"
+        results.append({"error": error, "ttft_ms": None, "total_ms": None, "turn": None, "connect_ms": None})
+
+
+async def run_level(url: str, conversations: List[List[str]], concurrency: int, args) -> dict:
+    """Runs sessions_per_level conversations with at most `concurrency` open at once."""
+    sessions = args.sessions_per_level or concurrency * 2
+    source = itertools.cycle(conversations)
+    queue = [next(source) for _ in range(sessions)]
+    results: List[dict] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(questions):
+        async with semaphore:
+            await run_session(url, questions, args, results)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(q) for q in queue))
+    elapsed = time.perf_counter() - start
+
+    # A session that fails to connect counts as one failed turn
+    turns = results
+    ok = [r for r in turns if r["error"] is None]
+    errors = Counter(r["error"] for r in turns if r["error"])
+    ttft = [r["ttft_ms"] for r in ok]
+    total = [r["total_ms"] for r in ok]
+    connect = [r["connect_ms"] for r in turns if r.get("connect_ms") is not None]
+    return {
+        "concurrency": concurrency,
+        "sessions": sessions,
+        "turns": len(turns),
+        "errors": dict(errors),
+        "error_rate": sum(errors.values()) / len(turns) if turns else 0.0,
+        "turns_per_second": len(ok) / elapsed if elapsed else 0.0,
+        "connect_p50_ms": percentile(connect, 50),
+        "ttft_p50_ms": percentile(ttft, 50),
+        "ttft_p90_ms": percentile(ttft, 90),
+        "ttft_p99_ms": percentile(ttft, 99),
+        "total_p50_ms": percentile(total, 50),
+        "total_p90_ms": percentile(total, 90),
+        "total_p99_ms": percentile(total, 99),
+    }
+
+
+async def main_async(args) -> List[dict]:
+    conversations = load_corpus(args.corpus, args.turns)
+    if not conversations:
+        raise SystemExit(f"{args.corpus} has no questions")
+
+    server = None
+    url = args.url
+    if args.mock:
+        backend = ws_mock_server.MockBackend(
+            args.mock_first_token_ms, args.mock_token_interval_ms, args.mock_tokens, args.mock_error_rate
+        )
+        server = await ws_mock_server.serve(backend, "127.0.0.1", 0)
+        url = ws_mock_server.server_url(server)
+    try:
+        if not args.json:
+            print_header()
+        levels = []
+        for concurrency in args.concurrency:
+            levels.append(await run_level(url, conversations, concurrency, args))
+            if not args.json:
+                print_level(levels[-1])
+        return levels
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+
+def print_header() -> None:
+    print(
+        f"{'conc':>5} {'turns':>6} {'err %':>6} {'turns/s':>8} {'TTFT p50':>9} {'p90':>7} {'p99':>7}"
+        f" {'total p50':>10} {'p90':>7} {'p99':>7}  errors"
+    )
+
+
+def print_level(r: dict) -> None:
+    print(
+        f"{r['concurrency']:>5} {r['turns']:>6} {r['error_rate'] * 100:>6.1f} {r['turns_per_second']:>8.1f}"
+        f" {r['ttft_p50_ms']:>7.0f}ms {r['ttft_p90_ms']:>5.0f}ms {r['ttft_p99_ms']:>5.0f}ms"
+        f" {r['total_p50_ms']:>8.0f}ms {r['total_p90_ms']:>5.0f}ms {r['total_p99_ms']:>5.0f}ms"
+        f"  {', '.join(f'{k}={v}' for k, v in sorted(r['errors'].items())) or '-'}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="wss:// URL of the deployed WebSocketAPI stage")
+    target.add_argument("--mock", action="store_true", help="start ws_mock_server in-process and target it")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--sessions-per-level", type=int, help="conversations per level (default: 2 x concurrency)")
+    parser.add_argument("--turns", type=int, default=3, help="questions per conversation")
+    parser.add_argument("--think-time-ms", type=float, default=0, help="pause between an answer and the next question")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a complete answer")
+    parser.add_argument("--mock-first-token-ms", type=float, default=400)
+    parser.add_argument("--mock-token-interval-ms", type=float, default=15)
+    parser.add_argument("--mock-tokens", type=int, default=200)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    levels = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(levels, indent=2))
+    return 1 if any(level["turns"] == 0 for level in levels) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
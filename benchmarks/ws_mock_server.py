@@ -0,0 +1,110 @@
+"""
+A local stand-in for the deployed WebSocketAPI, for exercising ws_loadgen.py
+without AWS. It speaks the same protocol as the $default route:
+
+- the client sends {"message": "<question>"}
+- the answer arrives as one text frame per model token, then a "[[END]]" frame
+- a failed turn gets the state machine's error message and no "[[END]]"
+
+Token cadence, first-token delay and failure rate are configurable, so the
+load generator's reporting can be checked against known numbers.
+
+    python ws_mock_server.py --port 8765 --first-token-ms 400 --tokens 200
+"""
+
+import argparse
+import asyncio
+import json
+import random
+
+import websockets
+
+END_MARKER = "[[END]]"
+ERROR_MESSAGE = "**There was an error, please try again later.**"
+
+
+class MockBackend:
+    """
+    Answers each question by streaming synthetic tokens.
+    - first_token_ms: Delay between receiving a question and the first frame.
+    - token_interval_ms: Delay between frames.
+    - tokens: Number of token frames per answer.
+    - error_rate: Fraction of turns answered with the error message instead.
+    - seed: Seed for the error draws, so runs are repeatable.
+    """
+
+    def __init__(
+        self,
+        first_token_ms: float = 400,
+        token_interval_ms: float = 15,
+        tokens: int = 200,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.first_token_ms = first_token_ms
+        self.token_interval_ms = token_interval_ms
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.connections = 0
+        self.questions = 0
+
+    async def answer(self, websocket, question: str) -> None:
+        await asyncio.sleep(self.first_token_ms / 1000)
+        if self.random.random() < self.error_rate:
+            await websocket.send(ERROR_MESSAGE)
+            return
+        words = question.split() or ["answer"]
+        for i in range(self.tokens):
+            if i:
+                await asyncio.sleep(self.token_interval_ms / 1000)
+            await websocket.send(words[i % len(words)] + " ")
+        await websocket.send(END_MARKER)
+
+    async def handle(self, websocket, path=None) -> None:
+        # Older websockets releases pass the request path as a second argument
+        self.connections += 1
+        async for raw in websocket:
+            self.questions += 1
+            try:
+                question = json.loads(raw)["message"]
+            except (ValueError, KeyError, TypeError):
+                # The integration's request template would produce an invalid
+                # state machine input, which ends in the error message
+                await websocket.send(ERROR_MESSAGE)
+                continue
+            # Like the deployed API, a new question does not wait for the previous answer
+            asyncio.ensure_future(self.answer(websocket, question))
+
+
+async def serve(backend: MockBackend, host: str, port: int):
+    """Starts the mock server and returns it; port 0 picks a free port."""
+    return await websockets.serve(backend.handle, host, port, max_size=None)
+
+
+def server_url(server) -> str:
+    host, port = list(server.sockets)[0].getsockname()[:2]
+    return f"ws://{host}:{port}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-token-ms", type=float, default=400)
+    parser.add_argument("--token-interval-ms", type=float, default=15)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    backend = MockBackend(args.first_token_ms, args.token_interval_ms, args.tokens, args.error_rate)
+    server = await serve(backend, args.host, args.port)
+    print(f"mock WebSocketAPI listening on {server_url(server)}")
+    await asyncio.Future()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
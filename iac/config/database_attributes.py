@@ -0,0 +1,13 @@
+from typing import TypedDict
+
+from aws_cdk import aws_ec2 as ec2, aws_lambda
+
+
+class DatabaseAttributes(TypedDict):
+    reader_endpoint: str
+    database_name: str
+    secret_name: str
+    secret_arn: str
+    client_security_group: ec2.ISecurityGroup
+    client_layer: aws_lambda.ILayerVersion
+    vpc: ec2.IVpc
@@ -0,0 +1,7 @@
+from typing import TypedDict
+
+
+class DomainAttributes(TypedDict):
+    domain_name: str
+    hosted_zone_id: str
+    hosted_zone_name: str
@@ -1,3 +1,5 @@
+from typing import Sequence
+
 import aws_cdk
 from aws_cdk import (
     aws_dynamodb as dynamodb,
@@ -5,6 +7,11 @@ from aws_cdk import (
 from constructs import Construct
 
 
+def context_table_name(application_ci: str) -> str:
+    # The same in every region, so a replica is found by name
+    return f"{application_ci}-context"
+
+
 class ContextStack(aws_cdk.Stack):
 
     def __init__(
@@ -13,6 +20,7 @@ class ContextStack(aws_cdk.Stack):
         construct_id: str,
         env: aws_cdk.Environment,
         application_ci: str,
+        replica_regions: Sequence[str] = (),
         **kwargs,
     ) -> None:
 
@@ -21,14 +29,18 @@ class ContextStack(aws_cdk.Stack):
         table = dynamodb.TableV2(
             self,
             "context_table",
-            table_name=f"{application_ci}-context",
+            table_name=context_table_name(application_ci),
             billing=dynamodb.Billing.on_demand(),
             removal_policy=aws_cdk.RemovalPolicy.DESTROY,
             partition_key=dynamodb.Attribute(
                 name="PK", type=dynamodb.AttributeType.STRING
             ),
             sort_key=dynamodb.Attribute(name="SK", type=dynamodb.AttributeType.NUMBER),
+            # Written by the "Update history" state so idle sessions age out
+            time_to_live_attribute="expires_at",
             # stream=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES,  # is this obsolete?
+            # A global table: every region reads and writes its own replica
+            replicas=[dynamodb.ReplicaTableProps(region=region) for region in replica_regions],
         )
 
         self.contexttable_table_name = table.table_name
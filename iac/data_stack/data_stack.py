@@ -1,9 +1,14 @@
+from typing import Optional, Sequence
+
 import aws_cdk
+from aws_cdk import aws_iam as iam
 from aws_cdk import aws_s3 as s3
 from aws_cdk import aws_s3_deployment
 
 from constructs import Construct
 
+from config.bucket_attributes import BucketAttributes
+
 
 class DataStack(aws_cdk.Stack):
 
@@ -12,15 +17,19 @@ class DataStack(aws_cdk.Stack):
         scope: Construct,
         construct_id: str,
         env: aws_cdk.Environment,
+        bucket: Optional[BucketAttributes] = None,
+        replica_buckets: Sequence[BucketAttributes] = (),
         **kwargs,
     ) -> None:
 
         super().__init__(scope, construct_id, env=env, **kwargs)
 
+        # Buckets that replicate need names known in the other regions
+        bucket_name = bucket["bucket_name"] if bucket else self.stack_name.lower()
         self.data_bucket = s3.Bucket(
             self,
             "data_bucket",
-            bucket_name=self.stack_name.lower(),
+            bucket_name=bucket_name,
             access_control=s3.BucketAccessControl.BUCKET_OWNER_FULL_CONTROL,
             encryption=s3.BucketEncryption.S3_MANAGED,
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
@@ -37,3 +46,55 @@ class DataStack(aws_cdk.Stack):
             destination_bucket=self.data_bucket,
             destination_key_prefix="",
         )
+
+        if replica_buckets:
+            # Objects added here are copied to the buckets of the other regions, whose
+            # knowledge bases then read a local copy. Versioning, which replication needs, is
+            # on for every data bucket.
+            replication_role = iam.Role(
+                self,
+                "ReplicationRole",
+                assumed_by=iam.ServicePrincipal("s3.amazonaws.com"),
+            )
+            replication_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["s3:GetReplicationConfiguration", "s3:ListBucket"],
+                    resources=[f"arn:aws:s3:::{bucket_name}"],
+                )
+            )
+            replication_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        "s3:GetObjectVersionForReplication",
+                        "s3:GetObjectVersionAcl",
+                        "s3:GetObjectVersionTagging",
+                    ],
+                    resources=[f"arn:aws:s3:::{bucket_name}/*"],
+                )
+            )
+            replication_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["s3:ReplicateObject", "s3:ReplicateDelete", "s3:ReplicateTags"],
+                    resources=[f"arn:aws:s3:::{r['bucket_name']}/*" for r in replica_buckets],
+                )
+            )
+            # The CDK version in use has no replication rules on the Bucket construct
+            cfn_bucket: s3.CfnBucket = self.data_bucket.node.default_child
+            cfn_bucket.replication_configuration = s3.CfnBucket.ReplicationConfigurationProperty(
+                role=replication_role.role_arn,
+                rules=[
+                    s3.CfnBucket.ReplicationRuleProperty(
+                        id=replica["id"],
+                        status="Enabled",
+                        priority=priority,
+                        filter=s3.CfnBucket.ReplicationRuleFilterProperty(prefix=""),
+                        delete_marker_replication=s3.CfnBucket.DeleteMarkerReplicationProperty(
+                            status="Enabled"
+                        ),
+                        destination=s3.CfnBucket.ReplicationDestinationProperty(
+                            bucket=f"arn:aws:s3:::{replica['bucket_name']}"
+                        ),
+                    )
+                    for priority, replica in enumerate(replica_buckets)
+                ],
+            )
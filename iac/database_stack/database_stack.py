@@ -16,6 +16,8 @@ from aws_cdk import (
 
 from constructs import Construct
 
+from config.database_attributes import DatabaseAttributes
+
 
 class DatabaseStack(aws_cdk.Stack):
 
@@ -26,6 +28,9 @@ class DatabaseStack(aws_cdk.Stack):
         env: aws_cdk.Environment,
         data_bucket: s3.Bucket,
         application_ci: str,
+        prime_on_init: bool = True,
+        snap_start: bool = False,
+        dependencies_layer: bool = False,
         **kwargs,
     ) -> None:
 
@@ -127,12 +132,18 @@ class DatabaseStack(aws_cdk.Stack):
             enable_data_api=True,
         )
         self.database_cluster_arn = database.cluster_arn
+        self.database_reader_endpoint = database.cluster_read_endpoint.hostname
         # TODO: handle this better
         temp_build_root = "/tmp/build"
         python_runtime_version = "python3.12"
         src_home = "../src/lambda_loader"
         src_root = "../src"
         command = f"../scripts/build_lambda.sh {temp_build_root} {python_runtime_version.replace('python','')} {application_ci} {src_home} {src_root}"
+        # Builds are cached by content, see the script for the options. The cold import time of
+        # the handler module is part of the report.
+        command += " --import-check lambda_loader.lambda_loader"
+        if dependencies_layer:
+            command += " --layer"
         try:
             process = subprocess.Popen(
                 command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
@@ -140,7 +151,12 @@ class DatabaseStack(aws_cdk.Stack):
             stdout, stderr = process.communicate()
 
             if process.returncode == 0:
-                self.built_archive = stdout.decode("utf-8").replace("\n", "")
+                # The package, then the dependencies layer if one was requested
+                archives = stdout.decode("utf-8").split()
+                self.built_archive = archives[0]
+                self.built_layer_archive = archives[1] if dependencies_layer else None
+                # The size report
+                sys.stderr.write(stderr.decode("utf-8"))
             else:
                 raise RuntimeError(stderr.decode("utf-8"))
 
@@ -162,6 +178,8 @@ class DatabaseStack(aws_cdk.Stack):
                 "AURORA_SECRET_NAME": secret_db_creds.secret_name,
                 "DATA_FILE": "chinook.sql",
                 "VECTOR_CONFIG_FILE": "vector.sql",
+                # Fetches the credentials and connects during init, see lambda_loader.py
+                "PRIME_ON_INIT": "true" if prime_on_init else "false",
             },
             vpc=vpc,
             vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PUBLIC),
@@ -169,6 +187,36 @@ class DatabaseStack(aws_cdk.Stack):
             security_groups=[serverless_security_group],
         )
 
+        # What other stacks need to query the database, for example analytic questions in
+        # InferenceStack. The layer carries the loader's dependencies, including psycopg2.
+        self.database_attributes = None
+        if self.built_layer_archive:
+            client_layer = aws_lambda.LayerVersion(
+                self,
+                "rds_data_loader_dependencies",
+                code=aws_lambda.Code.from_asset(self.built_layer_archive),
+                compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_12],
+                compatible_architectures=[aws_lambda.Architecture.X86_64],
+            )
+            lambda_s3_function.add_layers(client_layer)
+            self.database_attributes = DatabaseAttributes(
+                reader_endpoint=self.database_reader_endpoint,
+                database_name=self.database_name,
+                secret_name=secret_db_creds.secret_name,
+                secret_arn=secret_db_creds.secret_arn,
+                client_security_group=serverless_security_group,
+                client_layer=client_layer,
+                vpc=vpc,
+            )
+
+        # The trigger invokes the function's current version, so SnapStart applies to it.
+        # Provisioned concurrency is not offered: the loader runs once per deployment.
+        if snap_start:
+            # The CDK version in use rejects snap_start for Python runtimes, which Lambda supports
+            lambda_s3_function.node.default_child.add_property_override(
+                "SnapStart", {"ApplyOn": "PublishedVersions"}
+            )
+
         ### the below permissions are essential
         data_bucket.grant_read(lambda_s3_function.role)
         secret_db_creds.grant_read(lambda_s3_function)
@@ -182,7 +230,9 @@ class DatabaseStack(aws_cdk.Stack):
 
         # Clean up the .zip archive build
         try:
-            shutil.rmtree(temp_build_root)
+            # A cached build never creates the build root
+            if os.path.exists(temp_build_root):
+                shutil.rmtree(temp_build_root)
         except OSError as e:
             error = f"Error deleting temporary build directory {temp_build_root}: {e}"
             print(error)
@@ -6,11 +6,22 @@ from aws_cdk import (
     aws_lambda,
     aws_logs as logs,
     aws_apigatewayv2 as apigwv2,
+    aws_certificatemanager as acm,
+    aws_route53 as route53,
     aws_stepfunctions as sfn,
 )
 
 from constructs import Construct
 import os
+import shutil
+import subprocess
+import sys
+from typing import Optional, Sequence
+
+from config.database_attributes import DatabaseAttributes
+from config.domain_attributes import DomainAttributes
+
+DEPLOYMENT_MODES = ("state_machine", "direct")
 
 
 class InferenceStack(aws_cdk.Stack):
@@ -27,11 +38,63 @@ class InferenceStack(aws_cdk.Stack):
         bedrock_model_version: str,
         contexttable_table_name: str,
         contexttable_table_arn: str,
+        history_limit: int = 5,
+        history_ttl: aws_cdk.Duration = aws_cdk.Duration.days(7),
+        compaction_token_threshold: int = 6000,
+        deployment_mode: str = "state_machine",
+        retrieval_fetch_results: int = 20,
+        retrieval_results: int = 10,
+        retrieval_min_results: int = 4,
+        retrieval_relative_score: float = 0.4,
+        retrieval_score_gap: float = 0.15,
+        # On the knowledge base's score scale, so it is off until calibrated with
+        # benchmarks/bench_retrieval.py --backend knowledge-base --adaptive
+        retrieval_score_floor: float = 0.0,
+        # The same scale: below it the fast tier is not trusted with a question; 0 turns it off
+        routing_min_fast_top_score: float = 0.0,
+        context_compression_ratio: float = 0.35,
+        debug_sample_rate: float = 0.01,
+        fast_model_id: Optional[str] = None,
+        escalation_probe_chars: int = 40,
+        request_coalescing: bool = False,
+        prime_on_init: bool = True,
+        snap_start: bool = False,
+        provisioned_concurrency: int = 0,
+        analytics_database: Optional[DatabaseAttributes] = None,
+        analytics_subnet_ids: Sequence[str] = (),
+        analytics_statement_timeout: aws_cdk.Duration = aws_cdk.Duration.seconds(5),
+        analytics_max_rows: int = 500,
+        analytics_max_query_cost: int = 1_000_000,
+        analytics_small_query_cost: int = 10_000,
+        analytics_small_query_timeout: aws_cdk.Duration = aws_cdk.Duration.seconds(1),
+        websocket_domain: Optional[DomainAttributes] = None,
         **kwargs,
     ) -> None:
 
         super().__init__(scope, construct_id, env=env, **kwargs)
 
+        # "state_machine": route -> Express state machine -> history, inference, history update
+        # "direct": route -> inference function, which also reads and writes history
+        if deployment_mode not in DEPLOYMENT_MODES:
+            raise ValueError(
+                f"Unknown deployment mode {deployment_mode}, expected one of {DEPLOYMENT_MODES}"
+            )
+        # Lambda does not allow both on one function version
+        if snap_start and provisioned_concurrency:
+            raise ValueError("SnapStart and provisioned concurrency cannot be combined")
+        if not retrieval_min_results <= retrieval_results < retrieval_fetch_results:
+            raise ValueError(
+                "Expected retrieval_min_results <= retrieval_results < retrieval_fetch_results"
+            )
+        # The database is only reachable from inside its VPC, while the function must still post
+        # to the public API Gateway Management API, which no VPC endpoint serves for a public
+        # API. Only subnets with a NAT gateway give both; the default VPC has none.
+        if analytics_database and not analytics_subnet_ids:
+            raise ValueError(
+                "Analytic questions need analytics_subnet_ids: private subnets of the database's "
+                "VPC that route to the internet through a NAT gateway"
+            )
+
         vpc = ec2.Vpc.from_lookup(
             self,
             "Vpc",
@@ -72,12 +135,6 @@ class InferenceStack(aws_cdk.Stack):
             removal_policy=aws_cdk.RemovalPolicy.DESTROY,
         )
 
-        step_function_execution_role = iam.Role(
-            self,
-            "StepFunctionExecutionRole",
-            assumed_by=iam.ServicePrincipal("apigateway.amazonaws.com"),
-        )
-
         websocket_api_log_group = logs.LogGroup(
             self,
             "WebSocketAPILogGroup",
@@ -92,6 +149,13 @@ class InferenceStack(aws_cdk.Stack):
             removal_policy=aws_cdk.RemovalPolicy.DESTROY,
         )
 
+        compaction_function_log_group = logs.LogGroup(
+            self,
+            "CompactionFunctionLogGroup",
+            log_group_name=f"/applications/{application_ci}/{application_ci}-compaction-function",
+            removal_policy=aws_cdk.RemovalPolicy.DESTROY,
+        )
+
         websocket_api_gateway = apigwv2.CfnApi(
             self,
             "WebSocketAPI",
@@ -100,86 +164,46 @@ class InferenceStack(aws_cdk.Stack):
             route_selection_expression="$request.body.action",
         )
 
-        api_endpoint_prefix = f"arn:aws:execute-api:{env.region}:{env.account}:{websocket_api_gateway.attr_api_id}/{websocket_api_gateway.name}/POST/@connections/"
-        api_endpoint_arn = api_endpoint_prefix + "{connectionId}"
-
-        # TODO: Need the stateMachineArn here. Situation is state machine needs the API Gateway,
-        # and the API Gateway needs the state machine...
-        request_template = {
-            "$default": """#set($sfn_input=$util.escapeJavaScript($input.body).replaceAll("\\'","'")) {
-        "input": "{\\"data\\":$sfn_input, \\"timestamp\\":\\"$context.requestTimeEpoch\\", \\"ConnectionID\\":\\"$context.connectionId\\"}",
-        "stateMachineArn": "arn"   
-        }"""
-        }
+        # A plain string rather than the stage's attribute, so that the functions and state
+        # machine do not depend on the stage (which depends on the integration that needs them)
+        websocket_api_stage_name = f"{application_ci}-websocket-api"
 
-        websocket_api_gateway_default_integration = apigwv2.CfnIntegration(
-            self,
-            "WebSocketAPIGatewayIntegration",
-            api_id=websocket_api_gateway.attr_api_id,
-            integration_type="AWS",
-            integration_method="POST",
-            integration_uri=f"arn:aws:apigateway:{env.region}:states:action/StartExecution",
-            credentials_arn=step_function_execution_role.role_arn,
-            template_selection_expression="\\$default",
-            request_templates=request_template,
-        )
-
-        websocket_api_gateway_default_route = apigwv2.CfnRoute(
-            self,
-            "WebSocketAPIDefaultRoute",
-            api_id=websocket_api_gateway.attr_api_id,
-            route_key="$default",
-            authorization_type="NONE",
-            target=f"integrations/{websocket_api_gateway_default_integration.ref}",  # TODO: fix this
-        )
-
-        websocket_api_gateway_default_route.node.add_dependency(
-            websocket_api_gateway_default_integration
-        )
-
-        websocket_api_gateway_deployment = apigwv2.CfnDeployment(
-            self, "WebSocketAPIDeployment", api_id=websocket_api_gateway.attr_api_id
-        )
-        websocket_api_gateway_deployment.node.add_dependency(
-            websocket_api_gateway_default_route
-        )
-
-        websocket_api_gateway_stage = apigwv2.CfnStage(
-            self,
-            "WebSocketAPIStage",
-            stage_name=f"{application_ci}-websocket-api",
-            deployment_id=websocket_api_gateway_deployment.attr_deployment_id,
-            api_id=websocket_api_gateway.attr_api_id,
-            default_route_settings=apigwv2.CfnStage.RouteSettingsProperty(
-                data_trace_enabled=False,
-                detailed_metrics_enabled=True,
-                logging_level="ERROR",
-            ),
-            access_log_settings=apigwv2.CfnStage.AccessLogSettingsProperty(
-                destination_arn=websocket_api_log_group.log_group_arn,
-                format="$context.status $context.responseLength $context.requestId $context.error.messageString",
-            ),
-        )
-
-        websocket_api_gateway_route_response = apigwv2.CfnRouteResponse(
-            self,
-            "WebSocketAPIGatewayDfltRtRsp",
-            api_id=websocket_api_gateway.attr_api_id,
-            route_id=websocket_api_gateway_default_route.attr_route_id,
-            route_response_key="$default",
-        )
+        api_endpoint_prefix = f"arn:aws:execute-api:{env.region}:{env.account}:{websocket_api_gateway.attr_api_id}/{websocket_api_stage_name}/POST/@connections/"
+        api_endpoint_arn = api_endpoint_prefix + "{connectionId}"
 
-        websocket_api_gateway_integration_response = apigwv2.CfnIntegrationResponse(
-            self,
-            "WebSocketAPIGatewayIntgrRsp",
-            api_id=websocket_api_gateway.attr_api_id,
-            integration_id=websocket_api_gateway_default_integration.ref,  # TODO fix
-            integration_response_key="$default",
-        )
+        # bedrock_model_id is the strong tier. Without a fast tier every request goes to it.
+        model_tier_ids = {"fast": fast_model_id or bedrock_model_id, "strong": bedrock_model_id}
+
+        # Analytic questions query the database from inside its VPC, in the given NAT subnets.
+        # Bedrock, DynamoDB, Secrets Manager and API Gateway are all reached through the NAT.
+        analytics_network = {}
+        if analytics_database:
+            analytics_network = dict(
+                vpc=analytics_database["vpc"],
+                vpc_subnets=ec2.SubnetSelection(
+                    subnets=[
+                        ec2.Subnet.from_subnet_id(self, f"AnalyticsSubnet{i}", subnet_id)
+                        for i, subnet_id in enumerate(analytics_subnet_ids)
+                    ]
+                ),
+                security_groups=[analytics_database["client_security_group"]],
+            )
 
-        websocket_api_gateway_integration_response.node.add_dependency(
-            websocket_api_gateway_default_integration
-        )
+        # Flat sources with precompiled bytecode, see build_lambda.sh. The dependencies come from
+        # the Powertools layer and the runtime, so they are only installed, not packaged, to
+        # stand in for those while the cold import time of the handler module is measured.
+        temp_build_root = "/tmp/build_inference"
+        command = f"../scripts/build_lambda.sh {temp_build_root} 3.12 {application_ci}_inference ../src/bedrock_interface ../src --flat --no-deps --import-check bedrock_interface"
+        process = subprocess.run(command, shell=True, capture_output=True)
+        if process.returncode != 0:
+            raise RuntimeError(
+                f"Error creating the inference package. {process.stderr.decode('utf-8')}"
+            )
+        # The size and import report
+        sys.stderr.write(process.stderr.decode("utf-8"))
+        inference_archive = process.stdout.decode("utf-8").split()[0]
+        # A cached build never creates the build root
+        shutil.rmtree(temp_build_root, ignore_errors=True)
 
         lambda_inference_function = aws_lambda.Function(
             self,
@@ -188,14 +212,43 @@ class InferenceStack(aws_cdk.Stack):
             architecture=aws_lambda.Architecture.X86_64,
             handler="bedrock_interface.handler",
             timeout=aws_cdk.Duration.minutes(2),
-            code=aws_lambda.Code.from_asset("../src/bedrock_interface"),
+            code=aws_lambda.Code.from_asset(inference_archive),
             environment={
                 "ANTHROPIC_VERSION": bedrock_model_version,  # "bedrock-2023-05-31",
                 "BEDROCK_MODEL_ID": bedrock_model_id,  # "anthropic.claude-3-sonnet-20240229-v1:0",
+                "FAST_MODEL_ID": model_tier_ids["fast"],
+                "STRONG_MODEL_ID": model_tier_ids["strong"],
+                # Characters of a fast-tier answer held back to check it before streaming
+                "ROUTING_ESCALATION_PROBE_CHARS": str(escalation_probe_chars),
+                "ROUTING_MIN_FAST_TOP_SCORE": str(routing_min_fast_top_score),
                 "KNOWLEDGE_BASE_ID": knowledge_base_id,
                 "MAX_TOKENS": "8000",  #  Verify this
-                "API_GATEWAY_ENDPOINT_URL": f"https://{websocket_api_gateway.attr_api_id}.execute-api.{env.region}.amazonaws.com/{websocket_api_gateway_stage.stage_name}",
+                "API_GATEWAY_ENDPOINT_URL": f"https://{websocket_api_gateway.attr_api_id}.execute-api.{env.region}.amazonaws.com/{websocket_api_stage_name}",
+                "HISTORY_TTL_SECONDS": str(int(history_ttl.to_seconds())),
+                "DEPLOYMENT_MODE": deployment_mode,
+                # Fetches deeper than it keeps, and cuts the fetched results to those that stand
+                # out, see retrieval_depth.py
+                "RETRIEVAL_FETCH_RESULTS": str(retrieval_fetch_results),
+                "RETRIEVAL_RESULTS": str(retrieval_results),
+                "RETRIEVAL_MIN_RESULTS": str(retrieval_min_results),
+                "RETRIEVAL_RELATIVE_SCORE": str(retrieval_relative_score),
+                "RETRIEVAL_SCORE_GAP": str(retrieval_score_gap),
+                "RETRIEVAL_SCORE_FLOOR": str(retrieval_score_floor),
+                # Fraction of the retrieved text kept in the prompt, see context_compression.py;
+                # 1 sends the chunks whole
+                "CONTEXT_COMPRESSION_RATIO": str(context_compression_ratio),
+                "POWERTOOLS_SERVICE_NAME": f"{application_ci}-inference",
+                "POWERTOOLS_METRICS_NAMESPACE": application_ci,
+                # Fraction of invocations that log the (truncated) full response
+                "POWERTOOLS_LOGGER_SAMPLE_RATE": str(debug_sample_rate),
+                "DEBUG_RESPONSE_MAX_CHARS": "2000",
+                # Identical in-flight questions share one generation, see request_coalescing.py
+                "COALESCING_ENABLED": "true" if request_coalescing else "false",
+                "CONTEXT_TABLE_NAME": contexttable_table_name,
+                # Runs the clients' first-call work during init, see priming.py
+                "PRIME_ON_INIT": "true" if prime_on_init else "false",
             },
+            tracing=aws_lambda.Tracing.ACTIVE,
             log_group=inference_function_log_group,
             # TODO: Problems accessing a public API from a lambda in a VPC, even on a publci subnet.
             # See: https://repost.aws/knowledge-center/api-gateway-vpc-connections
@@ -204,8 +257,63 @@ class InferenceStack(aws_cdk.Stack):
             # vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PUBLIC),
             # allow_public_subnet=True,
             # security_groups=[serverless_security_group],
+            **analytics_network,
         )
 
+        if analytics_database:
+            # Queries go to the reader endpoint; the writer is left to the loader
+            lambda_inference_function.add_environment("ANALYTICS_ENABLED", "true")
+            lambda_inference_function.add_environment(
+                "ANALYTICS_READER_HOST", analytics_database["reader_endpoint"]
+            )
+            lambda_inference_function.add_environment(
+                "ANALYTICS_DATABASE_NAME", analytics_database["database_name"]
+            )
+            lambda_inference_function.add_environment(
+                "ANALYTICS_SECRET_NAME", analytics_database["secret_name"]
+            )
+            lambda_inference_function.add_environment(
+                "ANALYTICS_STATEMENT_TIMEOUT_MS",
+                str(int(analytics_statement_timeout.to_milliseconds())),
+            )
+            lambda_inference_function.add_environment("ANALYTICS_MAX_ROWS", str(analytics_max_rows))
+            # Planner cost budgets, see query_guard.py: queries over the maximum are refused, and
+            # small ones get the shorter timeout
+            lambda_inference_function.add_environment(
+                "ANALYTICS_MAX_QUERY_COST", str(analytics_max_query_cost)
+            )
+            lambda_inference_function.add_environment(
+                "ANALYTICS_SMALL_QUERY_COST", str(analytics_small_query_cost)
+            )
+            lambda_inference_function.add_environment(
+                "ANALYTICS_SMALL_QUERY_TIMEOUT_MS",
+                str(int(analytics_small_query_timeout.to_milliseconds())),
+            )
+            # Ahead of the Powertools layer, so that its files win where the two overlap
+            lambda_inference_function.add_layers(analytics_database["client_layer"])
+            lambda_inference_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "AnalyticsDatabasePolicy",
+                    document=iam.PolicyDocument(
+                        statements=[
+                            iam.PolicyStatement(
+                                actions=["secretsmanager:GetSecretValue"],
+                                resources=[analytics_database["secret_arn"]],
+                                effect=iam.Effect.ALLOW,
+                            ),
+                            # The schema catalog and query results shared between instances,
+                            # see schema_catalog.py and result_cache.py
+                            iam.PolicyStatement(
+                                actions=["dynamodb:GetItem", "dynamodb:PutItem"],
+                                resources=[contexttable_table_arn],
+                                effect=iam.Effect.ALLOW,
+                            ),
+                        ],
+                    ),
+                )
+            )
+
         lambda_inference_function.role.attach_inline_policy(
             iam.Policy(
                 self,
@@ -223,7 +331,8 @@ class InferenceStack(aws_cdk.Stack):
                                 "bedrock:InvokeModelWithResponseStream",
                             ],
                             resources=[
-                                f"arn:aws:bedrock:{env.region}::foundation-model/{bedrock_model_id}"
+                                f"arn:aws:bedrock:{env.region}::foundation-model/{model_id}"
+                                for model_id in sorted(set(model_tier_ids.values()))
                             ],
                             effect=iam.Effect.ALLOW,
                         ),
@@ -238,106 +347,410 @@ class InferenceStack(aws_cdk.Stack):
                 ),
             )
         )
-        lambda_inference_function.add_layers(
-            aws_lambda.LayerVersion.from_layer_version_arn(
-                self,
-                "awsLambdaPowerTools",
-                f"arn:aws:lambda:{env.region}:017000801446:layer:AWSLambdaPowertoolsPythonV3-python312-x86_64:11",
+        if request_coalescing:
+            lambda_inference_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "RequestCoalescingPolicy",
+                    document=iam.PolicyDocument(
+                        statements=[
+                            iam.PolicyStatement(
+                                actions=[
+                                    "dynamodb:UpdateItem",
+                                    "dynamodb:GetItem",
+                                    "dynamodb:PutItem",
+                                    "dynamodb:Query",
+                                ],
+                                resources=[contexttable_table_arn],
+                                effect=iam.Effect.ALLOW,
+                            ),
+                        ],
+                    ),
+                )
             )
+
+        powertools_layer = aws_lambda.LayerVersion.from_layer_version_arn(
+            self,
+            "awsLambdaPowerTools",
+            f"arn:aws:lambda:{env.region}:017000801446:layer:AWSLambdaPowertoolsPythonV3-python312-x86_64:11",
         )
+        lambda_inference_function.add_layers(powertools_layer)
+
+        if snap_start:
+            # The CDK version in use rejects snap_start for Python runtimes, which Lambda supports
+            lambda_inference_function.node.default_child.add_property_override(
+                "SnapStart", {"ApplyOn": "PublishedVersions"}
+            )
 
-        self.inference_function_name = lambda_inference_function.function_name
-        self.inference_function_arn = lambda_inference_function.function_arn
+        # SnapStart and provisioned concurrency only apply to published versions, so the
+        # WebSocket route and the state machine invoke an alias of the current version
+        inference_target = lambda_inference_function
+        if snap_start or provisioned_concurrency:
+            inference_target = aws_lambda.Alias(
+                self,
+                "InferenceFunctionAlias",
+                alias_name="live",
+                version=lambda_inference_function.current_version,
+                provisioned_concurrent_executions=provisioned_concurrency or None,
+            )
 
-        step_function = sfn.StateMachine(
+        self.inference_function_name = inference_target.function_name
+        self.inference_function_arn = inference_target.function_arn
+
+        # Folds older turns into a rolling summary, invoked asynchronously after each turn
+        lambda_compaction_function = aws_lambda.Function(
             self,
-            "WebSocketAPIStateMachine",
-            state_machine_type=sfn.StateMachineType.EXPRESS,
-            tracing_enabled=True,
-            logs=sfn.LogOptions(
-                destination=step_function_log_group, level=sfn.LogLevel.ALL
-            ),
-            definition_body=sfn.DefinitionBody.from_file(
-                path="./statemachine.asl.json"
-            ),
-            definition_substitutions={
-                "WSApi": f"{websocket_api_gateway.attr_api_id}.execute-api.{env.region}.amazonaws.com",
-                "WSApiStage": websocket_api_gateway_stage.stage_name,
-                "PromptFunction": self.inference_function_name,
-                "ContextTable": contexttable_table_name,
+            "compaction_function",
+            runtime=aws_lambda.Runtime.PYTHON_3_12,
+            architecture=aws_lambda.Architecture.X86_64,
+            handler="history_compaction.handler",
+            timeout=aws_cdk.Duration.minutes(2),
+            code=aws_lambda.Code.from_asset(inference_archive),
+            environment={
+                "ANTHROPIC_VERSION": bedrock_model_version,
+                "SUMMARY_MODEL_ID": bedrock_model_id,
+                "SUMMARY_MAX_TOKENS": "1000",
+                "CONTEXT_TABLE_NAME": contexttable_table_name,
+                "COMPACTION_TOKEN_THRESHOLD": str(compaction_token_threshold),
+                # The summary takes one slot of the history window
+                "COMPACTION_MAX_TURNS": str(history_limit - 1),
+                "COMPACTION_KEEP_TURNS": "2",
+                "HISTORY_TTL_SECONDS": str(int(history_ttl.to_seconds())),
+                # Only imported for its token estimate; this function is not traced
+                "POWERTOOLS_TRACE_DISABLED": "true",
             },
+            log_group=compaction_function_log_group,
+            # Token estimates come from telemetry.py, so that the budget matches the metrics
+            layers=[powertools_layer],
         )
 
-        step_function.role.attach_inline_policy(
+        lambda_compaction_function.role.attach_inline_policy(
             iam.Policy(
                 self,
-                "StepFunctionsDynamoDb",
-                statements=[
-                    iam.PolicyStatement(
-                        effect=iam.Effect.ALLOW,
-                        actions=[
-                            "dynamodb:GetItem",
-                            "dynamodb:DeleteItem",
-                            "dynamodb:PutItem",
-                            "dynamodb:Scan",
-                            "dynamodb:Query",
-                            "dynamodb:UpdateItem",
-                            "dynamodb:BatchWriteItem",
-                            "dynamodb:BatchGetItem",
-                            "dynamodb:DescribeTable",
-                            "dynamodb:ConditionCheckItem",
-                        ],
-                        resources=[
-                            contexttable_table_arn,
-                            f"{contexttable_table_arn}/index/*",
-                        ],
-                    ),
-                ],
+                "CompactionPolicy",
+                document=iam.PolicyDocument(
+                    statements=[
+                        iam.PolicyStatement(
+                            actions=[
+                                "dynamodb:Query",
+                                "dynamodb:PutItem",
+                                "dynamodb:BatchWriteItem",
+                            ],
+                            resources=[contexttable_table_arn],
+                            effect=iam.Effect.ALLOW,
+                        ),
+                        iam.PolicyStatement(
+                            actions=["bedrock:InvokeModel"],
+                            resources=[
+                                f"arn:aws:bedrock:{env.region}::foundation-model/{bedrock_model_id}"
+                            ],
+                            effect=iam.Effect.ALLOW,
+                        ),
+                    ],
+                ),
             )
         )
 
-        step_function.role.attach_inline_policy(
-            iam.Policy(
+        if deployment_mode == "state_machine":
+            step_function_execution_role = iam.Role(
                 self,
-                "StepFunctionsLambdaExecution",
-                statements=[
-                    iam.PolicyStatement(
-                        effect=iam.Effect.ALLOW,
-                        actions=["lambda:InvokeFunction"],
-                        resources=[f"{self.inference_function_arn}*"],
-                    )
-                ],
+                "StepFunctionExecutionRole",
+                assumed_by=iam.ServicePrincipal("apigateway.amazonaws.com"),
             )
-        )
 
-        step_function.role.attach_inline_policy(
-            iam.Policy(
+            step_function = sfn.StateMachine(
+                self,
+                "WebSocketAPIStateMachine",
+                state_machine_type=sfn.StateMachineType.EXPRESS,
+                tracing_enabled=True,
+                logs=sfn.LogOptions(
+                    destination=step_function_log_group, level=sfn.LogLevel.ALL
+                ),
+                definition_body=sfn.DefinitionBody.from_file(
+                    path="./statemachine.asl.json"
+                ),
+                definition_substitutions={
+                    "WSApi": f"{websocket_api_gateway.attr_api_id}.execute-api.{env.region}.amazonaws.com",
+                    "WSApiStage": websocket_api_stage_name,
+                    "PromptFunction": self.inference_function_name,
+                    "CompactionFunction": lambda_compaction_function.function_name,
+                    "ContextTable": contexttable_table_name,
+                    "HistoryLimit": str(history_limit),
+                    "KnowledgeBaseId": knowledge_base_id,
+                    "RetrievalResults": str(retrieval_fetch_results),
+                },
+            )
+
+            step_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "StepFunctionsDynamoDb",
+                    statements=[
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                "dynamodb:GetItem",
+                                "dynamodb:DeleteItem",
+                                "dynamodb:PutItem",
+                                "dynamodb:Scan",
+                                "dynamodb:Query",
+                                "dynamodb:UpdateItem",
+                                "dynamodb:BatchWriteItem",
+                                "dynamodb:BatchGetItem",
+                                "dynamodb:DescribeTable",
+                                "dynamodb:ConditionCheckItem",
+                            ],
+                            resources=[
+                                contexttable_table_arn,
+                                f"{contexttable_table_arn}/index/*",
+                            ],
+                        ),
+                    ],
+                )
+            )
+
+            step_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "StepFunctionsLambdaExecution",
+                    statements=[
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=["lambda:InvokeFunction"],
+                            resources=[
+                                f"{self.inference_function_arn}*",
+                                f"{lambda_compaction_function.function_arn}*",
+                            ],
+                        )
+                    ],
+                )
+            )
+
+            step_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "StepFunctionsKnowledgeBaseRetrieve",
+                    statements=[
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=["bedrock:Retrieve"],
+                            resources=[knowledge_base_arn],
+                        ),
+                    ],
+                )
+            )
+
+            step_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "StepFunctionsApiManageConnections",
+                    statements=[
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=["execute-api:ManageConnections"],
+                            resources=[api_endpoint_arn],
+                        ),
+                    ],
+                )
+            )
+
+            step_function.role.add_managed_policy(
+                iam.ManagedPolicy.from_aws_managed_policy_name("AWSXrayWriteOnlyAccess")
+            )
+
+            step_function_execution_role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "StepFunctionsStateExecution",
+                    statements=[
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=["states:StartExecution"],
+                            resources=[step_function.state_machine_arn],
+                        ),
+                    ],
+                )
+            )
+
+            request_template = {
+                "$default": """#set($sfn_input=$util.escapeJavaScript($input.body).replaceAll("\\'","'")) {
+        "input": "{\\"data\\":$sfn_input, \\"timestamp\\":\\"$context.requestTimeEpoch\\", \\"ConnectionID\\":\\"$context.connectionId\\"}",
+        "stateMachineArn": "%s"
+        }"""
+                % step_function.state_machine_arn
+            }
+
+            websocket_api_gateway_default_integration = apigwv2.CfnIntegration(
                 self,
-                "StepFunctionsApiManageConnections",
-                statements=[
-                    iam.PolicyStatement(
-                        effect=iam.Effect.ALLOW,
-                        actions=["execute-api:ManageConnections"],
-                        resources=[api_endpoint_arn],
+                "WebSocketAPIGatewayIntegration",
+                api_id=websocket_api_gateway.attr_api_id,
+                integration_type="AWS",
+                integration_method="POST",
+                integration_uri=f"arn:aws:apigateway:{env.region}:states:action/StartExecution",
+                credentials_arn=step_function_execution_role.role_arn,
+                template_selection_expression="\\$default",
+                request_templates=request_template,
+            )
+        else:
+            # Fast path: the route invokes the inference function asynchronously, with the same
+            # event the state machine would pass it, and the function handles history itself
+            lambda_inference_function.add_environment("HISTORY_LIMIT", str(history_limit))
+            lambda_inference_function.add_environment(
+                "COMPACTION_FUNCTION_NAME", lambda_compaction_function.function_name
+            )
+            # A retried invocation would stream a second answer to the user
+            inference_target.configure_async_invoke(retry_attempts=0)
+
+            lambda_inference_function.role.attach_inline_policy(
+                iam.Policy(
+                    self,
+                    "DirectHistoryPolicy",
+                    document=iam.PolicyDocument(
+                        statements=[
+                            iam.PolicyStatement(
+                                actions=["dynamodb:Query", "dynamodb:PutItem"],
+                                resources=[contexttable_table_arn],
+                                effect=iam.Effect.ALLOW,
+                            ),
+                            iam.PolicyStatement(
+                                actions=["lambda:InvokeFunction"],
+                                resources=[lambda_compaction_function.function_arn],
+                                effect=iam.Effect.ALLOW,
+                            ),
+                        ],
                     ),
-                ],
+                )
+            )
+
+            inference_target.add_permission(
+                "WebSocketAPIInvoke",
+                principal=iam.ServicePrincipal("apigateway.amazonaws.com"),
+                source_arn=f"arn:aws:execute-api:{env.region}:{env.account}:{websocket_api_gateway.attr_api_id}/*",
+            )
+
+            request_template = {
+                "$default": """{"data": $input.body, "timestamp": "$context.requestTimeEpoch", "ConnectionID": "$context.connectionId"}"""
+            }
+
+            websocket_api_gateway_default_integration = apigwv2.CfnIntegration(
+                self,
+                "WebSocketAPIGatewayIntegration",
+                api_id=websocket_api_gateway.attr_api_id,
+                integration_type="AWS",
+                integration_method="POST",
+                integration_uri=f"arn:aws:apigateway:{env.region}:lambda:path/2015-03-31/functions/{inference_target.function_arn}/invocations",
+                template_selection_expression="\\$default",
+                request_templates=request_template,
+                # Return to API Gateway immediately; the answer is streamed over the connection
+                request_parameters={
+                    "integration.request.header.X-Amz-Invocation-Type": "'Event'"
+                },
             )
+
+        websocket_api_gateway_default_route = apigwv2.CfnRoute(
+            self,
+            "WebSocketAPIDefaultRoute",
+            api_id=websocket_api_gateway.attr_api_id,
+            route_key="$default",
+            authorization_type="NONE",
+            target=f"integrations/{websocket_api_gateway_default_integration.ref}",  # TODO: fix this
         )
 
-        step_function.role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("AWSXrayWriteOnlyAccess")
+        websocket_api_gateway_default_route.node.add_dependency(
+            websocket_api_gateway_default_integration
         )
 
-        step_function_execution_role.attach_inline_policy(
-            iam.Policy(
+        websocket_api_gateway_deployment = apigwv2.CfnDeployment(
+            self, "WebSocketAPIDeployment", api_id=websocket_api_gateway.attr_api_id
+        )
+        websocket_api_gateway_deployment.node.add_dependency(
+            websocket_api_gateway_default_route
+        )
+
+        websocket_api_gateway_stage = apigwv2.CfnStage(
+            self,
+            "WebSocketAPIStage",
+            stage_name=websocket_api_stage_name,
+            deployment_id=websocket_api_gateway_deployment.attr_deployment_id,
+            api_id=websocket_api_gateway.attr_api_id,
+            default_route_settings=apigwv2.CfnStage.RouteSettingsProperty(
+                data_trace_enabled=False,
+                detailed_metrics_enabled=True,
+                logging_level="ERROR",
+            ),
+            access_log_settings=apigwv2.CfnStage.AccessLogSettingsProperty(
+                destination_arn=websocket_api_log_group.log_group_arn,
+                format="$context.status $context.responseLength $context.requestId $context.error.messageString",
+            ),
+        )
+
+        if websocket_domain:
+            # Every region serves the same name; Route 53 answers each client with the region
+            # of lowest latency that is healthy
+            websocket_certificate = acm.Certificate(
                 self,
-                "StepFunctionsStateExecution",
-                statements=[
-                    iam.PolicyStatement(
-                        effect=iam.Effect.ALLOW,
-                        actions=["states:StartExecution"],
-                        resources=[step_function.state_machine_arn],
-                    ),
+                "WebSocketCertificate",
+                domain_name=websocket_domain["domain_name"],
+                validation=acm.CertificateValidation.from_dns(
+                    route53.HostedZone.from_hosted_zone_attributes(
+                        self,
+                        "WebSocketHostedZone",
+                        hosted_zone_id=websocket_domain["hosted_zone_id"],
+                        zone_name=websocket_domain["hosted_zone_name"],
+                    )
+                ),
+            )
+            websocket_domain_name = apigwv2.CfnDomainName(
+                self,
+                "WebSocketDomainName",
+                domain_name=websocket_domain["domain_name"],
+                domain_name_configurations=[
+                    apigwv2.CfnDomainName.DomainNameConfigurationProperty(
+                        certificate_arn=websocket_certificate.certificate_arn,
+                        endpoint_type="REGIONAL",
+                        security_policy="TLS_1_2",
+                    )
                 ],
             )
+            websocket_api_mapping = apigwv2.CfnApiMapping(
+                self,
+                "WebSocketApiMapping",
+                api_id=websocket_api_gateway.attr_api_id,
+                domain_name=websocket_domain_name.ref,
+                stage=websocket_api_stage_name,
+            )
+            websocket_api_mapping.node.add_dependency(websocket_api_gateway_stage)
+            route53.CfnRecordSet(
+                self,
+                "WebSocketLatencyRecord",
+                hosted_zone_id=websocket_domain["hosted_zone_id"],
+                name=websocket_domain["domain_name"],
+                type="A",
+                set_identifier=env.region,
+                region=env.region,
+                alias_target=route53.CfnRecordSet.AliasTargetProperty(
+                    dns_name=websocket_domain_name.attr_regional_domain_name,
+                    hosted_zone_id=websocket_domain_name.attr_regional_hosted_zone_id,
+                    evaluate_target_health=True,
+                ),
+            )
+
+        websocket_api_gateway_route_response = apigwv2.CfnRouteResponse(
+            self,
+            "WebSocketAPIGatewayDfltRtRsp",
+            api_id=websocket_api_gateway.attr_api_id,
+            route_id=websocket_api_gateway_default_route.attr_route_id,
+            route_response_key="$default",
+        )
+
+        websocket_api_gateway_integration_response = apigwv2.CfnIntegrationResponse(
+            self,
+            "WebSocketAPIGatewayIntgrRsp",
+            api_id=websocket_api_gateway.attr_api_id,
+            integration_id=websocket_api_gateway_default_integration.ref,  # TODO fix
+            integration_response_key="$default",
+        )
+
+        websocket_api_gateway_integration_response.node.add_dependency(
+            websocket_api_gateway_default_integration
         )
@@ -1,14 +1,15 @@
 import builtins
-from typing import List
+from typing import Optional, Sequence
 
 import aws_cdk
 
 from database_stack.database_stack import DatabaseStack
 from data_stack.data_stack import DataStack
 from knowledge_base_stack.knowledge_base_stack import KnowledgeBaseStack
-from context_stack.context_stack import ContextStack
+from context_stack.context_stack import ContextStack, context_table_name
 from inference_stack.inference_stack import InferenceStack
 from config.bucket_attributes import BucketAttributes
+from config.domain_attributes import DomainAttributes
 
 
 class RegionalStack(aws_cdk.Stack):
@@ -19,13 +20,65 @@ class RegionalStack(aws_cdk.Stack):
         env: aws_cdk.Environment,
         id: builtins.str,
         runtime_environment: builtins.str,
+        regions: Sequence[str] = (),
+        websocket_domain: Optional[DomainAttributes] = None,
         **kwargs,
     ):
 
         super().__init__(scope, id, **kwargs)
 
+        # Active-active: every region in `regions` runs the whole application against its own
+        # copy of the data and its own replica of the context table. The first region is the
+        # primary: it owns the global table and replicates its data bucket to the others.
+        regions = list(regions) or [env.region]
+        primary = env.region == regions[0]
+        bucket_base_name = f"{application_ci}-analytics"
+        buckets = {
+            region: BucketAttributes(
+                bucket_name=f"{bucket_base_name}-{region}",
+                region=region,
+                account=env.account,
+                id=f"{bucket_base_name}-{'primary' if region == regions[0] else 'secondary'}-{region}",
+            )
+            for region in regions
+        }
+
         # Stack 1 - data stack: S3 bucket with the data files loaded
-        data_stack = DataStack(self, "data", env=env)
+        self.data_stack = data_stack = DataStack(
+            self,
+            "data",
+            env=env,
+            # A single region keeps the bucket it always had
+            bucket=buckets[env.region] if len(regions) > 1 else None,
+            replica_buckets=[buckets[r] for r in regions[1:]] if primary else [],
+        )
+
+        # e.g. `cdk deploy -c inference_analytics=true -c analytics_subnet_ids=subnet-1,subnet-2`,
+        # private subnets with a NAT gateway in the database's VPC. With several regions, give
+        # each its own as `-c analytics_subnet_ids:<region>=...`.
+        analytics = str(self.node.try_get_context("inference_analytics")).lower() == "true"
+        analytics_subnet_ids = [
+            subnet_id.strip()
+            for subnet_id in str(
+                self.node.try_get_context(f"analytics_subnet_ids:{env.region}")
+                or self.node.try_get_context("analytics_subnet_ids")
+                or ""
+            ).split(",")
+            if subnet_id.strip()
+        ]
+
+        # e.g. `cdk deploy -c retrieval_score_floor=<score>`. Below it the best retrieved result is
+        # too weak to answer from, and the question gets no documents. Scores are on the
+        # knowledge base's scale, so calibrate the floor against it: bench_retrieval.py
+        # --backend knowledge-base --adaptive reports the best scores of the unanswerable
+        # questions and of those whose answer was found. The default of 0 turns the floor off.
+        retrieval_score_floor = float(self.node.try_get_context("retrieval_score_floor") or 0)
+        # e.g. `cdk deploy -c routing_min_fast_top_score=<score>`, on the same scale and calibrated
+        # the same way: questions whose best result scores lower go to the strong tier. The
+        # default of 0 leaves the decision to the other routing features.
+        routing_min_fast_top_score = float(
+            self.node.try_get_context("routing_min_fast_top_score") or 0
+        )
 
         # Stack 2 - database stack: Serverless Aurora Postgres + lambda to load data files from S3
         database_stack = DatabaseStack(
@@ -34,6 +87,12 @@ class RegionalStack(aws_cdk.Stack):
             env=env,
             data_bucket=data_stack.data_bucket,
             application_ci=application_ci,
+            # The layer carries psycopg2 for the inference function
+            dependencies_layer=analytics,
+            # e.g. `cdk deploy -c loader_snap_start=true`, or `-c loader_prime_on_init=false` to
+            # leave fetching the credentials and connecting to the first invocation
+            snap_start=str(self.node.try_get_context("loader_snap_start")).lower() == "true",
+            prime_on_init=str(self.node.try_get_context("loader_prime_on_init")).lower() != "false",
         )
 
         # Stack 3 - knowledge base stack
@@ -50,41 +109,64 @@ class RegionalStack(aws_cdk.Stack):
         )
 
         # Stack 4 - Context stack. May move this to app side.
-        context_stack = ContextStack(
-            self,
-            "context_stack",
-            env=env,
-            application_ci=application_ci,
-        )
+        # The primary creates the table with a replica in every other region; the others use
+        # their local replica, which has the same name.
+        self.context_stack = None
+        if primary:
+            self.context_stack = ContextStack(
+                self,
+                "context_stack",
+                env=env,
+                application_ci=application_ci,
+                replica_regions=regions[1:],
+            )
+            contexttable_table_name = self.context_stack.contexttable_table_name
+            contexttable_table_arn = self.context_stack.contexttable_table_arn
+        else:
+            contexttable_table_name = context_table_name(application_ci)
+            contexttable_table_arn = (
+                f"arn:aws:dynamodb:{env.region}:{env.account}:table/{contexttable_table_name}"
+            )
 
         bedrock_model_version = "bedrock-2023-05-31"
         bedrock_model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+        # Short factual lookups are routed to this model, see model_routing.py
+        bedrock_fast_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
 
-        inference_stack = InferenceStack(
+        self.inference_stack = InferenceStack(
             self,
             "inference_stack",
             env=env,
             application_ci=application_ci,
             knowledge_base_id=knowledge_base_stack.knowledge_base_id,
             bedrock_model_id=bedrock_model_id,
+            fast_model_id=bedrock_fast_model_id,
             bedrock_model_version=bedrock_model_version,
             knowledge_base_arn=knowledge_base_stack.knowledge_base_arn,
-            contexttable_table_name=context_stack.contexttable_table_name,
-            contexttable_table_arn=context_stack.contexttable_table_arn,
-        )
-
-        bucket_base_name = f"{application_ci}-analytics"
-
-        secondary_bucket = BucketAttributes(
-            bucket_name=f"{bucket_base_name}-us-east-2",
-            region="us-east-2",
-            account=env.account,
-            id="aaa-analytics-secondary",
+            contexttable_table_name=contexttable_table_name,
+            contexttable_table_arn=contexttable_table_arn,
+            retrieval_score_floor=retrieval_score_floor,
+            routing_min_fast_top_score=routing_min_fast_top_score,
+            # e.g. `cdk deploy -c inference_deployment_mode=direct`
+            deployment_mode=self.node.try_get_context("inference_deployment_mode")
+            or "state_machine",
+            # e.g. `cdk deploy -c inference_snap_start=true` or
+            # `cdk deploy -c inference_provisioned_concurrency=2`
+            snap_start=str(self.node.try_get_context("inference_snap_start")).lower() == "true",
+            provisioned_concurrency=int(
+                self.node.try_get_context("inference_provisioned_concurrency") or 0
+            ),
+            # e.g. `cdk deploy -c inference_prime_on_init=false`
+            prime_on_init=str(self.node.try_get_context("inference_prime_on_init")).lower()
+            != "false",
+            # e.g. `cdk deploy -c inference_request_coalescing=true` when many clients ask the
+            # same question at once; each question then pays a conditional write to the table
+            request_coalescing=str(
+                self.node.try_get_context("inference_request_coalescing")
+            ).lower()
+            == "true",
+            analytics_database=database_stack.database_attributes if analytics else None,
+            analytics_subnet_ids=analytics_subnet_ids,
+            websocket_domain=websocket_domain,
         )
 
-        primary_bucket = BucketAttributes(
-            bucket_name=f"{bucket_base_name}-us-east-1",
-            region="us-east-1",
-            account=env.account,
-            id="aaa-analytics-primary",
-        )
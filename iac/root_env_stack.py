@@ -4,6 +4,7 @@ import aws_cdk
 import builtins
 
 from regional_stack import RegionalStack
+from config.domain_attributes import DomainAttributes
 from constructs import Construct
 
 account_ids = {
@@ -25,26 +26,42 @@ class RootEnvStack(aws_cdk.Stack):
 
         super().__init__(scope, id)
 
-        primary_region = "us-east-1"
-        primary_stack = RegionalStack(
-            self,
-            id=primary_region,
-            runtime_environment=runtime_environment,
-            env=aws_cdk.Environment(
-                account=account_ids[runtime_environment], region=primary_region
-            ),
-            application_ci=application_ci,
-        )
-
-        # When we are production ready and need fault tolerance...
-        """
-        secondary_stack = RegionalStack(
-            self,
-            id="us-east-2",
-            runtime_environment=runtime_environment,
-            env=aws_cdk.Environment(
-                account=account_ids[runtime_environment], region="us-east-2"
-            ),
-            application_ci=application_ci,
-        )
-        """
+        # e.g. `cdk deploy -c regions=us-east-1,us-east-2` for an active-active deployment;
+        # the first region is the primary
+        regions = [
+            region.strip()
+            for region in str(self.node.try_get_context("regions") or "us-east-1").split(",")
+            if region.strip()
+        ]
+
+        # e.g. `-c websocket_domain_name=chat.example.com -c hosted_zone_id=Z0123456789
+        # -c hosted_zone_name=example.com`: clients connect to one name, routed by latency
+        websocket_domain = None
+        if self.node.try_get_context("websocket_domain_name"):
+            websocket_domain = DomainAttributes(
+                domain_name=self.node.try_get_context("websocket_domain_name"),
+                hosted_zone_id=self.node.try_get_context("hosted_zone_id"),
+                hosted_zone_name=self.node.try_get_context("hosted_zone_name"),
+            )
+
+        regional_stacks = {
+            region: RegionalStack(
+                self,
+                id=region,
+                runtime_environment=runtime_environment,
+                env=aws_cdk.Environment(
+                    account=account_ids[runtime_environment], region=region
+                ),
+                application_ci=application_ci,
+                regions=regions,
+                websocket_domain=websocket_domain,
+            )
+            for region in regions
+        }
+
+        primary_stack = regional_stacks[regions[0]]
+        for region in regions[1:]:
+            # Replication needs the destination buckets to exist
+            primary_stack.data_stack.add_dependency(regional_stacks[region].data_stack)
+            # The context table replica of a secondary region is made by the primary
+            regional_stacks[region].inference_stack.add_dependency(primary_stack.context_stack)
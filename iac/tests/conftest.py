@@ -0,0 +1,52 @@
+"""Shared setup for synthesizing the CDK app in tests. Nothing is deployed or looked up in AWS."""
+
+import json
+import os
+import sys
+
+import aws_cdk
+import pytest
+
+IAC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APPLICATION_CI = "aaa"
+
+sys.path.insert(0, IAC_ROOT)
+
+# The account and security groups only need to look real
+os.environ.setdefault("AWS_DEV_ACCOUNT", "123456789012")
+os.environ.setdefault("DEFAULT_SG", "sg-12345678")
+os.environ.setdefault("S3_SG", "sg-87654321")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def iac_root():
+    """Asset paths in the stacks are relative to iac, like for `cdk synth`."""
+    previous = os.getcwd()
+    os.chdir(IAC_ROOT)
+    yield IAC_ROOT
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def synth():
+    """
+    Returns a function that builds the app with the feature flags of cdk.json and the given
+    context, like `cdk synth -c key=value`, and returns its regional stacks by region.
+    """
+    from root_env_stack import RootEnvStack
+
+    with open(os.path.join(IAC_ROOT, "cdk.json")) as f:
+        feature_flags = json.load(f)["context"]
+
+    def build(**context):
+        app = aws_cdk.App(context=dict(feature_flags, **context))
+        root = RootEnvStack(
+            app,
+            id=f"{APPLICATION_CI}-dev",
+            application_ci=APPLICATION_CI,
+            runtime_environment="dev",
+        )
+        regions = [child.node.id for child in root.node.children if hasattr(child, "inference_stack")]
+        return {region: root.node.find_child(region) for region in regions}
+
+    return build
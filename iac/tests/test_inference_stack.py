@@ -0,0 +1,64 @@
+import pytest
+from aws_cdk.assertions import Match, Template
+
+REGION = "us-east-1"
+SUBNET_IDS = ["subnet-0a1b2c3d", "subnet-4e5f6a7b"]
+
+
+def inference_function(template):
+    (function,) = template.find_resources(
+        "AWS::Lambda::Function", {"Properties": {"Handler": "bedrock_interface.handler"}}
+    ).values()
+    return function["Properties"]
+
+
+@pytest.fixture(scope="module")
+def analytics_template(synth):
+    stacks = synth(inference_analytics="true", analytics_subnet_ids=",".join(SUBNET_IDS))
+    return Template.from_stack(stacks[REGION].inference_stack)
+
+
+def test_analytics_runs_in_the_given_nat_subnets(analytics_template):
+    vpc_config = inference_function(analytics_template)["VpcConfig"]
+    assert vpc_config["SubnetIds"] == SUBNET_IDS
+    assert len(vpc_config["SecurityGroupIds"]) == 1
+
+
+def test_analytics_reads_the_reader_endpoint(analytics_template):
+    variables = inference_function(analytics_template)["Environment"]["Variables"]
+    assert variables["ANALYTICS_ENABLED"] == "true"
+    assert "ANALYTICS_READER_HOST" in variables
+
+
+def test_analytics_can_share_cached_catalogs_and_results(analytics_template):
+    analytics_template.has_resource_properties(
+        "AWS::IAM::Policy",
+        {
+            "PolicyName": Match.string_like_regexp("AnalyticsDatabasePolicy"),
+            "PolicyDocument": {
+                "Statement": Match.array_with(
+                    [Match.object_like({"Action": ["dynamodb:GetItem", "dynamodb:PutItem"]})]
+                )
+            },
+        },
+    )
+
+
+def test_analytics_needs_subnets(synth):
+    with pytest.raises(ValueError, match="analytics_subnet_ids"):
+        synth(inference_analytics="true")
+
+
+def test_subnets_can_be_given_per_region(synth):
+    stacks = synth(
+        inference_analytics="true",
+        analytics_subnet_ids="subnet-00000000",
+        **{f"analytics_subnet_ids:{REGION}": ",".join(SUBNET_IDS)},
+    )
+    template = Template.from_stack(stacks[REGION].inference_stack)
+    assert inference_function(template)["VpcConfig"]["SubnetIds"] == SUBNET_IDS
+
+
+def test_without_analytics_the_function_is_outside_any_vpc(synth):
+    template = Template.from_stack(synth()[REGION].inference_stack)
+    assert "VpcConfig" not in inference_function(template)
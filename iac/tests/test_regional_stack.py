@@ -0,0 +1,100 @@
+import json
+
+import pytest
+from aws_cdk.assertions import Match, Template
+
+from conftest import APPLICATION_CI
+
+REGIONS = ["us-east-1", "us-west-2"]
+PRIMARY, SECONDARY = REGIONS
+DOMAIN = {
+    "websocket_domain_name": "chat.example.com",
+    "hosted_zone_id": "Z0123456789EXAMPLE",
+    "hosted_zone_name": "example.com",
+}
+
+
+@pytest.fixture(scope="module")
+def stacks(synth):
+    return synth(regions=",".join(REGIONS), **DOMAIN)
+
+
+def bucket(stack):
+    (properties,) = [
+        r["Properties"] for r in Template.from_stack(stack).find_resources("AWS::S3::Bucket").values()
+    ]
+    return properties
+
+
+def test_context_table_has_a_replica_in_every_region(stacks):
+    template = Template.from_stack(stacks[PRIMARY].context_stack)
+    template.resource_count_is("AWS::DynamoDB::GlobalTable", 1)
+    (table,) = template.find_resources("AWS::DynamoDB::GlobalTable").values()
+    assert sorted(r["Region"] for r in table["Properties"]["Replicas"]) == REGIONS
+
+
+def test_secondary_regions_use_the_replica(stacks):
+    assert stacks[SECONDARY].context_stack is None
+    # The replica only exists once the primary's table is deployed
+    assert stacks[PRIMARY].context_stack in stacks[SECONDARY].inference_stack.dependencies
+
+
+def test_primary_bucket_replicates_to_the_other_regions(stacks):
+    properties = bucket(stacks[PRIMARY].data_stack)
+    assert properties["BucketName"] == f"{APPLICATION_CI}-analytics-{PRIMARY}"
+    destinations = [rule["Destination"]["Bucket"] for rule in properties["ReplicationConfiguration"]["Rules"]]
+    assert destinations == [f"arn:aws:s3:::{APPLICATION_CI}-analytics-{SECONDARY}"]
+    # The destination buckets have to exist before the rules that point to them
+    assert stacks[SECONDARY].data_stack in stacks[PRIMARY].data_stack.dependencies
+
+
+def test_secondary_buckets_do_not_replicate(stacks):
+    properties = bucket(stacks[SECONDARY].data_stack)
+    assert properties["BucketName"] == f"{APPLICATION_CI}-analytics-{SECONDARY}"
+    assert "ReplicationConfiguration" not in properties
+
+
+@pytest.mark.parametrize("region", REGIONS)
+def test_inference_path_stays_in_its_region(stacks, region):
+    template = Template.from_stack(stacks[region].inference_stack)
+    # Any other region in the inference stack would put a cross-region call in the request path
+    text = json.dumps(template.to_json())
+    assert [other for other in REGIONS if other != region and other in text] == []
+    for function in template.find_resources("AWS::Lambda::Function").values():
+        table = function["Properties"].get("Environment", {}).get("Variables", {}).get("CONTEXT_TABLE_NAME")
+        # The primary imports the name from its context stack; the others use their replica
+        if isinstance(table, str):
+            assert table == f"{APPLICATION_CI}-context"
+
+
+@pytest.mark.parametrize("region", REGIONS)
+def test_every_region_serves_the_domain_with_a_latency_record(stacks, region):
+    template = Template.from_stack(stacks[region].inference_stack)
+    template.resource_count_is("AWS::ApiGatewayV2::DomainName", 1)
+    template.has_resource_properties(
+        "AWS::ApiGatewayV2::DomainName",
+        {
+            "DomainName": DOMAIN["websocket_domain_name"],
+            "DomainNameConfigurations": [Match.object_like({"EndpointType": "REGIONAL"})],
+        },
+    )
+    template.resource_count_is("AWS::ApiGatewayV2::ApiMapping", 1)
+    template.has_resource_properties(
+        "AWS::Route53::RecordSet",
+        {
+            "Region": region,
+            "SetIdentifier": region,
+            "AliasTarget": Match.object_like({"EvaluateTargetHealth": True}),
+        },
+    )
+
+
+def test_single_region_without_a_domain(synth):
+    (regional,) = synth(regions=PRIMARY).values()
+    template = Template.from_stack(regional.context_stack)
+    (table,) = template.find_resources("AWS::DynamoDB::GlobalTable").values()
+    assert [r["Region"] for r in table["Properties"]["Replicas"]] == [PRIMARY]
+    assert "ReplicationConfiguration" not in bucket(regional.data_stack)
+    inference = Template.from_stack(regional.inference_stack)
+    inference.resource_count_is("AWS::ApiGatewayV2::DomainName", 0)
+    inference.resource_count_is("AWS::Route53::RecordSet", 0)
@@ -1,64 +1,265 @@
 #!/bin/bash
 
+# Usage: build_lambda.sh <build root> <python version> <app id> <src home> <src root> [options]
+#
+# Builds a .zip deployment package of the Lambda in <src home> and prints its path on stdout.
+# With --layer, the dependencies go into a separate layer archive, whose path is printed on a
+# second line. Everything else, including the size report, goes to stderr. Directories named
+# tests are never packaged.
+#
+# Options:
+#   --layer                  Put the dependencies into a layer archive instead of the package
+#   --flat                   Copy the sources to the package root, for handlers such as
+#                            "bedrock_interface.handler" whose modules import each other flat
+#   --no-deps                Leave the dependencies out, for a Lambda that gets them from layers.
+#                            They are only installed for --import-check, in place of those layers.
+#   --import-check <module>  Report the cold import time of <module> from the package, also on a
+#                            cached build
+#   --no-cache               Rebuild even if a cached build exists
+#
+# Builds are cached in $LAMBDA_BUILD_CACHE (default ~/.cache/lambda_builds). The dependencies are
+# keyed on poetry.lock and the compiling interpreter, the package on the lockfile, the sources and
+# the options, so a source change reuses the installed dependencies and an unchanged Lambda is not
+# rebuilt at all.
+# Bytecode is compiled with python<python version>, or $LAMBDA_BUILD_PYTHON, when available.
+
 app_id=$3
 build_root=$1
 python_version=$2
 src_home=$4
 src_root=$5
+shift 5
+
+use_layer=false
+use_flat=false
+use_deps=true
+import_check=""
+use_cache=true
+while [ $# -gt 0 ]; do
+    case $1 in
+        --layer) use_layer=true ;;
+        --flat) use_flat=true ;;
+        --no-deps) use_deps=false ;;
+        --import-check) import_check=$2; shift ;;
+        --no-cache) use_cache=false ;;
+        *) echo "Unknown option $1. Exiting." >&2; exit 1 ;;
+    esac
+    shift
+done
 
 build_path=$build_root/build
+layer_path=$build_root/layer
+cache_root=${LAMBDA_BUILD_CACHE:-$HOME/.cache/lambda_builds}
+target_python=${LAMBDA_BUILD_PYTHON:-python$python_version}
 # TODO: Validate parameters
 
+if ! "$target_python" -c "" 2>/dev/null; then
+    echo "$target_python is not available: bytecode is not precompiled and imports are not checked." >&2
+    target_python=""
+fi
+
+# Hashes every file under a directory by relative path and content
+hash_tree() {
+    (cd "$1" && find . -type f ! -path "*/__pycache__/*" ! -path "*/tests/*" ! -name "*.pyc" -print0 | LC_ALL=C sort -z | xargs -0 sha256sum) | sha256sum | cut -c1-16
+}
+
+# Deletes files the Lambda runtime never reads
+prune() {
+    find "$1" -type d \( -name "__pycache__" -o -name "tests" -o -name "test" \) -prune -exec rm -rf {} +
+    find "$1" -type f \( -name "*.pyi" -o -name "*.pyx" -o -name "*.c" -o -name "*.h" -o -name "*.md" -o -name "RECORD" -o -name "INSTALLER" \) -delete
+    find "$1" -type d -name "*.dist-info" -exec rm -rf {}/licenses \; 2>/dev/null
+    find "$1" -type d -empty -delete
+}
+
+# Unchecked-hash .pyc files stay valid although zip does not keep exact timestamps
+precompile() {
+    if [ -n "$target_python" ]; then
+        "$target_python" -m compileall -q -j 0 --invalidation-mode unchecked-hash "$1" >/dev/null
+    fi
+}
+
+# Same inputs, same archive: fixed timestamps and no extra file attributes
+archive() {
+    find "$1" -exec touch -h -t 198001010000 {} +
+    (cd "$1" && find . -mindepth 1 | LC_ALL=C sort | zip -q -X -D "$2" -@)
+}
+
+# Lines of "<size> <name>" for the largest top-level entries of a directory
+largest() {
+    (cd "$1" && du -sk -- * 2>/dev/null | sort -rn | head -n 5 | awk '{ printf "    %8.1f MiB  %s\n", $1 / 1024, $2 }')
+}
+
+# Imports the module from an unpacked package and its dependencies, like the runtime does on a
+# cold start
+check_import() {
+    if [ -z "$import_check" ] || [ -z "$target_python" ]; then
+        return
+    fi
+    import_ms=$(cd "$1" && PYTHONPATH="$1:$2" AWS_DEFAULT_REGION=${AWS_DEFAULT_REGION:-us-east-1} \
+        "$target_python" -c "import time; t = time.perf_counter(); import $import_check; print(round((time.perf_counter() - t) * 1000))" 2>&1)
+    if [ $? -eq 0 ]; then
+        echo "Cold import of $import_check: $import_ms ms" >&2
+    else
+        echo "Unable to import $import_check from the package: $import_ms" >&2
+    fi
+}
+
+report() {
+    for file in "$@"; do
+        echo "$(basename $file): $(du -k $file | awk '{ printf "%.1f MiB", $1 / 1024 }')" >&2
+    done
+}
+
+lock_hash=$( (cat "$src_home/poetry.lock" "$src_home/pyproject.toml"; echo "$python_version") | sha256sum | cut -c1-16)
+source_hash=$(hash_tree "$src_home")
+script_hash=$(sha256sum "$0" | cut -c1-16)
+# Dependencies installed without an interpreter to compile them have no bytecode, so they are
+# cached apart from those that do
+compile_hash=$(echo "${target_python:-none}" | sha256sum | cut -c1-8)
+package_key=$(echo "$lock_hash $source_hash $script_hash $use_layer $use_flat $use_deps $target_python" | sha256sum | cut -c1-16)
+deps_cache=$cache_root/deps-$lock_hash-$script_hash-$compile_hash
+package_cache=$cache_root/$app_id-$package_key
+archive_name="$app_id"_deployment_package.zip
+layer_name="$app_id"_dependencies_layer.zip
+
+# Without --no-deps the dependencies are packaged; with it they are only needed for the import check
+needs_deps=$use_deps
+if [ -n "$import_check" ] && [ -n "$target_python" ]; then
+    needs_deps=true
+fi
+
+# A package without its dependencies is only reused if they are still cached for the check
+if $use_cache && test -f "$package_cache/$archive_name" && { $use_deps || ! $needs_deps || test -d "$deps_cache"; }; then
+    echo "Reusing cached build $package_cache." >&2
+    report $package_cache/*.zip
+    if [ -n "$import_check" ] && [ -n "$target_python" ]; then
+        check_root=$(mktemp -d)
+        unzip -q "$package_cache/$archive_name" -d "$check_root/package"
+        if $use_layer; then
+            unzip -q "$package_cache/$layer_name" -d "$check_root/layer"
+            check_import "$check_root/package" "$check_root/layer/python"
+        elif ! $use_deps; then
+            check_import "$check_root/package" "$deps_cache"
+        else
+            check_import "$check_root/package"
+        fi
+        rm -rf "$check_root"
+    fi
+    echo "$package_cache/$archive_name"
+    if $use_layer; then
+        echo "$package_cache/$layer_name"
+    fi
+    exit 0
+fi
+
 if test -d $build_root; then
-    echo "Build root already exists. Exiting."
+    echo "Build root already exists. Exiting." >&2
     exit 1
 fi
-dir_error=$(mkdir -p "$build_path" 2>&1)
+dir_error=$(mkdir -p "$build_path" "$cache_root" 2>&1)
 if [ $? -ne 0 ]; then
-    echo "Unable to create .zip archive build root directory $build_root. Reason: $dir_error. Exiting."
+    echo "Unable to create .zip archive build root directory $build_root. Reason: $dir_error. Exiting." >&2
     exit 1
 fi
 
-poetry config warnings.export false
+if ! $needs_deps; then
+    :
+elif ! $use_cache || ! test -d "$deps_cache"; then
+    poetry config warnings.export false >/dev/null 2>&1
 
-# We need a lock file here, otherwise requirements.txt will be malformed with text at the top of th file
-poetry_error=$( (cd $src_home && poetry export -f requirements.txt --without-hashes >$build_path/requirements.txt 2>&1) ) 
-# TODO: Poetry warning exits as 1???
-if [ $? -ne 0 ]; then
-    echo "Unable to export requirements.txt from project dependencies. Reason: $poetry_error. Cleaning up and exiting."
-    rm -rf $build_root 2>&1 > /dev/null
-    exit 1
-fi
+    # We need a lock file here, otherwise requirements.txt will be malformed with text at the top of th file
+    poetry_error=$( (cd $src_home && poetry export -f requirements.txt --without-hashes >$build_root/requirements.txt 2>&1) )
+    # TODO: Poetry warning exits as 1???
+    if [ $? -ne 0 ]; then
+        echo "Unable to export requirements.txt from project dependencies. Reason: $poetry_error. Cleaning up and exiting." >&2
+        rm -rf $build_root 2>&1 > /dev/null
+        exit 1
+    fi
 
-requirements_path=$build_path"/requirements.txt"
+    requirements_path=$build_root"/requirements.txt"
 
-pip_error=$(pip install --platform manylinux2014_x86_64 --target=$build_path --implementation cp --python-version $python_version --only-binary=:all: --upgrade --no-compile -r $requirements_path 2>&1 >/dev/null)
-if [ $? -ne 0 ]; then
-    echo "'pip install' into the .zip archive build directory failed. Reason: $pip_error. Cleaning up and exiting."
-    rm -rf $build_root 2>&1 > /dev/null
-    exit 1
+    pip_error=$(pip install --platform manylinux2014_x86_64 --target=$build_root/deps --implementation cp --python-version $python_version --only-binary=:all: --upgrade --no-compile -r $requirements_path 2>&1 >/dev/null)
+    if [ $? -ne 0 ]; then
+        echo "'pip install' into the .zip archive build directory failed. Reason: $pip_error. Cleaning up and exiting." >&2
+        rm -rf $build_root 2>&1 > /dev/null
+        exit 1
+    fi
+
+    prune $build_root/deps
+    precompile $build_root/deps
+    # Written under a temporary name first, so an interrupted build is never reused
+    rm -rf "$deps_cache" "$deps_cache.partial"
+    cp -r $build_root/deps "$deps_cache.partial" && mv "$deps_cache.partial" "$deps_cache"
+    echo "Installed dependencies into $deps_cache." >&2
+else
+    echo "Reusing cached dependencies $deps_cache." >&2
+fi
+
+if $use_layer; then
+    mkdir -p $layer_path/python
+    cp -r "$deps_cache"/. $layer_path/python/
+elif $use_deps; then
+    cp -r "$deps_cache"/. $build_path/
 fi
 
-rm $requirements_path
-lambda_cp_error=$(cp -r "$src_home" $build_path/)
+if $use_flat; then
+    sources_path=$build_path
+    lambda_cp_error=$(cp -r "$src_home"/. $build_path/ 2>&1)
+else
+    sources_path=$build_path/$(basename $src_home)
+    lambda_cp_error=$(cp -r "$src_home" $build_path/ 2>&1)
+fi
 if [ $? -ne 0 ]; then
-    echo "copy lambda root to .zip archive build directory failed. Reason: $lambda_error. Cleaning up and exiting."
+    echo "copy lambda root to .zip archive build directory failed. Reason: $lambda_cp_error. Cleaning up and exiting." >&2
     rm -rf $build_root 2>&1 > /dev/null
     exit 1
 fi
-
-archive=$build_root/"$app_id"_deployment_package.zip
+# Only the sources are needed at runtime
+rm -f $sources_path/poetry.lock $sources_path/pyproject.toml
+find $sources_path -type d \( -name "__pycache__" -o -name "tests" \) -prune -exec rm -rf {} +
+precompile $sources_path
 
 # Per the AWS docs...
 chmod -R 755 $build_root
-rm -rf $build_path/__pycache__
-zip_error=$( (cd $build_path && zip -r $archive . 2>&1 >/dev/null) )
+mkdir -p $build_root/out
+zip_error=$(archive $build_path $build_root/out/$archive_name 2>&1)
 if [ $? -ne 0 ]; then
-    echo "zipping .zip archive from build directory failed. Reason: $zip_error. Cleaning up and exiting."
+    echo "zipping .zip archive from build directory failed. Reason: $zip_error. Cleaning up and exiting." >&2
     rm -rf $build_root 2>&1 > /dev/null
     exit 1
 fi
+if $use_layer; then
+    zip_error=$(archive $layer_path $build_root/out/$layer_name 2>&1)
+    if [ $? -ne 0 ]; then
+        echo "zipping layer archive failed. Reason: $zip_error. Cleaning up and exiting." >&2
+        rm -rf $build_root 2>&1 > /dev/null
+        exit 1
+    fi
+fi
+
+if $use_layer; then
+    check_import $build_path $layer_path/python
+elif ! $use_deps; then
+    check_import $build_path "$deps_cache"
+else
+    check_import $build_path
+fi
 
-rm -rf $build_path
-echo $archive
-exit 0
\ No newline at end of file
+echo "Largest entries:" >&2
+if $use_layer; then
+    largest $layer_path/python >&2
+else
+    largest $build_path >&2
+fi
+
+rm -rf "$package_cache" "$package_cache.partial"
+mkdir -p "$package_cache.partial"
+cp $build_root/out/*.zip "$package_cache.partial"/ && mv "$package_cache.partial" "$package_cache"
+report $package_cache/*.zip
+
+rm -rf $build_path $layer_path $build_root/deps $build_root/out $build_root/requirements.txt
+echo "$package_cache/$archive_name"
+if $use_layer; then
+    echo "$package_cache/$layer_name"
+fi
+exit 0
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Validates an Amazon States Language definition locally, before `cdk deploy` does.
+
+Placeholders such as ${ContextTable} are substituted with dummy values (or the
+ones given with --substitution) before the definition is parsed, so the check
+sees what Step Functions will see.
+
+    python scripts/validate_asl.py iac/statemachine.asl.json
+    python scripts/validate_asl.py iac/statemachine.asl.json -s HistoryLimit=5
+"""
+
+import argparse
+import json
+import re
+import sys
+
+PLACEHOLDER = re.compile(r"\$\{(\w+)\}")
+STRING_TO_JSON = re.compile(r"States\.StringToJson\('([^']*)'\)")
+
+STATE_TYPES = {"Task", "Pass", "Choice", "Wait", "Succeed", "Fail", "Parallel", "Map"}
+TERMINAL_TYPES = {"Succeed", "Fail"}
+
+
+def substitute(text, substitutions):
+    placeholders = sorted(set(PLACEHOLDER.findall(text)))
+
+    def replace(match):
+        name = match.group(1)
+        # Numeric-looking names default to a number so StringToJson arguments stay valid
+        return substitutions.get(name, "1" if name.endswith(("Limit", "Results")) else name)
+
+    return PLACEHOLDER.sub(replace, text), placeholders
+
+
+def check_paths(value, location, errors):
+    """Checks every "<field>.$" value is a path or an intrinsic function."""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            if key.endswith(".$"):
+                if not isinstance(child, str) or not child.startswith(("$", "States.")):
+                    errors.append(f"{location}.{key}: must be a path or intrinsic function")
+                for literal in STRING_TO_JSON.findall(child if isinstance(child, str) else ""):
+                    try:
+                        json.loads(literal)
+                    except ValueError:
+                        errors.append(f"{location}.{key}: StringToJson argument {literal!r} is not JSON")
+            check_paths(child, f"{location}.{key}", errors)
+    elif isinstance(value, list):
+        for i, child in enumerate(value):
+            check_paths(child, f"{location}[{i}]", errors)
+
+
+def check_machine(machine, location, errors):
+    states = machine.get("States")
+    if not isinstance(states, dict) or not states:
+        errors.append(f"{location}: no States")
+        return
+    start = machine.get("StartAt")
+    if start not in states:
+        errors.append(f"{location}: StartAt {start!r} is not a state")
+
+    edges = {}
+    for name, state in states.items():
+        here = f"{location}.{name}"
+        kind = state.get("Type")
+        if kind not in STATE_TYPES:
+            errors.append(f"{here}: unknown Type {kind!r}")
+            continue
+        targets = []
+        if "Next" in state:
+            targets.append(state["Next"])
+        for catcher in state.get("Catch", []):
+            targets.append(catcher.get("Next"))
+        if kind == "Choice":
+            targets.extend(choice.get("Next") for choice in state.get("Choices", []))
+            if "Default" in state:
+                targets.append(state["Default"])
+        elif kind not in TERMINAL_TYPES and not state.get("End") and "Next" not in state:
+            errors.append(f"{here}: needs Next or End")
+        if state.get("End") and "Next" in state:
+            errors.append(f"{here}: has both Next and End")
+        if kind == "Task" and "Resource" not in state:
+            errors.append(f"{here}: Task without Resource")
+        for target in targets:
+            if target not in states:
+                errors.append(f"{here}: transition to unknown state {target!r}")
+        edges[name] = [t for t in targets if t in states]
+
+        if kind == "Parallel":
+            branches = state.get("Branches") or []
+            if not branches:
+                errors.append(f"{here}: Parallel without Branches")
+            for i, branch in enumerate(branches):
+                check_machine(branch, f"{here}.Branches[{i}]", errors)
+        if kind == "Map":
+            processor = state.get("ItemProcessor") or state.get("Iterator")
+            if processor is None:
+                errors.append(f"{here}: Map without ItemProcessor")
+            else:
+                check_machine(processor, f"{here}.ItemProcessor", errors)
+
+        for field in ("Parameters", "ResultSelector", "Arguments"):
+            check_paths(state.get(field), f"{here}.{field}", errors)
+
+    reachable = set()
+    pending = [start] if start in states else []
+    while pending:
+        name = pending.pop()
+        if name not in reachable:
+            reachable.add(name)
+            pending.extend(edges.get(name, []))
+    for name in states:
+        if name not in reachable:
+            errors.append(f"{location}.{name}: unreachable from StartAt")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("definition")
+    parser.add_argument("-s", "--substitution", action="append", default=[], metavar="NAME=VALUE")
+    args = parser.parse_args()
+
+    substitutions = dict(item.split("=", 1) for item in args.substitution)
+    with open(args.definition) as f:
+        text, placeholders = substitute(f.read(), substitutions)
+
+    try:
+        machine = json.loads(text)
+    except ValueError as e:
+        print(f"{args.definition}: not valid JSON after substitution: {e}")
+        return 1
+
+    errors = []
+    check_machine(machine, "$", errors)
+    for error in errors:
+        print(error)
+    if errors:
+        return 1
+    print(f"{args.definition}: OK (placeholders: {', '.join(placeholders)})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
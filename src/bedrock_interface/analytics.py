@@ -0,0 +1,380 @@
+# Import necessary libraries
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+from aws_lambda_powertools.utilities import parameters
+
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:
+    # Only deployments with analytics enabled ship psycopg2, in the analytics layer
+    psycopg2 = None
+
+# Requests with this mode in their data are answered from the analytics database
+ANALYTICS_MODE = "analytics"
+# Requests that also ask for this format get the result as NDJSON frames, see ndjson_frames
+STREAM_FORMAT = "ndjson"
+# Room left in every NDJSON frame for its header line
+FRAME_HEADER_BYTES = 64
+
+SQL_SYSTEM_PROMPT = """You translate questions about a PostgreSQL database into a single read-only SQL query.
+- Use only the tables and columns described in <schema>, and quote identifiers exactly as they are written there.
+- Each line of <schema> is a table with its approximate row count and its columns: PK marks the primary key, -> the column a foreign key references, and e.g. lists example values.
+- Write one SELECT statement, without a trailing semicolon.
+- Unless the query aggregates to a few rows, add LIMIT {max_rows}.
+- Answer with the query inside <sql></sql> tags and nothing else.
+- If the schema cannot answer the question, answer <sql></sql>.
+<schema>
+{schema}
+</schema>"""
+
+# Statements and functions a generated query must not contain. The reader endpoint and the
+# read-only session reject writes anyway; this catches them before they reach the database.
+FORBIDDEN_SQL = re.compile(
+    r"\b(insert|update|delete|merge|drop|alter|create|grant|revoke|truncate|copy|vacuum|"
+    r"analyze|call|do|lock|set|reset|listen|notify|prepare|execute|refresh)\b"
+    r"|\b(pg|lo)_\w+\s*\(|\bdblink\w*\s*\(|\bset_config\s*\(",
+    re.IGNORECASE,
+)
+
+
+class UnsafeQueryError(ValueError):
+    """A generated query that is not a single read-only SELECT."""
+
+
+# The reader pool is kept across invocations, so warm requests skip the connection setup
+_pool = None
+_last_used: Dict[int, float] = {}
+
+
+def connection_settings() -> Dict[str, Any]:
+    """
+    Returns the psycopg2 connection arguments for the reader. ANALYTICS_DSN, if set, is used as
+    is, for example for a local Postgres. Otherwise the credentials come from the database
+    secret and the host is the cluster's reader endpoint, so the writer only serves loads.
+    """
+    options = (
+        f"-c statement_timeout={int(os.getenv('ANALYTICS_STATEMENT_TIMEOUT_MS', '5000'))}"
+        " -c default_transaction_read_only=on"
+    )
+    settings = {
+        "connect_timeout": int(os.getenv("ANALYTICS_CONNECT_TIMEOUT_SECONDS", "5")),
+        "application_name": os.getenv("POWERTOOLS_SERVICE_NAME", "bedrock-interface"),
+        "options": options,
+    }
+    if os.getenv("ANALYTICS_DSN"):
+        return dict(settings, dsn=os.getenv("ANALYTICS_DSN"))
+    credentials = parameters.get_secret(
+        os.getenv("ANALYTICS_SECRET_NAME"), transform="json", max_age=3600
+    )
+    return dict(
+        settings,
+        host=os.getenv("ANALYTICS_READER_HOST") or credentials["host"],
+        port=credentials["port"],
+        dbname=os.getenv("ANALYTICS_DATABASE_NAME") or credentials["dbname"],
+        user=credentials["username"],
+        password=credentials["password"],
+    )
+
+
+def reader_pool() -> Any:
+    """
+    Returns the pool of reader connections, creating it on first use.
+    """
+    global _pool
+    if psycopg2 is None:
+        raise RuntimeError("psycopg2 is not installed, analytics are not enabled")
+    if _pool is None or _pool.closed:
+        _pool = ThreadedConnectionPool(
+            minconn=1, maxconn=int(os.getenv("ANALYTICS_POOL_SIZE", "2")), **connection_settings()
+        )
+    return _pool
+
+
+def close_pool() -> None:
+    """
+    Closes every pooled connection, for example before a SnapStart snapshot.
+    """
+    global _pool
+    if _pool is not None and not _pool.closed:
+        _pool.closeall()
+    _pool = None
+    _last_used.clear()
+
+
+@contextmanager
+def reader_connection() -> Iterator[Any]:
+    """
+    Lends a pooled reader connection. A connection that sat idle for longer than
+    ANALYTICS_IDLE_CHECK_SECONDS is checked first and replaced if the server dropped it, for
+    example after a reader failover. The read-only transaction is always rolled back.
+    """
+    pool = reader_pool()
+    connection = pool.getconn()
+    idle_since = _last_used.get(id(connection))
+    if idle_since is not None and time.time() - idle_since > float(
+        os.getenv("ANALYTICS_IDLE_CHECK_SECONDS", "60")
+    ):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+    try:
+        yield connection
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # The connection may be broken, so it is not handed out again
+        _last_used.pop(id(connection), None)
+        pool.putconn(connection, close=True)
+        raise
+    else:
+        if connection.closed:
+            pool.putconn(connection, close=True)
+        else:
+            connection.rollback()
+            _last_used[id(connection)] = time.time()
+            pool.putconn(connection)
+
+
+def generate_sql(
+    bedrock_client: Any,
+    model_id: str,
+    anthropic_version: str,
+    question: str,
+    schema: str,
+    max_rows: int,
+) -> str:
+    """
+    Asks the model for a query that answers the question.
+    - bedrock_client: The Bedrock runtime client.
+    - model_id: The model that writes the query.
+    - anthropic_version: The Anthropic API version of the request body.
+    - question: The user's question.
+    - schema: The schema description from schema_catalog.schema_context.
+    - max_rows: The row limit the query is asked to respect.
+
+    Returns the query, or an empty string if the model found that the schema cannot answer it.
+    """
+    response = bedrock_client.invoke_model(
+        modelId=model_id,
+        body=json.dumps(
+            {
+                "anthropic_version": anthropic_version,
+                "max_tokens": int(os.getenv("ANALYTICS_SQL_MAX_TOKENS", "1000")),
+                "temperature": 0,
+                "system": SQL_SYSTEM_PROMPT.format(schema=schema, max_rows=max_rows),
+                "messages": [{"role": "user", "content": question}],
+            }
+        ),
+    )
+    text = "".join(
+        block.get("text", "") for block in json.loads(response["body"].read())["content"]
+    )
+    match = re.search(r"<sql>(.*?)</sql>", text, re.DOTALL)
+    return (match.group(1) if match else text).strip()
+
+
+def read_only_sql(sql: str) -> str:
+    """
+    Checks that a generated query is a single SELECT and nothing else.
+    - sql: The generated query.
+
+    Returns the query without a trailing semicolon. Raises UnsafeQueryError otherwise.
+    """
+    statement = sql.strip().rstrip(";").strip()
+    # String literals, quoted identifiers and comments may contain any word
+    code = re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", "''", statement)
+    code = re.sub(r"--[^\n]*|/\*.*?\*/", " ", code, flags=re.DOTALL)
+    if ";" in code:
+        raise UnsafeQueryError("Only a single statement can be run")
+    if not re.match(r"\s*(select|with)\b", code, re.IGNORECASE):
+        raise UnsafeQueryError("Only SELECT queries can be run")
+    forbidden = FORBIDDEN_SQL.search(code)
+    if forbidden:
+        raise UnsafeQueryError(f"The query may not use {forbidden.group(0).strip()}")
+    return statement
+
+
+def run_query(connection: Any, sql: str, max_rows: int) -> Dict[str, Any]:
+    """
+    Runs a read-only query and fetches at most max_rows rows.
+    - connection: A reader connection.
+    - sql: A query checked by read_only_sql.
+    - max_rows: The most rows returned; the result says whether there were more.
+
+    Returns the column names, the rows, whether they were truncated and the query time.
+    """
+    started_at = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        columns = [column.name for column in cursor.description]
+        rows = cursor.fetchmany(max_rows + 1)
+    return {
+        "columns": columns,
+        "rows": rows[:max_rows],
+        "truncated": len(rows) > max_rows,
+        "query_ms": (time.perf_counter() - started_at) * 1000,
+    }
+
+
+def format_cell(value: Any) -> str:
+    if value is None:
+        return ""
+    return str(value).replace("|", "\\|").replace("\n", " ")
+
+
+def format_results(result: Dict[str, Any], rows_per_frame: int) -> Iterator[str]:
+    """
+    Renders a query result as a Markdown table, rows_per_frame rows at a time, so a large
+    result is posted as several frames.
+    - result: The result from run_query.
+    - rows_per_frame: The rows in each piece of text.
+    """
+    if not result["rows"]:
+        yield "The query returned no rows.\n"
+        return
+    header = "| " + " | ".join(format_cell(c) for c in result["columns"]) + " |\n"
+    header += "|" + "---|" * len(result["columns"]) + "\n"
+    rows = result["rows"]
+    for start in range(0, len(rows), rows_per_frame):
+        text = "".join(
+            "| " + " | ".join(format_cell(v) for v in row) + " |\n"
+            for row in rows[start : start + rows_per_frame]
+        )
+        yield (header if start == 0 else "") + text
+    if result["truncated"]:
+        yield f"\n_Showing the first {len(rows)} rows._\n"
+
+
+def stream_batches(
+    connection: Any, sql: str, batch_rows: int
+) -> Iterator[Tuple[List[str], List[Tuple[Any, ...]]]]:
+    """
+    Reads a query's rows through a named, server-side cursor, batch_rows at a time, so only one
+    batch is ever held in memory. Closing the generator closes the cursor.
+    - connection: A reader connection, inside the transaction the query runs in.
+    - sql: A query checked by read_only_sql.
+    - batch_rows: The rows fetched per round trip.
+
+    Yields the column names and the rows of each batch; the first batch may be empty.
+    """
+    with connection.cursor(name=f"analytics_{uuid.uuid4().hex}") as cursor:
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            # A named cursor only describes its columns after the first fetch
+            yield [column.name for column in cursor.description], rows
+            if len(rows) < batch_rows:
+                return
+
+
+def ndjson_header(sequence: int, kind: str, **values: Any) -> str:
+    """
+    Returns the header line that starts an NDJSON frame, see ndjson_frames.
+    - sequence: The frame's sequence number.
+    - kind: The frame's type.
+    - values: More fields of the header.
+    """
+    return json.dumps(dict(seq=sequence, type=kind, **values), separators=(",", ":")) + "\n"
+
+
+def cut_bytes(text: str, max_bytes: int) -> str:
+    """
+    Cuts text to at most max_bytes bytes of UTF-8, without splitting a character.
+    - text: The text to cut.
+    - max_bytes: The most bytes kept.
+    """
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode("utf-8", "ignore") + "…"
+
+
+def ndjson_frames(
+    batches: Iterator[Tuple[List[str], List[Tuple[Any, ...]]]],
+    max_rows: int,
+    frame_bytes: int,
+    max_cell_bytes: int,
+) -> Iterator[str]:
+    """
+    Encodes streamed rows as WebSocket frames of newline-delimited JSON. Every frame starts
+    with a header line carrying its sequence number and type: "columns" with the column
+    names, "rows" followed by one JSON array per row, and finally "end" with the row count,
+    whether there were more than max_rows, and how many rows were left out because even with
+    their cells cut they did not fit in a frame. If reading the rows fails, or the column names
+    alone do not fit in a frame, the last frame is "error" with a message instead, so a client
+    always sees the stream finish.
+    - batches: The batches from stream_batches.
+    - max_rows: The most rows sent.
+    - frame_bytes: The size in bytes every frame is kept under, below the API Gateway frame
+      limit.
+    - max_cell_bytes: Longer text values are cut to this many bytes of UTF-8.
+    """
+    sequence, total, oversized, truncated, columns = 0, 0, 0, False, None
+    lines: List[str] = []
+    size = 0
+    # A row line must leave room for the header line of its frame
+    line_bytes_limit = frame_bytes - FRAME_HEADER_BYTES
+
+    def cell(value: Any) -> Any:
+        if isinstance(value, str):
+            return cut_bytes(value, max_cell_bytes)
+        return value
+
+    try:
+        for batch_columns, rows in batches:
+            if columns is None:
+                columns = batch_columns
+                frame = ndjson_header(sequence, "columns", columns=columns)
+                if len(frame.encode("utf-8")) > frame_bytes:
+                    yield ndjson_header(
+                        sequence,
+                        "error",
+                        message=f"The result's {len(columns)} columns do not fit in a frame",
+                        rows=0,
+                    )
+                    return
+                yield frame
+                sequence += 1
+            for row in rows:
+                if total == max_rows:
+                    truncated = True
+                    break
+                # Values JSON cannot hold, such as decimals and dates, are sent as text
+                line = json.dumps([cell(v) for v in row], separators=(",", ":"), ensure_ascii=False, default=str) + "\n"
+                line_bytes = len(line.encode("utf-8"))
+                # Many columns, or escaping, can still make a row too large for any frame
+                if line_bytes > line_bytes_limit:
+                    oversized += 1
+                    continue
+                if lines and size + line_bytes > line_bytes_limit:
+                    yield ndjson_header(sequence, "rows", count=len(lines)) + "".join(lines)
+                    sequence += 1
+                    lines, size = [], 0
+                lines.append(line)
+                size += line_bytes
+                total += 1
+            if truncated:
+                break
+    except Exception as e:
+        # Closes the stream for the client; the error is then raised to the caller. Buffered
+        # rows were never sent.
+        yield ndjson_header(
+            sequence,
+            "error",
+            message=cut_bytes(str(e).strip(), line_bytes_limit // 2),
+            rows=total - len(lines),
+        )
+        raise
+    if lines:
+        yield ndjson_header(sequence, "rows", count=len(lines)) + "".join(lines)
+        sequence += 1
+    yield ndjson_header(sequence, "end", rows=total, truncated=truncated, oversized=oversized)
@@ -1,8 +1,33 @@
 # Import necessary libraries
+import base64
 import json
 import boto3
 import os
-from typing import List, Dict, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Callable, List, Dict, Any, Optional, Tuple
+
+from aws_lambda_powertools.metrics import MetricUnit
+from botocore.exceptions import ClientError
+
+import analytics
+import query_guard
+import result_cache
+import schema_catalog
+from context_compression import compress_docs
+from history_codec import decode_attribute, encode_text_b64
+from model_routing import FAST_TIER, STRONG_TIER, model_tiers, route_request, should_escalate
+from priming import (
+    PrimingCall,
+    close_connections,
+    prime_clients,
+    register_runtime_hooks,
+    snap_start_init,
+)
+from request_coalescing import FlightWriter, flight_key, follow_flight, join_flight
+from retrieval_depth import adapt_results, depth_settings
+from telemetry import TurnMetrics, log_turn, logger, metrics, tracer
 
 # Initialize AWS clients for Kendra, Bedrock, and API Gateway Management API
 # These clients are used for interacting with respective AWS services
@@ -14,6 +39,124 @@ apigatewaymanagementapi_client = boto3.client(
     "apigatewaymanagementapi", endpoint_url=api_gateway_endpoint_url
 )
 
+# Used for request coalescing, and in the "direct" deployment mode, where there is no
+# state machine to fetch and store the conversation history
+dynamodb_client = boto3.client("dynamodb")
+lambda_client = boto3.client("lambda")
+
+# Runs the independent I/O of a turn, such as history and retrieval, concurrently
+executor = ThreadPoolExecutor(max_workers=4)
+
+ERROR_MESSAGE = "**There was an error, please try again later.**"
+
+
+def priming_calls() -> List[PrimingCall]:
+    """
+    The calls a turn makes, with valid parameters, for priming the clients during init.
+    """
+    table_name = os.getenv("CONTEXT_TABLE_NAME") or "priming"
+    key = {"PK": {"S": "priming"}, "SK": {"N": "0"}}
+    return [
+        (
+            bedrock_agent_runtime,
+            "retrieve",
+            {
+                "retrievalQuery": {"text": "priming"},
+                "knowledgeBaseId": os.getenv("KNOWLEDGE_BASE_ID") or "PRIMING000",
+                "retrievalConfiguration": {"vectorSearchConfiguration": {"numberOfResults": 1}},
+            },
+        ),
+        (
+            bedrock_client,
+            "invoke_model_with_response_stream",
+            {"modelId": model_tiers()[STRONG_TIER] or "priming", "body": b"{}"},
+        ),
+        (apigatewaymanagementapi_client, "post_to_connection", {"Data": b"", "ConnectionId": "priming"}),
+        (
+            dynamodb_client,
+            "query",
+            {
+                "TableName": table_name,
+                "KeyConditionExpression": "PK = :pk",
+                "ExpressionAttributeValues": {":pk": key["PK"]},
+            },
+        ),
+        (dynamodb_client, "get_item", {"TableName": table_name, "Key": key}),
+        (dynamodb_client, "put_item", {"TableName": table_name, "Item": key}),
+        (
+            dynamodb_client,
+            "update_item",
+            {"TableName": table_name, "Key": key, "UpdateExpression": "REMOVE priming"},
+        ),
+        (
+            lambda_client,
+            "invoke",
+            {
+                "FunctionName": os.getenv("COMPACTION_FUNCTION_NAME") or "priming",
+                "InvocationType": "Event",
+                "Payload": b"{}",
+            },
+        ),
+    ]
+
+
+# Moves the first-call cost of every client (service models, endpoint resolution, credentials,
+# signing) from the first request into init, which SnapStart snapshots and provisioned
+# concurrency runs ahead of traffic
+def warm_analytics_pool() -> None:
+    """
+    Opens the first reader connection of the analytics pool and loads the schema catalog, ahead
+    of the first analytic question.
+    """
+    if os.getenv("ANALYTICS_ENABLED") != "true":
+        return
+    try:
+        with analytics.reader_connection() as connection:
+            schema_catalog.load_catalog(
+                connection,
+                dynamodb_client,
+                os.getenv("CONTEXT_TABLE_NAME"),
+                os.getenv("ANALYTICS_SCHEMA", "public"),
+            )
+    except Exception as e:
+        # The first analytic question tries again
+        logger.warning(f"Unable to connect to the analytics reader: {e}")
+
+
+def release_connections() -> None:
+    """
+    Closes the clients' and the analytics pool's connections, so that environments restored
+    from a SnapStart snapshot open their own rather than reuse the snapshot's.
+    """
+    close_connections(
+        [
+            bedrock_client,
+            bedrock_agent_runtime,
+            apigatewaymanagementapi_client,
+            dynamodb_client,
+            lambda_client,
+        ]
+    )
+    analytics.close_pool()
+
+
+if os.getenv("PRIME_ON_INIT", "false") == "true":
+    priming_timings = prime_clients(priming_calls())
+    logger.info(
+        "Primed AWS clients",
+        extra={"priming_ms": {name: round(ms, 1) for name, ms in priming_timings.items()}},
+    )
+    if not snap_start_init():
+        warm_analytics_pool()
+if snap_start_init():
+    # The database secret and connection are only fetched after restore, never snapshotted
+    register_runtime_hooks(
+        before_snapshot=release_connections,
+        after_restore=warm_analytics_pool
+        if os.getenv("PRIME_ON_INIT", "false") == "true"
+        else None,
+    )
+
 
 def vector_db_retrieve(query, kbId, numberOfResults=5):
     response = bedrock_agent_runtime.retrieve(
@@ -27,109 +170,690 @@ def vector_db_retrieve(query, kbId, numberOfResults=5):
     return response
 
 
-def handler(event: List[Dict[str, Any]], context: Any) -> str:
+def normalize_retrieval_results(response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts a retrieve response produced by the state machine's SDK integration, which uses
+    PascalCase keys, into the shape boto3 returns.
+    - response: The retrieve response with a "RetrievalResults" list.
+    """
+    results = []
+    for result in response["RetrievalResults"]:
+        location = result.get("Location", {})
+        results.append(
+            {
+                "content": {"text": result["Content"]["Text"]},
+                "location": {
+                    "type": location.get("Type"),
+                    "s3Location": {"uri": location.get("S3Location", {}).get("Uri")},
+                },
+                "score": result.get("Score"),
+                "metadata": result.get("Metadata", {}),
+            }
+        )
+    return {"retrievalResults": results}
+
+
+@metrics.log_metrics
+@tracer.capture_lambda_handler(capture_response=False)
+@logger.inject_lambda_context
+def handler(event: List[Dict[str, Any]], context: Any) -> Dict[str, str]:
     """
     The main handler function for processing incoming events.
     - event: The event dictionary containing data and context from the triggering source.
     - context: Provides information about the invocation, function, and execution environment.
+
+    Returns the history record attributes the state machine writes back to the context table.
+    In the "direct" deployment mode the function is invoked straight from the WebSocket route
+    and reads and writes the history itself.
+    """
+    if os.getenv("DEPLOYMENT_MODE") == "direct":
+        try:
+            answer_question(event, direct=True)
+        except Exception:
+            logger.exception("Unable to answer question")
+            # There is no state machine to warn the user, so do it here
+            apigatewaymanagementapi_client.post_to_connection(
+                Data=ERROR_MESSAGE, ConnectionId=event["ConnectionID"]
+            )
+            raise
+        return {"statusCode": 200}
+    return answer_question(event, direct=False)
+
+
+def answer_question(event: Dict[str, Any], direct: bool) -> Dict[str, str]:
+    """
+    Answers a single question, streaming the response to the WebSocket connection.
+    - event: Contains the message data, ConnectionID and timestamp of the request.
+    - direct: Whether history has to be fetched and stored here rather than by the state machine.
     """
 
-    # Initialize a variable to accumulate the full response text
-    full_response = ""
+    turn_metrics = TurnMetrics()
 
     # Retrieve necessary configurations from environment variables
     # These are set in the Lambda function's configuration and are essential for the operation
-    model_id = os.getenv("BEDROCK_MODEL_ID")
     anthropic_version = os.getenv("ANTHROPIC_VERSION")
     max_tokens = os.getenv("MAX_TOKENS")
     knowledge_base_id = os.getenv("KNOWLEDGE_BASE_ID")
+    history_ttl_seconds = int(os.getenv("HISTORY_TTL_SECONDS", "604800"))
+
+    question = event["data"]["message"]
+    connection_id = event["ConnectionID"]
+
+    if (
+        event["data"].get("mode") == analytics.ANALYTICS_MODE
+        and os.getenv("ANALYTICS_ENABLED") == "true"
+    ):
+        return answer_analytic_question(event, direct, turn_metrics)
+
+    # History and retrieval are independent, so in direct mode fetch them concurrently
+    if direct:
+        history_future = executor.submit(fetch_history_records, connection_id)
+
+    # Extract search results and process them for context, unless the state machine
+    # already retrieved them alongside the history
+    prefetched = event.get("retrievalResults") or {}
+    if "RetrievalResults" in prefetched:
+        vector_db_context = normalize_retrieval_results(prefetched)
+        metrics.add_metric(name="RetrievalPrefetched", unit=MetricUnit.Count, value=1)
+    else:
+        with tracer.provider.in_subsegment("## retrieval"):
+            retrieval_started_at = time.perf_counter()
+            vector_db_context = vector_db_retrieve(
+                question, knowledge_base_id, numberOfResults=depth_settings()["fetch_results"]
+            )
+            turn_metrics.add_duration("RetrievalLatency", retrieval_started_at)
 
-    # Extract historical conversation records for context
+    # Keep only the results that stand out from the rest, and none if nothing matches well
+    vector_db_context, depth = adapt_results(vector_db_context)
+    metrics.add_metric(name="RetrievalDocuments", unit=MetricUnit.Count, value=depth["kept"])
+    metrics.add_metric(
+        name=f"RetrievalCut{depth['reason'].capitalize()}", unit=MetricUnit.Count, value=1
+    )
+
+    # Extract historical conversation records and the rolling summary for context
     history = []
+    summary = ""
     try:
-        history = get_history_from_records(event["contentResults"][0]["Items"])
+        if direct:
+            records = history_future.result()
+        else:
+            records = event["contentResults"]["Items"]
+        history = get_history_from_records(records)
+        summary = get_summary_from_records(records)
     except Exception as e:
         pass
 
+    # An identical question that is already being answered is not generated again: this
+    # request follows the leader's stream instead
+    flight = join_request_flight(question, history, summary, connection_id)
+    full_response = None
+    decision = {"tier": None, "model_id": None, "reason": "coalesced"}
+    if flight is not None and flight["role"] == "follower":
+        full_response = follow_request_flight(flight, connection_id, turn_metrics)
+
+    if full_response is None:
+        writer = None
+        if flight is not None and flight["role"] == "leader":
+            writer = FlightWriter(
+                dynamodb_client,
+                os.getenv("CONTEXT_TABLE_NAME"),
+                flight,
+                flush_ms=int(os.getenv("COALESCING_FLUSH_MS", "100")),
+            )
+
+        # Keep only the sentences of the retrieved chunks that bear on the question
+        compression_started_at = time.perf_counter()
+        prompt_docs, compression = compress_docs(question, vector_db_context)
+        if compression["chars_after"] < compression["chars_before"]:
+            turn_metrics.add_duration("ContextCompressionLatency", compression_started_at)
+            metrics.add_metric(
+                name="ContextCharsRemoved",
+                unit=MetricUnit.Count,
+                value=compression["chars_before"] - compression["chars_after"],
+            )
+
+        # Prepare the request body for the Bedrock AI model invocation
+        system_prompt = generate_system_prompt(prompt_docs, history, summary)
+        turn_metrics.add_prompt(system_prompt)
+        body = json.dumps(
+            {
+                "anthropic_version": anthropic_version,
+                "max_tokens": int(max_tokens),
+                "system": system_prompt,
+                "messages": [{"role": "user", "content": question}],
+            }
+        )
+
+        # Route the request to a model tier, then invoke it and process the streaming response
+        decision = route_request(question, vector_db_context, history, summary)
+        metrics.add_metric(
+            name=f"RoutedTo{decision['tier'].capitalize()}", unit=MetricUnit.Count, value=1
+        )
+        with tracer.provider.in_subsegment("## generation"):
+            try:
+                full_response, decision = stream_answer(
+                    body, decision, connection_id, turn_metrics, writer.write if writer else None
+                )
+            except Exception:
+                if writer:
+                    writer.finish(error=True)
+                raise
+            tracer.put_annotation(key="model_tier", value=decision["tier"])
+            tracer.put_annotation(key="routing_reason", value=decision["reason"])
+        if writer:
+            writer.finish()
+    values = turn_metrics.publish(full_response)
+    log_turn(
+        full_response,
+        dict(
+            values,
+            model_id=decision["model_id"],
+            model_tier=decision["tier"],
+            routing=decision,
+            retrieval=depth,
+        ),
+    )
+    # Return the compressed question and full response text after processing all chunks,
+    # along with the epoch second at which DynamoDB may expire the history item
+    record = {
+        "question": encode_text_b64(question),
+        "answer": encode_text_b64(full_response),
+        "expires_at": str(int(time.time()) + history_ttl_seconds),
+    }
+    if direct:
+        # The answer has already been delivered, so this is off the user's critical path
+        save_history(connection_id, event["timestamp"], record)
+    return record
+
+
+def answer_analytic_question(
+    event: Dict[str, Any], direct: bool, turn_metrics: TurnMetrics
+) -> Dict[str, str]:
+    """
+    Answers a question about the analytics database: the model writes a query, which runs on
+    a pooled, read-only connection to the reader endpoint, and the result is streamed to the
+    WebSocket connection as a Markdown table, or as NDJSON frames if the request asks for the
+    analytics.STREAM_FORMAT format.
+    - event: Contains the message data, ConnectionID and timestamp of the request.
+    - direct: Whether history has to be stored here rather than by the state machine.
+    - turn_metrics: Records stream and post_to_connection timings.
+    """
     question = event["data"]["message"]
     connection_id = event["ConnectionID"]
+    stream = event["data"].get("format") == analytics.STREAM_FORMAT
+    if stream:
+        max_rows = int(os.getenv("ANALYTICS_STREAM_MAX_ROWS", "100000"))
+    else:
+        max_rows = int(os.getenv("ANALYTICS_MAX_ROWS", "500"))
+    model_id = model_tiers()[STRONG_TIER]
+    answer = []
+    # Where the result came from, see result_cache.lookup, and how the query was run
+    cached = {"source": None}
+
+    def post(text: str) -> None:
+        post_text(connection_id, text, turn_metrics, answer.append)
 
-    # Extract search results and process them for context
-    vector_db_context = vector_db_retrieve(
-        question, knowledge_base_id, numberOfResults=10
+    # Once stream_result runs, its frames end the NDJSON stream whatever happens
+    ndjson_started = False
+
+    def close_ndjson(message: str) -> None:
+        if stream and not ndjson_started:
+            frame = analytics.ndjson_header(0, "error", message=message, rows=0)
+            post_frame(connection_id, frame, turn_metrics)
+
+    with tracer.provider.in_subsegment("## analytics"):
+        with analytics.reader_connection() as connection:
+            catalog, catalog_source = schema_catalog.load_catalog(
+                connection,
+                dynamodb_client,
+                os.getenv("CONTEXT_TABLE_NAME"),
+                os.getenv("ANALYTICS_SCHEMA", "public"),
+            )
+            schema = schema_catalog.schema_context(catalog, question)
+            metrics.add_metric(name="SchemaContextChars", unit=MetricUnit.Count, value=len(schema))
+            generation_started_at = time.perf_counter()
+            sql = analytics.generate_sql(
+                bedrock_client, model_id, os.getenv("ANTHROPIC_VERSION"), question, schema, max_rows
+            )
+            turn_metrics.add_duration("SqlGenerationLatency", generation_started_at)
+            result, guard = None, {}
+            try:
+                if not sql:
+                    post("I'm sorry, I don't know. The data does not cover this question.")
+                    close_ndjson("The data does not cover this question.")
+                else:
+                    sql = analytics.read_only_sql(sql)
+                    post(f"```sql\n{sql}\n```\n\n")
+                    if not stream:
+                        cached = result_cache.lookup(
+                            connection,
+                            dynamodb_client,
+                            os.getenv("CONTEXT_TABLE_NAME"),
+                            catalog,
+                            sql,
+                            max_rows,
+                        )
+                        result = cached.get("result")
+                    if result is None:
+                        guard = query_guard.guard_query(connection, sql, max_rows)
+                        if guard["rewritten"]:
+                            metrics.add_metric(
+                                name="AnalyticsQueryRewrites", unit=MetricUnit.Count, value=1
+                            )
+                    if stream:
+                        # Too large to cache or keep: the rows are only posted
+                        ndjson_started = True
+                        streamed = stream_result(
+                            connection_id, connection, guard["sql"], max_rows, turn_metrics
+                        )
+                        metrics.add_metric(
+                            name="AnalyticsStreamLatency",
+                            unit=MetricUnit.Milliseconds,
+                            value=streamed["stream_ms"],
+                        )
+                        metrics.add_metric(
+                            name="AnalyticsRows", unit=MetricUnit.Count, value=streamed["rows"]
+                        )
+                        answer.append(f"_Streamed {streamed['rows']} rows._\n")
+                        if streamed["type"] == "error":
+                            post(f"The result could not be streamed: {streamed['message']}")
+                    elif result is None:
+                        result = analytics.run_query(connection, guard["sql"], max_rows)
+                        result_cache.store(
+                            dynamodb_client, os.getenv("CONTEXT_TABLE_NAME"), cached, result
+                        )
+            except (
+                analytics.UnsafeQueryError,
+                query_guard.QueryBudgetError,
+                analytics.psycopg2.Error,
+            ) as e:
+                close_ndjson(str(e).strip())
+                if connection.closed:
+                    raise
+                if isinstance(e, query_guard.QueryBudgetError):
+                    metrics.add_metric(
+                        name="AnalyticsQueryBudgetRejections", unit=MetricUnit.Count, value=1
+                    )
+                # A query the model got wrong, or that timed out, is an answer rather than a
+                # failure of the function
+                logger.warning(f"Unable to run generated query: {e}", extra={"sql": sql})
+                metrics.add_metric(name="AnalyticsQueryErrors", unit=MetricUnit.Count, value=1)
+                connection.rollback()
+                post(f"The query could not be run: {str(e).strip()}")
+    if result is not None:
+        if cached["source"] in ("memory", "shared"):
+            # The average is the hit ratio; the saving is what the query took when it ran
+            metrics.add_metric(name="AnalyticsResultCacheHit", unit=MetricUnit.Count, value=1)
+            metrics.add_metric(
+                name="AnalyticsQueryTimeSaved", unit=MetricUnit.Milliseconds, value=result["query_ms"]
+            )
+        else:
+            if cached["source"] == "miss":
+                metrics.add_metric(name="AnalyticsResultCacheHit", unit=MetricUnit.Count, value=0)
+            metrics.add_metric(
+                name="AnalyticsQueryLatency", unit=MetricUnit.Milliseconds, value=result["query_ms"]
+            )
+        metrics.add_metric(name="AnalyticsRows", unit=MetricUnit.Count, value=len(result["rows"]))
+        for text in analytics.format_results(
+            result, int(os.getenv("ANALYTICS_ROWS_PER_FRAME", "50"))
+        ):
+            post(text)
+    post_frame(connection_id, "[[END]]", turn_metrics)
+
+    full_response = "".join(answer)
+    values = turn_metrics.publish(full_response)
+    log_turn(
+        full_response,
+        dict(
+            values,
+            model_id=model_id,
+            mode=analytics.ANALYTICS_MODE,
+            sql=sql,
+            catalog_source=catalog_source,
+            result_source=cached["source"],
+            query_class=guard.get("class"),
+            estimated_cost=guard.get("cost"),
+            rewritten=guard.get("rewritten"),
+            schema_chars=len(schema),
+        ),
     )
+    record = {
+        "question": encode_text_b64(question),
+        "answer": encode_text_b64(full_response),
+        "expires_at": str(
+            int(time.time()) + int(os.getenv("HISTORY_TTL_SECONDS", "604800"))
+        ),
+    }
+    if direct:
+        save_history(connection_id, event["timestamp"], record)
+    return record
+
+
+def join_request_flight(
+    question: str, history: List[Dict[str, str]], summary: str, connection_id: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Joins the flight of identical in-flight requests, as its leader or as a follower. Returns
+    None when coalescing is disabled or unavailable, in which case the request is answered alone.
+    - question: The user's question.
+    - history: The past Q&A pairs included in the prompt.
+    - summary: The rolling summary of earlier turns.
+    - connection_id: The ID used for the connection in API Gateway.
+    """
+    if os.getenv("COALESCING_ENABLED", "false") != "true":
+        return None
+    try:
+        return join_flight(
+            dynamodb_client,
+            os.getenv("CONTEXT_TABLE_NAME"),
+            flight_key(question, history, summary),
+            connection_id,
+            lease_seconds=int(os.getenv("COALESCING_LEASE_SECONDS", "150")),
+        )
+    except Exception as e:
+        logger.warning(f"Unable to join a request flight: {e}")
+        return None
 
-    # Prepare the request body for the Bedrock AI model invocation
-    body = json.dumps(
-        {
-            "anthropic_version": anthropic_version,
-            "max_tokens": int(max_tokens),
-            "system": generate_system_prompt(vector_db_context, history),
-            "messages": [{"role": "user", "content": question}],
-        }
+
+def follow_request_flight(
+    flight: Dict[str, Any], connection_id: str, turn_metrics: TurnMetrics
+) -> Optional[str]:
+    """
+    Forwards the leader's answer to this request's connection as it is written.
+    - flight: The flight returned by join_request_flight.
+    - connection_id: The ID used for the connection in API Gateway.
+    - turn_metrics: Records post_to_connection timings.
+
+    Returns the full answer, or None if the leader failed before any of it was forwarded.
+    """
+    full_response = follow_flight(
+        dynamodb_client,
+        os.getenv("CONTEXT_TABLE_NAME"),
+        flight,
+        lambda text: post_frame(connection_id, text, turn_metrics),
+        poll_ms=int(os.getenv("COALESCING_POLL_MS", "100")),
+        stall_seconds=float(os.getenv("COALESCING_STALL_SECONDS", "15")),
     )
+    if full_response is None:
+        logger.warning("The request flight failed, answering without it")
+        metrics.add_metric(name="CoalescingFallbacks", unit=MetricUnit.Count, value=1)
+        return None
+    post_frame(connection_id, "[[END]]", turn_metrics)
+    metrics.add_metric(name="RequestsCoalesced", unit=MetricUnit.Count, value=1)
+    return full_response
 
-    # Invoke the Bedrock AI model and process the streaming response
+
+def stream_answer(
+    body: str,
+    decision: Dict[str, Any],
+    connection_id: str,
+    turn_metrics: TurnMetrics,
+    on_text: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Streams the answer of the routed model tier to the connection. A fast-tier request that
+    cannot be started, or whose answer opens with a refusal, is escalated to the strong tier
+    before anything has been posted.
+    - body: The model request body.
+    - decision: The routing decision from route_request.
+    - connection_id: The ID used for the connection in API Gateway.
+    - turn_metrics: Records stream and post_to_connection timings.
+    - on_text: Called with the text of every frame posted to the connection.
+
+    Returns the full response and the decision that produced it.
+    """
+    if decision["tier"] == FAST_TIER:
+        probe_chars = int(os.getenv("ROUTING_ESCALATION_PROBE_CHARS", "40"))
+        # With nothing to answer from, a refusal is the expected answer, and the strong tier
+        # would have nothing more to go on
+        if decision["reason"] == "no_context":
+            probe_chars = 0
+        full_response = None
+        try:
+            turn_metrics.model_invoked_at = time.perf_counter()
+            response = bedrock_client.invoke_model_with_response_stream(
+                body=body, modelId=decision["model_id"]
+            )
+        except ClientError as e:
+            # Throttling or an unavailable model; only safe to retry because nothing was posted
+            logger.warning(f"Unable to invoke the fast tier, escalating: {e}")
+        else:
+            full_response = process_response(
+                response, connection_id, "", turn_metrics, probe_chars, on_text
+            )
+        if full_response is not None:
+            return full_response, decision
+        metrics.add_metric(name="RoutingEscalations", unit=MetricUnit.Count, value=1)
+        decision = dict(
+            decision,
+            tier=STRONG_TIER,
+            model_id=model_tiers()[STRONG_TIER],
+            escalated_from=decision["reason"],
+        )
+        turn_metrics.restart_stream()
+
+    turn_metrics.model_invoked_at = time.perf_counter()
     response = bedrock_client.invoke_model_with_response_stream(
-        body=body, modelId=model_id
+        body=body, modelId=decision["model_id"]
     )
-    full_response = process_response(response, connection_id, full_response)
-    print(f"FULL RESPONSE: {full_response}")
-    # Return the full response text after processing all chunks
-    return full_response
+    return process_response(response, connection_id, "", turn_metrics, 0, on_text), decision
+
+
+def fetch_history_records(connection_id: str) -> List[Dict[str, Any]]:
+    """
+    Runs the same bounded, newest-first history query as the "Fetch history" state.
+    - connection_id: The ID used for the connection in API Gateway.
+    """
+    response = dynamodb_client.query(
+        TableName=os.getenv("CONTEXT_TABLE_NAME"),
+        KeyConditionExpression="PK = :pk",
+        ExpressionAttributeValues={":pk": {"S": connection_id}},
+        ExpressionAttributeNames={
+            "#question": "question",
+            "#answer": "answer",
+            "#summary": "summary",
+        },
+        ProjectionExpression="#question, #answer, #summary",
+        ScanIndexForward=False,
+        Limit=int(os.getenv("HISTORY_LIMIT", "5")),
+    )
+    return response["Items"]
+
+
+def save_history(connection_id: str, timestamp: str, record: Dict[str, str]) -> None:
+    """
+    Does the work of the "Update history" and "Compact history" states: stores the turn,
+    then kicks off compaction asynchronously.
+    - connection_id: The ID used for the connection in API Gateway.
+    - timestamp: The request time in epoch milliseconds, used as the sort key.
+    - record: The history record attributes returned by answer_question.
+    """
+    dynamodb_client.put_item(
+        TableName=os.getenv("CONTEXT_TABLE_NAME"),
+        Item={
+            "PK": {"S": connection_id},
+            "SK": {"N": timestamp},
+            # boto3 expects raw bytes for binary attributes
+            "question": {"B": base64.b64decode(record["question"])},
+            "answer": {"B": base64.b64decode(record["answer"])},
+            "expires_at": {"N": record["expires_at"]},
+        },
+    )
+    # Compaction must see the new turn, so it is only started once the put has finished
+    try:
+        lambda_client.invoke(
+            FunctionName=os.getenv("COMPACTION_FUNCTION_NAME"),
+            InvocationType="Event",
+            Payload=json.dumps({"ConnectionID": connection_id}),
+        )
+    except Exception as e:
+        logger.warning(f"Unable to start history compaction: {e}")
 
 
 def process_response(
-    response: Dict[str, Any], connection_id: str, full_response: str
-) -> str:
+    response: Dict[str, Any],
+    connection_id: str,
+    full_response: str,
+    turn_metrics: Optional[TurnMetrics] = None,
+    probe_chars: int = 0,
+    on_text: Optional[Callable[[str], None]] = None,
+) -> Optional[str]:
     """
     Processes the streaming response from the Bedrock AI model invocation.
     - response: The response object from the model invocation.
     - connection_id: The ID used for the connection in API Gateway.
     - full_response: The accumulated full response text.
+    - turn_metrics: Records stream and post_to_connection timings.
+    - probe_chars: Holds back the first probe_chars characters of the answer. If they show the
+      model should be escalated, the stream is abandoned and None is returned with nothing posted.
+    - on_text: Called with the text of every frame posted to the connection.
     """
+    turn_metrics = turn_metrics or TurnMetrics()
+    held = []
+
     # Iterate through the response events
     for event in response.get("body"):
+        turn_metrics.model_event()
         chunk = json.loads(event["chunk"]["bytes"])
 
         # Check for message completion indicator
         if chunk["type"] == "message_delta":
+            turn_metrics.output_tokens = chunk.get("usage", {}).get("output_tokens")
+            if probe_chars:
+                # The whole answer was shorter than the probe
+                if should_escalate(full_response):
+                    return None
+                if held:
+                    post_text(connection_id, "".join(held), turn_metrics, on_text)
+                held, probe_chars = [], 0
             # Signal the end of the message to the API Gateway
-            apigatewaymanagementapi_client.post_to_connection(
-                Data="[[END]]", ConnectionId=connection_id
-            )
+            post_frame(connection_id, "[[END]]", turn_metrics)
 
         # Check for text content and append it to the full response
         if (
             chunk["type"] == "content_block_delta"
             and chunk["delta"]["type"] == "text_delta"
         ):
-            # Send the text chunk to the API Gateway and accumulate it
-            apigatewaymanagementapi_client.post_to_connection(
-                Data=chunk["delta"]["text"], ConnectionId=connection_id
-            )
+            turn_metrics.token()
             full_response += chunk["delta"]["text"]
+            if probe_chars:
+                held.append(chunk["delta"]["text"])
+                if len(full_response) < probe_chars:
+                    continue
+                if should_escalate(full_response):
+                    close_stream(response)
+                    return None
+                # The answer is going ahead, so release what was held back as one frame
+                post_text(connection_id, "".join(held), turn_metrics, on_text)
+                held, probe_chars = [], 0
+                continue
+            # Send the text chunk to the API Gateway
+            post_text(connection_id, chunk["delta"]["text"], turn_metrics, on_text)
     return full_response
 
 
+def post_frame(connection_id: str, data: str, turn_metrics: TurnMetrics) -> None:
+    """
+    Posts a frame to the WebSocket connection and records how long that took.
+    - connection_id: The ID used for the connection in API Gateway.
+    - data: The frame contents.
+    - turn_metrics: Records post_to_connection timings.
+    """
+    posted_at = time.perf_counter()
+    apigatewaymanagementapi_client.post_to_connection(Data=data, ConnectionId=connection_id)
+    turn_metrics.frame_posted(posted_at)
+
+
+def stream_result(
+    connection_id: str,
+    connection: Any,
+    sql: str,
+    max_rows: int,
+    turn_metrics: TurnMetrics,
+) -> Dict[str, Any]:
+    """
+    Streams a query's rows to the WebSocket connection as NDJSON frames, see
+    analytics.ndjson_frames. Rows are read through a server-side cursor and posted batch by
+    batch, so memory stays flat whatever the size of the result.
+    - connection_id: The ID used for the connection in API Gateway.
+    - connection: A reader connection, inside the transaction the query runs in.
+    - sql: A query checked by analytics.read_only_sql and query_guard.guard_query.
+    - max_rows: The most rows sent.
+    - turn_metrics: Records post_to_connection timings.
+
+    Returns the header of the last frame, "end" with the rows sent, whether they were truncated
+    and how many were too large to send, or "error" if the result could not be streamed, and
+    how long streaming took. An error while reading the rows is raised after its error frame
+    was posted.
+    """
+    started_at = time.perf_counter()
+    batches = analytics.stream_batches(
+        connection, sql, int(os.getenv("ANALYTICS_STREAM_BATCH_ROWS", "1000"))
+    )
+    with closing(batches):
+        for frame in analytics.ndjson_frames(
+            batches,
+            max_rows,
+            int(os.getenv("ANALYTICS_STREAM_FRAME_BYTES", "32000")),
+            int(os.getenv("ANALYTICS_STREAM_MAX_CELL_BYTES", "1000")),
+        ):
+            post_frame(connection_id, frame, turn_metrics)
+    end = json.loads(frame.split("\n", 1)[0])
+    end["stream_ms"] = (time.perf_counter() - started_at) * 1000
+    return end
+
+
+def post_text(
+    connection_id: str,
+    text: str,
+    turn_metrics: TurnMetrics,
+    on_text: Optional[Callable[[str], None]],
+) -> None:
+    """
+    Posts a frame of answer text and passes it on, for example to the request flight.
+    - connection_id: The ID used for the connection in API Gateway.
+    - text: The answer text.
+    - turn_metrics: Records post_to_connection timings.
+    - on_text: Called with the text after it was posted.
+    """
+    post_frame(connection_id, text, turn_metrics)
+    if on_text is not None:
+        on_text(text)
+
+
+def close_stream(response: Dict[str, Any]) -> None:
+    """
+    Closes an abandoned model response stream so its connection is released.
+    - response: The response object from the model invocation.
+    """
+    close = getattr(response.get("body"), "close", None)
+    if close is not None:
+        close()
+
+
 def generate_system_prompt(
-    docs: List[Dict[str, Any]], history: List[Dict[str, str]]
+    docs: List[Dict[str, Any]], history: List[Dict[str, str]], summary: str = ""
 ) -> str:
     """
     Generates a prompt for the AI model to guide its response generation.
     - docs: A list of documents from Kendra for context.
     - history: A list of past Q&A pairs for context.
+    - summary: The rolling summary of turns older than the history.
     """
     # Construct the system prompt with context and instructions for the AI model
     system_prompt = "For this query, please prioritize the context I will give and try to ground your response as much as possible in just that information including links where possible. Minimizing pulling from other background knowledge unless absolutely necessary. The context provided will be in the form of docs provided on the topic and a history of question and answers. If you don't know the answer, say 'I'm sorry, I don't know'. Return all answers in markdown."
 
     # Add documents to the prompt for additional context
-    if docs:
+    if docs and docs.get("retrievalResults"):
         system_prompt += "\n\n<docs>\n"
         for doc in docs["retrievalResults"]:
             system_prompt += f"<doc>\n<title>{doc['location']['s3Location']['uri']}</title>\n<content>{doc['content']['text']}</content>\n<link>{doc['location']['s3Location']['uri']}</link>\n</doc>"
         system_prompt += "\n<docs>"
 
+    # Add the summary of earlier turns ahead of the recent history
+    if summary:
+        system_prompt += f"\n\n<summary>\n{summary}\n</summary>"
+
     # Add conversation history to the prompt for contextual grounding
     if history:
         system_prompt += "\n\n<history>\n"
@@ -143,12 +867,25 @@ def generate_system_prompt(
 def get_history_from_records(records: List[Dict[str, Any]]) -> List[Dict[str, str]]:
     """
     Extracts and formats the conversation history from DynamoDB records.
-    - records: The list of records from DynamoDB representing past interactions.
+    - records: The list of records from DynamoDB representing past interactions, newest first.
     """
-    # Compile a list of past Q&A pairs from the records
+    # Compile a list of past Q&A pairs from the records, oldest first
     history = []
-    for record in records:
-        question = record["question"]["S"]
-        answer = record["answer"]["S"]
+    for record in reversed(records):
+        if "question" not in record or "answer" not in record:
+            continue
+        question = decode_attribute(record["question"])
+        answer = decode_attribute(record["answer"])
         history.append({"question": question, "answer": answer})
     return history
+
+
+def get_summary_from_records(records: List[Dict[str, Any]]) -> str:
+    """
+    Extracts the rolling summary of earlier turns, if the session has been compacted.
+    - records: The list of records from DynamoDB representing past interactions, newest first.
+    """
+    for record in records:
+        if "summary" in record:
+            return decode_attribute(record["summary"])
+    return ""
@@ -0,0 +1,178 @@
+# Import necessary libraries
+import heapq
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Set, Tuple
+
+# Text extracted from PDFs runs headings and fields together without sentence ends, so
+# stretches longer than MAX_UNIT_WORDS words are cut into overlapping windows. The overlap
+# keeps a phrase such as a date whole in at least one window.
+MAX_UNIT_WORDS = 40
+UNIT_OVERLAP_WORDS = 10
+SENTENCE_START = re.compile(r"[\"'(\[]?[A-Z0-9]")
+# Marks where sentences were left out of a chunk
+GAP = " … "
+# A question word already covered by a kept sentence counts for this much less each time,
+# so repeated boilerplate such as a page footer naming the program does not fill the budget
+COVERED_DECAY = 0.3
+
+TOKEN = re.compile(r"[a-z0-9]+(?:[-,][0-9]+)*")
+
+# Words that never decide which sentence answers a question
+STOP_WORDS = {
+    "a", "about", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "has", "have", "how", "i", "in", "is", "it", "its", "kind", "may", "of", "on",
+    "one", "or", "that", "the", "this", "to", "what", "when", "which", "who", "will", "with",
+}
+
+# Question cues and the pattern of the text that answers them. A sentence of the expected
+# shape ranks above one that only shares words with the question.
+MONTHS = r"(?:January|February|March|April|May|June|July|August|September|October|November|December)"
+ANSWER_SHAPES = (
+    (("when", "deadline", "due", "date"), re.compile(rf"\b{MONTHS}\s+\d{{1,2}}(?:,\s*\d{{4}})?")),
+    (("much", "funding", "budget", "amount", "cost"), re.compile(r"\$\s?\d[\d,.]*")),
+    (("many", "number", "limit"), re.compile(r"\b\d+\b")),
+)
+ANSWER_SHAPE_BOOST = 1.5
+
+
+def stem(word: str) -> str:
+    """
+    Reduces a word to a crude stem, so "proposals" matches "proposal".
+    - word: A lowercase word.
+    """
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def terms(text: str) -> Set[str]:
+    """
+    Returns the stems of the words in a question or sentence.
+    - text: The text to split.
+    """
+    return {stem(w) for w in TOKEN.findall(text.lower()) if w not in STOP_WORDS}
+
+
+def split_units(words: List[str]) -> List[Tuple[int, int]]:
+    """
+    Splits a chunk into sentences, and sentences longer than MAX_UNIT_WORDS words into
+    overlapping windows.
+    - words: The chunk's words.
+
+    Returns the start and end word index of every unit.
+    """
+    sentences, start = [], 0
+    for i in range(1, len(words)):
+        if words[i - 1][-1] in ".!?" and SENTENCE_START.match(words[i]):
+            sentences.append((start, i))
+            start = i
+    if words:
+        sentences.append((start, len(words)))
+    units = []
+    step = MAX_UNIT_WORDS - UNIT_OVERLAP_WORDS
+    for start, end in sentences:
+        units.append((start, min(end, start + MAX_UNIT_WORDS)))
+        for window in range(start + step, end - UNIT_OVERLAP_WORDS, step):
+            units.append((window, min(end, window + MAX_UNIT_WORDS)))
+    return units
+
+
+def compress_docs(question: str, docs: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """
+    Keeps only the sentences of the retrieved chunks that best match the question, up to
+    CONTEXT_COMPRESSION_RATIO of their text. Sentences are scored by the question words they
+    contain, each weighted by how rare it is among the retrieved sentences and by how often
+    kept sentences already cover it; one of the shape a question cue expects, such as a date
+    for "when", counts for more. Every chunk keeps at least one sentence, so every source and
+    link stays in the prompt, and kept sentences stay in their order.
+    - question: The user's question.
+    - docs: The retrieve response used as context.
+
+    Returns the response with the chunks' text replaced, and the characters before and after.
+    """
+    results = (docs or {}).get("retrievalResults", [])
+    before = sum(len(r["content"]["text"]) for r in results)
+    question_terms = terms(question)
+    ratio = float(os.getenv("CONTEXT_COMPRESSION_RATIO", "0.35"))
+    if (
+        not 0 < ratio < 1
+        or before < int(os.getenv("CONTEXT_COMPRESSION_MIN_CHARS", "1500"))
+        or not question_terms
+    ):
+        return docs, {"chars_before": before, "chars_after": before}
+
+    words = [r["content"]["text"].split() for r in results]
+    # The question words in each word of the chunks, looked up once per distinct word
+    word_matches: Dict[str, Set[str]] = {}
+    units, matched = [], []
+    for i, chunk_words in enumerate(words):
+        chunk_matches = []
+        for word in chunk_words:
+            if word not in word_matches:
+                word_matches[word] = terms(word) & question_terms
+            chunk_matches.append(word_matches[word])
+        for start, end in split_units(chunk_words):
+            units.append((i, start, end, " ".join(chunk_words[start:end])))
+            matched.append(set().union(*chunk_matches[start:end]))
+    frequencies = Counter(t for unit_terms in matched for t in unit_terms)
+    weights = {t: math.log(1 + len(units) / f) for t, f in frequencies.items()}
+    cues = set(TOKEN.findall(question.lower()))
+    shapes = [pattern for shape_cues, pattern in ANSWER_SHAPES if cues.intersection(shape_cues)]
+    boosts = [
+        ANSWER_SHAPE_BOOST if any(pattern.search(text) for pattern in shapes) else 1.0
+        for _, _, _, text in units
+    ]
+
+    kept = [[False] * len(chunk_words) for chunk_words in words]
+    covered = Counter()
+    size, budget = 0, ratio * before
+
+    def keep(u: int) -> None:
+        nonlocal size
+        i, start, end, _ = units[u]
+        for k in range(start, end):
+            if not kept[i][k]:
+                kept[i][k] = True
+                size += len(words[i][k]) + 1
+        covered.update(matched[u])
+
+    def gain(u: int) -> float:
+        return boosts[u] * sum(weights[t] * COVERED_DECAY ** covered[t] for t in matched[u])
+
+    # Gains only shrink as sentences are kept, so a popped gain that is still at least the
+    # next stale one is the best; the earlier chunk and sentence win a tie
+    candidates = [(-gain(u), u) for u in range(len(units)) if matched[u]]
+    heapq.heapify(candidates)
+    while candidates:
+        _, best = heapq.heappop(candidates)
+        current = gain(best)
+        if candidates and (-current, best) > candidates[0]:
+            heapq.heappush(candidates, (-current, best))
+            continue
+        i, start, end, _ = units[best]
+        added = sum(len(words[i][k]) + 1 for k in range(start, end) if not kept[i][k])
+        if size + added <= budget:
+            keep(best)
+    for i, chunk_words in enumerate(words):
+        if chunk_words and not any(kept[i]):
+            keep(max((u for u in range(len(units)) if units[u][0] == i), key=lambda u: (gain(u), -u)))
+
+    compressed = []
+    for result, chunk_words, chunk_kept in zip(results, words, kept):
+        runs, run = [], []
+        for word, keep_word in zip(chunk_words, chunk_kept):
+            if keep_word:
+                run.append(word)
+            elif run:
+                runs.append(" ".join(run))
+                run = []
+        if run:
+            runs.append(" ".join(run))
+        compressed.append(dict(result, content=dict(result["content"], text=GAP.join(runs))))
+    after = sum(len(r["content"]["text"]) for r in compressed)
+    return dict(docs, retrievalResults=compressed), {"chars_before": before, "chars_after": after}
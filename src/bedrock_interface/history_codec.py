@@ -0,0 +1,58 @@
+# Import necessary libraries
+import base64
+import zlib
+from typing import Any, Dict
+
+# Every binary history attribute starts with one of these version tags so the
+# encoding can change later without rewriting existing items
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+
+COMPRESSION_LEVEL = 6
+
+
+def encode_text(text: str) -> bytes:
+    """
+    Encodes history text as a tagged binary value, compressing it when that makes it smaller.
+    - text: The question, answer or summary text.
+    """
+    raw = text.encode("utf-8")
+    compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+    if len(compressed) < len(raw):
+        return bytes([CODEC_ZLIB]) + compressed
+    return bytes([CODEC_RAW]) + raw
+
+
+def encode_text_b64(text: str) -> str:
+    """
+    Encodes history text for a DynamoDB "B" attribute written by the state machine.
+    - text: The question, answer or summary text.
+    """
+    return base64.b64encode(encode_text(text)).decode("ascii")
+
+
+def decode_text(value: bytes) -> str:
+    """
+    Decodes a tagged binary value produced by encode_text.
+    - value: The tagged bytes.
+    """
+    codec, payload = value[0], value[1:]
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload).decode("utf-8")
+    if codec == CODEC_RAW:
+        return payload.decode("utf-8")
+    raise ValueError(f"Unknown history codec {codec}")
+
+
+def decode_attribute(attribute: Dict[str, Any]) -> str:
+    """
+    Reads a history attribute in DynamoDB JSON, accepting plain strings from items written
+    before compression and binary values from boto3 (bytes) or Step Functions (base64).
+    - attribute: The attribute value, e.g. {"S": "..."} or {"B": b"..."}.
+    """
+    if "S" in attribute:
+        return attribute["S"]
+    value = attribute["B"]
+    if isinstance(value, str):
+        value = base64.b64decode(value)
+    return decode_text(value)
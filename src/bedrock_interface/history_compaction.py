@@ -0,0 +1,183 @@
+# Import necessary libraries
+import json
+import boto3
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from history_codec import decode_attribute, encode_text
+from telemetry import estimate_tokens
+
+# The rolling summary lives under the same PK as the raw turns. Its sort key is
+# larger than any millisecond timestamp, so the newest-first history query always
+# returns it as the first item of the window.
+SUMMARY_SK = 9999999999999
+
+# Initialize AWS clients for DynamoDB and Bedrock
+dynamodb_client = boto3.client("dynamodb")
+bedrock_client = boto3.client("bedrock-runtime")
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Compacts the conversation history of a single connection. Invoked asynchronously
+    by the state machine after "Update history", so it never delays an answer.
+    - event: Contains the ConnectionID whose history should be compacted.
+    - context: Provides information about the invocation, function, and execution environment.
+    """
+    return compact_session(
+        table_name=os.getenv("CONTEXT_TABLE_NAME"),
+        connection_id=event["ConnectionID"],
+        summarize=bedrock_summarize,
+        token_threshold=int(os.getenv("COMPACTION_TOKEN_THRESHOLD", "6000")),
+        max_turns=int(os.getenv("COMPACTION_MAX_TURNS", "4")),
+        keep_turns=int(os.getenv("COMPACTION_KEEP_TURNS", "2")),
+        ttl_seconds=int(os.getenv("HISTORY_TTL_SECONDS", "604800")),
+    )
+
+
+def compact_session(
+    table_name: str,
+    connection_id: str,
+    summarize: Callable[[str, List[Dict[str, str]]], str],
+    token_threshold: int,
+    max_turns: int,
+    keep_turns: int,
+    ttl_seconds: int,
+) -> Dict[str, Any]:
+    """
+    Folds the oldest turns of a session into the rolling summary item once the raw
+    turns exceed the token threshold or no longer fit the history window.
+    - table_name: The context table name.
+    - connection_id: The partition key of the session.
+    - summarize: Called with the previous summary and the turns to fold, returns the new summary.
+    - token_threshold: Estimated raw-turn tokens above which the session is compacted.
+    - max_turns: Raw turns allowed before compacting, normally the history window minus the summary.
+    - keep_turns: Newest raw turns that are never folded.
+    - ttl_seconds: Lifetime of the summary item.
+    """
+    summary_item, items = load_session(table_name, connection_id)
+    turns = [
+        {
+            "SK": item["SK"]["N"],
+            "question": decode_attribute(item["question"]),
+            "answer": decode_attribute(item["answer"]),
+        }
+        for item in items
+    ]
+    raw_tokens = sum(
+        estimate_tokens(t["question"]) + estimate_tokens(t["answer"]) for t in turns
+    )
+    if raw_tokens <= token_threshold and len(turns) <= max_turns:
+        return {"compacted": False, "turns": len(turns), "raw_tokens": raw_tokens}
+
+    # Turns are oldest first; fold everything except the newest keep_turns
+    folded = turns[: max(len(turns) - keep_turns, 0)]
+    if not folded:
+        return {"compacted": False, "turns": len(turns), "raw_tokens": raw_tokens}
+
+    previous_summary = decode_attribute(summary_item["summary"]) if summary_item else ""
+    version = int(summary_item["version"]["N"]) if summary_item else 0
+    summary = summarize(
+        previous_summary,
+        [{"question": t["question"], "answer": t["answer"]} for t in folded],
+    )
+
+    # Guard against a concurrent compaction of the same session overwriting this one
+    try:
+        dynamodb_client.put_item(
+            TableName=table_name,
+            Item={
+                "PK": {"S": connection_id},
+                "SK": {"N": str(SUMMARY_SK)},
+                "summary": {"B": encode_text(summary)},
+                "version": {"N": str(version + 1)},
+                "covers_through": {"N": folded[-1]["SK"]},
+                "expires_at": {"N": str(int(time.time()) + ttl_seconds)},
+            },
+            ConditionExpression="attribute_not_exists(SK) OR version = :version",
+            ExpressionAttributeValues={":version": {"N": str(version)}},
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return {"compacted": False, "turns": len(turns), "raw_tokens": raw_tokens}
+
+    delete_turns(table_name, connection_id, folded)
+    return {
+        "compacted": True,
+        "folded": len(folded),
+        "turns": len(turns) - len(folded),
+        "raw_tokens": raw_tokens,
+        "summary_tokens": estimate_tokens(summary),
+    }
+
+
+def load_session(
+    table_name: str, connection_id: str
+) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Reads every item of a session, returning the summary item (if any) and the raw turns oldest first.
+    - table_name: The context table name.
+    - connection_id: The partition key of the session.
+    """
+    summary_item = None
+    turns = []
+    paginator = dynamodb_client.get_paginator("query")
+    for page in paginator.paginate(
+        TableName=table_name,
+        KeyConditionExpression="PK = :pk",
+        ExpressionAttributeValues={":pk": {"S": connection_id}},
+        ConsistentRead=True,
+    ):
+        for item in page["Items"]:
+            if int(item["SK"]["N"]) == SUMMARY_SK:
+                summary_item = item
+            elif "question" in item and "answer" in item:
+                turns.append(item)
+    return summary_item, turns
+
+
+def delete_turns(
+    table_name: str, connection_id: str, turns: List[Dict[str, Any]]
+) -> None:
+    """
+    Deletes turns that are now covered by the summary, 25 at a time.
+    - table_name: The context table name.
+    - connection_id: The partition key of the session.
+    - turns: The folded turns, each carrying its sort key.
+    """
+    requests = [
+        {"DeleteRequest": {"Key": {"PK": {"S": connection_id}, "SK": {"N": t["SK"]}}}}
+        for t in turns
+    ]
+    for i in range(0, len(requests), 25):
+        pending = {table_name: requests[i : i + 25]}
+        while pending:
+            response = dynamodb_client.batch_write_item(RequestItems=pending)
+            pending = response.get("UnprocessedItems")
+
+
+def bedrock_summarize(previous_summary: str, turns: List[Dict[str, str]]) -> str:
+    """
+    Produces the new rolling summary with a Bedrock model.
+    - previous_summary: The summary folded so far, possibly empty.
+    - turns: The Q&A pairs to fold into it, oldest first.
+    """
+    conversation = ""
+    if previous_summary:
+        conversation += f"<summary>{previous_summary}</summary>\n"
+    for t in turns:
+        conversation += f"<item>\n<question>{t['question']}</question>\n<answer>{t['answer']}</answer>\n</item>\n"
+
+    body = json.dumps(
+        {
+            "anthropic_version": os.getenv("ANTHROPIC_VERSION"),
+            "max_tokens": int(os.getenv("SUMMARY_MAX_TOKENS", "1000")),
+            "system": "Summarize the conversation below into a single concise summary that replaces it. Fold the existing summary in, if there is one. Keep every fact the user may refer back to: solicitation numbers, deadlines, amounts, names and links. Do not add information that is not in the conversation.",
+            "messages": [{"role": "user", "content": conversation}],
+        }
+    )
+    response = bedrock_client.invoke_model(
+        body=body, modelId=os.getenv("SUMMARY_MODEL_ID")
+    )
+    result = json.loads(response["body"].read())
+    return "".join(c["text"] for c in result["content"] if c["type"] == "text")
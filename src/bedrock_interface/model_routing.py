@@ -0,0 +1,124 @@
+# Import necessary libraries
+import os
+from typing import Any, Dict, List
+
+FAST_TIER = "fast"
+STRONG_TIER = "strong"
+
+# Words that usually mean the answer has to be reasoned out rather than looked up
+ANALYTIC_CUES = (
+    "compare",
+    "comparison",
+    "difference",
+    "differences",
+    "explain",
+    "why",
+    "strategy",
+    "plan",
+    "recommend",
+    "evaluate",
+    "pros",
+    "tradeoff",
+    "trade-off",
+)
+
+# The answer the system prompt asks for when the context does not cover the question
+REFUSAL_PREFIX = "i'm sorry, i don't know"
+
+
+def model_tiers() -> Dict[str, str]:
+    """
+    Returns the configured model ID of each tier. Without FAST_MODEL_ID every request goes to
+    the strong tier, which falls back to BEDROCK_MODEL_ID.
+    """
+    strong = os.getenv("STRONG_MODEL_ID") or os.getenv("BEDROCK_MODEL_ID")
+    return {FAST_TIER: os.getenv("FAST_MODEL_ID") or strong, STRONG_TIER: strong}
+
+
+def routing_features(
+    question: str,
+    docs: Dict[str, Any],
+    history: List[Dict[str, str]],
+    summary: str,
+) -> Dict[str, Any]:
+    """
+    Computes the cheap, local features a routing decision is based on.
+    - question: The user's question.
+    - docs: The retrieve response used as context.
+    - history: The past Q&A pairs included in the prompt.
+    - summary: The rolling summary of earlier turns.
+    """
+    scores = sorted(
+        (r.get("score") or 0.0 for r in (docs or {}).get("retrievalResults", [])),
+        reverse=True,
+    )
+    top_score = scores[0] if scores else 0.0
+    words = [w.strip("?,.!:;\"'()").lower() for w in question.split()]
+    return {
+        "question_words": len(words),
+        "analytic_cues": sum(1 for w in words if w in ANALYTIC_CUES),
+        "documents": len(scores),
+        "top_score": top_score,
+        # Many documents scoring close to the best one means the answer is spread across them.
+        # Close is a fraction of the best score, so it holds on any score scale.
+        "close_documents": sum(
+            1
+            for s in scores
+            if top_score - s <= float(os.getenv("ROUTING_CLOSE_RELATIVE_DELTA", "0.05")) * top_score
+        ),
+        "history_turns": len(history),
+        "has_summary": bool(summary),
+    }
+
+
+def route_request(
+    question: str,
+    docs: Dict[str, Any],
+    history: List[Dict[str, str]],
+    summary: str = "",
+) -> Dict[str, Any]:
+    """
+    Picks the model tier for a request. Short questions with a confident retrieval match and
+    little conversation behind them go to the fast tier, as do new conversations with nothing
+    retrieved, and everything else to the strong tier.
+    - question: The user's question.
+    - docs: The retrieve response used as context.
+    - history: The past Q&A pairs included in the prompt.
+    - summary: The rolling summary of earlier turns.
+
+    Returns the tier, its model ID, the reason for the choice and the features.
+    """
+    tiers = model_tiers()
+    features = routing_features(question, docs, history, summary)
+
+    if tiers[FAST_TIER] == tiers[STRONG_TIER]:
+        reason = "single_tier"
+    elif not features["documents"] and not features["history_turns"] and not features["has_summary"]:
+        # Nothing retrieved passed the score floor, so the answer is a quick "I don't know"
+        return {"tier": FAST_TIER, "model_id": tiers[FAST_TIER], "reason": "no_context", "features": features}
+    elif features["question_words"] > int(os.getenv("ROUTING_MAX_FAST_QUESTION_WORDS", "30")):
+        reason = "long_question"
+    elif features["analytic_cues"]:
+        reason = "analytic_question"
+    # Scores are on the scale of the vector store, so like the retrieval floor this is off
+    # until calibrated
+    elif features["top_score"] < float(os.getenv("ROUTING_MIN_FAST_TOP_SCORE", "0")):
+        reason = "weak_retrieval"
+    elif features["close_documents"] > int(os.getenv("ROUTING_MAX_FAST_CLOSE_DOCUMENTS", "4")):
+        reason = "spread_retrieval"
+    elif features["has_summary"] or features["history_turns"] > int(
+        os.getenv("ROUTING_MAX_FAST_HISTORY_TURNS", "2")
+    ):
+        reason = "long_conversation"
+    else:
+        return {"tier": FAST_TIER, "model_id": tiers[FAST_TIER], "reason": "simple_lookup", "features": features}
+    return {"tier": STRONG_TIER, "model_id": tiers[STRONG_TIER], "reason": reason, "features": features}
+
+
+def should_escalate(answer_prefix: str) -> bool:
+    """
+    Whether the start of a fast-tier answer shows it could not answer, so the strong tier
+    should be asked instead.
+    - answer_prefix: The first characters of the answer, before any were posted.
+    """
+    return answer_prefix.strip().lower().replace("’", "'").startswith(REFUSAL_PREFIX)
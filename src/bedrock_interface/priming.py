@@ -0,0 +1,111 @@
+# Import necessary libraries
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from botocore.awsrequest import AWSResponse
+
+try:
+    # Part of the Lambda Python runtime, for SnapStart runtime hooks
+    from snapshot_restore_py import register_after_restore, register_before_snapshot
+except ImportError:
+    register_before_snapshot = register_after_restore = None
+
+# A client, one of its operations and valid parameters for it
+PrimingCall = Tuple[Any, str, Dict[str, Any]]
+
+
+class _EmptyBody:
+    """The body of the responses the priming calls get instead of going to the network."""
+
+    def stream(self, **kwargs: Any) -> Iterator[bytes]:
+        yield b"{}"
+
+
+def _short_circuit(request: Any, **kwargs: Any) -> AWSResponse:
+    # Returning a response from before-send stops botocore from sending the request
+    return AWSResponse(request.url, 200, {}, _EmptyBody())
+
+
+@contextmanager
+def _untraced() -> Iterator[None]:
+    # Outside an invocation there is no X-Ray segment to record the calls in
+    try:
+        from aws_xray_sdk import global_sdk_config
+    except ImportError:
+        yield
+        return
+    enabled = global_sdk_config.sdk_enabled()
+    global_sdk_config.set_sdk_enabled(False)
+    try:
+        yield
+    finally:
+        global_sdk_config.set_sdk_enabled(enabled)
+
+
+def prime_clients(calls: List[PrimingCall]) -> Dict[str, float]:
+    """
+    Runs each call through its client without sending it. This loads the service model and
+    the shapes of the operation, resolves the endpoint, loads the credentials and signs the
+    request, which the first real call would otherwise pay for. No connection is opened, so
+    the result is safe to keep in a SnapStart snapshot.
+    - calls: The calls to prime, see PrimingCall.
+
+    Returns the milliseconds each call took, keyed by "<service>.<operation>".
+    """
+    timings = {}
+    with _untraced():
+        for client, operation, params in calls:
+            name = f"{client.meta.service_model.service_name}.{operation}"
+            events = client.meta.events
+            events.register_first("before-send", _short_circuit, unique_id="priming")
+            started_at = time.perf_counter()
+            try:
+                getattr(client, operation)(**params)
+            except Exception:
+                # The empty response may not parse as the operation's output; the request
+                # path was exercised all the same
+                pass
+            finally:
+                events.unregister("before-send", unique_id="priming")
+            timings[name] = (time.perf_counter() - started_at) * 1000
+    return timings
+
+
+def close_connections(clients: List[Any]) -> None:
+    """
+    Closes the pooled connections of the clients. The clients stay usable and open new
+    connections on their next call, so a restored snapshot never reuses a dead socket.
+    - clients: The boto3 clients.
+    """
+    for client in clients:
+        client.close()
+
+
+def snap_start_init() -> bool:
+    """
+    Whether this init phase runs ahead of a SnapStart snapshot, rather than on demand or for
+    provisioned concurrency.
+    """
+    return os.getenv("AWS_LAMBDA_INITIALIZATION_TYPE") == "snap-start"
+
+
+def register_runtime_hooks(
+    before_snapshot: Optional[Callable[[], None]] = None,
+    after_restore: Optional[Callable[[], None]] = None,
+) -> bool:
+    """
+    Registers SnapStart runtime hooks. Outside the Lambda runtime the hooks are not registered.
+    - before_snapshot: Called once before the snapshot is taken, during deployment.
+    - after_restore: Called in every execution environment restored from the snapshot.
+
+    Returns whether the hooks were registered.
+    """
+    if register_before_snapshot is None:
+        return False
+    if before_snapshot:
+        register_before_snapshot(before_snapshot)
+    if after_restore:
+        register_after_restore(after_restore)
+    return True
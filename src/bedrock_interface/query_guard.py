@@ -0,0 +1,84 @@
+# Import necessary libraries
+import json
+import os
+from typing import Any, Dict
+
+SMALL_QUERY = "small"
+LARGE_QUERY = "large"
+
+
+class QueryBudgetError(ValueError):
+    """A generated query whose estimated cost is over the budget."""
+
+
+def explain(connection: Any, sql: str) -> Dict[str, Any]:
+    """
+    Plans a query without running it.
+    - connection: A reader connection.
+    - sql: A query checked by analytics.read_only_sql.
+
+    Returns the planner's estimated total cost and result rows, and the type of the top node.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+        document = cursor.fetchone()[0]
+    # psycopg2 parses json columns, but the plan comes back as text from some poolers
+    if isinstance(document, str):
+        document = json.loads(document)
+    plan = document[0]["Plan"]
+    return {"cost": plan["Total Cost"], "rows": plan["Plan Rows"], "node": plan["Node Type"]}
+
+
+def limit_sql(sql: str, limit: int) -> str:
+    """
+    Wraps a query so the database stops after limit rows rather than producing them all.
+    - sql: A query checked by analytics.read_only_sql.
+    - limit: The most rows returned.
+    """
+    return f"SELECT * FROM (\n{sql}\n) AS limited LIMIT {int(limit)}"
+
+
+def guard_query(connection: Any, sql: str, max_rows: int) -> Dict[str, Any]:
+    """
+    Checks a query's plan against the budgets before it runs, and sets the statement timeout of
+    its class in the current transaction. A query estimated to return more than max_rows rows
+    is limited first, which often brings an unbounded join under the budget.
+    - connection: A reader connection, inside the transaction the query will run in.
+    - sql: A query checked by analytics.read_only_sql.
+    - max_rows: The most rows the answer shows.
+
+    Returns the query to run, its class, the estimates, whether it was limited and its timeout.
+    Raises QueryBudgetError if the query is over ANALYTICS_MAX_QUERY_COST.
+    """
+    plan = explain(connection, sql)
+    rewritten = False
+    if plan["rows"] > max_rows and plan["node"] != "Limit":
+        # One more than shown, so the answer can still say it was truncated
+        limited = limit_sql(sql, max_rows + 1)
+        limited_plan = explain(connection, limited)
+        if limited_plan["cost"] < plan["cost"]:
+            sql, plan, rewritten = limited, limited_plan, True
+
+    max_cost = float(os.getenv("ANALYTICS_MAX_QUERY_COST", "1000000"))
+    if plan["cost"] > max_cost:
+        raise QueryBudgetError(
+            f"The query is estimated to be too expensive: cost {plan['cost']:.0f} is over the"
+            f" budget of {max_cost:.0f}, for about {plan['rows']} rows. Try a narrower question."
+        )
+    # A small query running long means the estimate was wrong, so it is stopped sooner
+    if plan["cost"] <= float(os.getenv("ANALYTICS_SMALL_QUERY_COST", "10000")):
+        query_class = SMALL_QUERY
+        timeout_ms = int(os.getenv("ANALYTICS_SMALL_QUERY_TIMEOUT_MS", "1000"))
+    else:
+        query_class = LARGE_QUERY
+        timeout_ms = int(os.getenv("ANALYTICS_STATEMENT_TIMEOUT_MS", "5000"))
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+    return {
+        "sql": sql,
+        "class": query_class,
+        "cost": plan["cost"],
+        "rows": plan["rows"],
+        "rewritten": rewritten,
+        "timeout_ms": timeout_ms,
+    }
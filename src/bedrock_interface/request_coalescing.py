@@ -0,0 +1,237 @@
+# Import necessary libraries
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+# Flights share the context table with the conversation history. Connection IDs never
+# contain "#", so these partition keys cannot collide with a session.
+FLIGHT_PREFIX = "flight#"
+HEADER_SK = 0
+# Chunk sort keys are generation * SEQUENCE_SPAN + sequence, so a flight that is
+# reused later never mixes its chunks with an earlier generation's
+SEQUENCE_SPAN = 1_000_000
+# Flight items are only needed while the answer is streaming
+ITEM_TTL_SECONDS = 3600
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizes a question so trivially different phrasings share a flight.
+    - question: The user's question.
+    """
+    text = re.sub(r"\s+", " ", question.strip().lower())
+    return text.rstrip("?!. ")
+
+
+def flight_key(question: str, history: List[Dict[str, str]], summary: str) -> str:
+    """
+    Returns the flight partition key of a request. The history and summary are part of the key,
+    because the answer depends on them; in practice requests coalesce when they open a session.
+    - question: The user's question.
+    - history: The past Q&A pairs included in the prompt.
+    - summary: The rolling summary of earlier turns.
+    """
+    material = json.dumps([normalize_question(question), history, summary], sort_keys=True)
+    return FLIGHT_PREFIX + hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def join_flight(
+    dynamodb_client: Any,
+    table_name: str,
+    key: str,
+    connection_id: str,
+    lease_seconds: int,
+) -> Dict[str, Any]:
+    """
+    Becomes the leader of the flight if nobody holds its lease, otherwise joins it as a follower.
+    - dynamodb_client: The DynamoDB client.
+    - table_name: The context table name.
+    - key: The flight partition key from flight_key.
+    - connection_id: The connection of the request, recorded for debugging.
+    - lease_seconds: How long a leader may hold the flight without finishing it.
+
+    Returns the role ("leader" or "follower") and the flight generation.
+    """
+    now = int(time.time())
+    try:
+        response = dynamodb_client.update_item(
+            TableName=table_name,
+            Key={"PK": {"S": key}, "SK": {"N": str(HEADER_SK)}},
+            UpdateExpression=(
+                "SET generation = if_not_exists(generation, :zero) + :one, "
+                "lease_until = :lease_until, leader = :leader, expires_at = :expires_at"
+            ),
+            ConditionExpression="attribute_not_exists(PK) OR lease_until < :now",
+            ExpressionAttributeValues={
+                ":zero": {"N": "0"},
+                ":one": {"N": "1"},
+                ":now": {"N": str(now)},
+                ":lease_until": {"N": str(now + lease_seconds)},
+                ":leader": {"S": connection_id},
+                ":expires_at": {"N": str(now + ITEM_TTL_SECONDS)},
+            },
+            ReturnValues="ALL_NEW",
+        )
+        return {"role": "leader", "key": key, "generation": int(response["Attributes"]["generation"]["N"])}
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        header = dynamodb_client.get_item(
+            TableName=table_name,
+            Key={"PK": {"S": key}, "SK": {"N": str(HEADER_SK)}},
+            ConsistentRead=True,
+        )["Item"]
+        return {"role": "follower", "key": key, "generation": int(header["generation"]["N"])}
+
+
+class FlightWriter:
+    """
+    Streams the leader's answer into sequence-numbered chunk items. Text is batched for
+    flush_ms milliseconds, and the items are written in order on a background thread so the
+    leader's own stream is never slowed down by DynamoDB.
+    - dynamodb_client: The DynamoDB client.
+    - table_name: The context table name.
+    - flight: The flight returned by join_flight.
+    - flush_ms: The longest time text is held before it is written.
+    """
+
+    # Stays far below the 400 KB item size limit
+    MAX_CHUNK_CHARS = 16000
+
+    def __init__(self, dynamodb_client: Any, table_name: str, flight: Dict[str, Any], flush_ms: int):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.flight = flight
+        self.flush_ms = flush_ms
+        self.sequence = 0
+        self.buffer: List[str] = []
+        self.buffered_chars = 0
+        self.flushed_at = time.perf_counter()
+        self.failed = False
+        # One worker keeps the chunk writes in order
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def write(self, text: str) -> None:
+        """
+        Adds answer text to the flight.
+        - text: The text that was just posted to the leader's connection.
+        """
+        self.buffer.append(text)
+        self.buffered_chars += len(text)
+        if (
+            self.buffered_chars >= self.MAX_CHUNK_CHARS
+            or (time.perf_counter() - self.flushed_at) * 1000 >= self.flush_ms
+        ):
+            self._flush()
+
+    def finish(self, error: bool = False) -> None:
+        """
+        Writes the remaining text and the end (or error) marker, then releases the lease so the
+        next identical question starts a new flight.
+        - error: Whether the leader failed to produce a complete answer.
+        """
+        self._flush(end=not error, error=error)
+        self.pending.append(self.writer.submit(self._release))
+        for future in self.pending:
+            try:
+                future.result()
+            except Exception:
+                # Followers notice a broken flight through their stall timeout
+                self.failed = True
+        self.writer.shutdown(wait=False)
+
+    def _flush(self, end: bool = False, error: bool = False) -> None:
+        if not self.buffer and not end and not error:
+            return
+        self.sequence += 1
+        item = {
+            "PK": {"S": self.flight["key"]},
+            "SK": {"N": str(self.flight["generation"] * SEQUENCE_SPAN + self.sequence)},
+            "data": {"S": "".join(self.buffer)},
+            "expires_at": {"N": str(int(time.time()) + ITEM_TTL_SECONDS)},
+        }
+        if end:
+            item["end"] = {"BOOL": True}
+        if error:
+            item["error"] = {"BOOL": True}
+        self.buffer = []
+        self.buffered_chars = 0
+        self.flushed_at = time.perf_counter()
+        self.pending.append(
+            self.writer.submit(self.dynamodb_client.put_item, TableName=self.table_name, Item=item)
+        )
+
+    def _release(self) -> None:
+        self.dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key={"PK": {"S": self.flight["key"]}, "SK": {"N": str(HEADER_SK)}},
+            UpdateExpression="SET lease_until = :zero",
+            ConditionExpression="generation = :generation",
+            ExpressionAttributeValues={
+                ":zero": {"N": "0"},
+                ":generation": {"N": str(self.flight["generation"])},
+            },
+        )
+
+
+def follow_flight(
+    dynamodb_client: Any,
+    table_name: str,
+    flight: Dict[str, Any],
+    on_chunk: Callable[[str], None],
+    poll_ms: int,
+    stall_seconds: float,
+) -> Optional[str]:
+    """
+    Tails the leader's chunk items and hands each one to on_chunk, in order.
+    - dynamodb_client: The DynamoDB client.
+    - table_name: The context table name.
+    - flight: The flight returned by join_flight.
+    - on_chunk: Called with the text of every chunk, for example to post it to a connection.
+    - poll_ms: The delay between reads while waiting for the next chunk.
+    - stall_seconds: How long to wait for a new chunk before giving up on the leader.
+
+    Returns the full answer. Returns None if the leader failed or stalled before any text was
+    forwarded, so the caller can still answer on its own; raises RuntimeError if it failed later.
+    """
+    first_sk = flight["generation"] * SEQUENCE_SPAN + 1
+    last_sk = (flight["generation"] + 1) * SEQUENCE_SPAN - 1
+    next_sk = first_sk
+    answer = []
+    progressed_at = time.perf_counter()
+    while True:
+        query_args = {
+            "TableName": table_name,
+            "KeyConditionExpression": "PK = :pk AND SK BETWEEN :from AND :to",
+            "ExpressionAttributeValues": {
+                ":pk": {"S": flight["key"]},
+                ":from": {"N": str(next_sk)},
+                ":to": {"N": str(last_sk)},
+            },
+            # The chunks were just written by another invocation
+            "ConsistentRead": True,
+        }
+        items = dynamodb_client.query(**query_args)["Items"]
+        for item in items:
+            sk = int(item["SK"]["N"])
+            if sk != next_sk:
+                # A later chunk became visible before an earlier one; read again
+                break
+            next_sk += 1
+            progressed_at = time.perf_counter()
+            if item.get("error", {}).get("BOOL"):
+                if answer:
+                    raise RuntimeError("The coalesced request failed while streaming")
+                return None
+            if item["data"]["S"]:
+                answer.append(item["data"]["S"])
+                on_chunk(item["data"]["S"])
+            if item.get("end", {}).get("BOOL"):
+                return "".join(answer)
+        if time.perf_counter() - progressed_at > stall_seconds:
+            if answer:
+                raise RuntimeError("The coalesced request stalled while streaming")
+            return None
+        time.sleep(poll_ms / 1000)
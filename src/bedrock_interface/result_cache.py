@@ -0,0 +1,309 @@
+# Import necessary libraries
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from botocore.exceptions import ClientError
+
+from history_codec import decode_text, encode_text
+from telemetry import logger
+
+# Results share the context table with the conversation history, like request flights.
+# Connection IDs never contain "#", so these partition keys cannot collide with a session.
+RESULT_PREFIX = "result#"
+RESULT_SK = 0
+# Well below the DynamoDB item size limit
+MAX_ITEM_BYTES = 350_000
+
+# Installed and bumped by the loader, see src/lambda_loader/lambda_loader.py. A trigger on
+# every table bumps its version on any write, which invalidates the results that read it.
+VERSIONS_TABLE = "analytics_meta.table_versions"
+
+# Queries whose result changes without a write are never cached
+VOLATILE_SQL = re.compile(
+    r"\b(now|random|clock_timestamp|statement_timestamp|transaction_timestamp|timeofday|"
+    r"current_date|current_time|current_timestamp|localtime|localtimestamp|gen_random_uuid|"
+    r"txid_current)\b",
+    re.IGNORECASE,
+)
+
+SQL_TOKENS = re.compile(
+    r"(?P<literal>'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(?P<tag>\w*)\$.*?\$(?P=tag)\$)"
+    r"|(?P<comment>--[^\n]*|/\*.*?\*/)"
+    r"|(?P<space>\s+)"
+    r"|(?P<code>[^'\"$\s-]+|.)",
+    re.DOTALL,
+)
+
+# Column types an encoded result restores from their text form
+COLUMN_TYPES = (
+    ("decimal", decimal.Decimal),
+    ("datetime", datetime.datetime),
+    ("date", datetime.date),
+    ("time", datetime.time),
+)
+COLUMN_DECODERS = {
+    "decimal": decimal.Decimal,
+    "datetime": datetime.datetime.fromisoformat,
+    "date": datetime.date.fromisoformat,
+    "time": datetime.time.fromisoformat,
+}
+
+# Encoded results by cache key, least recently used first, kept across invocations
+_entries: "OrderedDict[str, Tuple[Dict[str, int], bytes]]" = OrderedDict()
+_entry_bytes = 0
+# Whether the database tracks table versions, remembered once it does
+_tracked = False
+# Error codes of the shared copy already logged, so a missing permission is logged once per container
+_logged_errors: Set[str] = set()
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Normalizes a query so that trivially different spellings share a cache entry: comments are
+    dropped, whitespace collapsed and unquoted text lowercased, which Postgres ignores anyway.
+    - sql: The query.
+    """
+    parts = []
+    for match in SQL_TOKENS.finditer(sql):
+        if match.group("literal"):
+            parts.append(match.group("literal"))
+        elif match.group("code"):
+            parts.append(match.group("code").lower())
+        elif parts and parts[-1] != " ":
+            parts.append(" ")
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def cache_key(sql: str, max_rows: int) -> str:
+    """
+    Returns the cache key of a query.
+    - sql: The query.
+    - max_rows: The row limit the result was fetched with.
+    """
+    material = json.dumps([normalize_sql(sql), max_rows])
+    return RESULT_PREFIX + hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def tables_read(catalog: Dict[str, Any], sql: str) -> List[str]:
+    """
+    Returns the catalog tables a query mentions, quoted or, for lowercase names, unquoted.
+    - catalog: The catalog from schema_catalog.load_catalog.
+    - sql: The query.
+    """
+    tables = []
+    for table in catalog["tables"]:
+        quoted = '"' + table.replace('"', '""') + '"'
+        if quoted in sql or (
+            table == table.lower() and re.search(rf"(?<![\w\"]){re.escape(table)}(?![\w\"])", sql, re.IGNORECASE)
+        ):
+            tables.append(table)
+    return tables
+
+
+def table_versions(connection: Any, schema: str, tables: List[str]) -> Optional[Dict[str, int]]:
+    """
+    Reads the current versions of tables.
+    - connection: A reader connection.
+    - schema: The schema of the tables.
+    - tables: The table names.
+
+    Returns the versions, or None if any of the tables is not tracked.
+    """
+    global _tracked
+    with connection.cursor() as cursor:
+        if not _tracked:
+            cursor.execute("SELECT to_regclass(%s)", (VERSIONS_TABLE,))
+            if cursor.fetchone()[0] is None:
+                return None
+            _tracked = True
+        cursor.execute(
+            f"SELECT table_name, version FROM {VERSIONS_TABLE} WHERE table_schema = %s AND table_name = ANY(%s)",
+            (schema, tables),
+        )
+        versions = dict(cursor.fetchall())
+    if set(versions) != set(tables):
+        return None
+    return versions
+
+
+def column_kind(column: Tuple[Any, ...]) -> str:
+    """
+    Returns how a result column is stored: "json" for values JSON holds as they are, a key of
+    COLUMN_DECODERS for types restored from text, and "text" for anything else.
+    - column: The column's values.
+    """
+    present = {type(v) for v in column if v is not None}
+    if present <= {int, float, str, bool}:
+        return "json"
+    for kind, value_type in COLUMN_TYPES:
+        if present == {value_type}:
+            return kind
+    # Rendered through str() either way, so the answer is the same
+    return "text"
+
+
+def encode_result(result: Dict[str, Any]) -> bytes:
+    """
+    Serializes a query result column by column, as compressed, compact JSON.
+    - result: The result from analytics.run_query.
+    """
+    columns = list(zip(*result["rows"])) if result["rows"] else [() for _ in result["columns"]]
+    kinds, values = [], []
+    for column in columns:
+        kind = column_kind(column)
+        kinds.append(kind)
+        if kind == "json":
+            values.append(list(column))
+        elif kind in ("decimal", "text"):
+            values.append([None if v is None else str(v) for v in column])
+        else:
+            values.append([None if v is None else v.isoformat() for v in column])
+    document = {
+        "columns": result["columns"],
+        "kinds": kinds,
+        "values": values,
+        "truncated": result["truncated"],
+        "query_ms": result["query_ms"],
+    }
+    return encode_text(json.dumps(document, separators=(",", ":"), ensure_ascii=False))
+
+
+def decode_result(value: bytes) -> Dict[str, Any]:
+    """
+    Reads a query result serialized by encode_result.
+    - value: The tagged bytes.
+    """
+    document = json.loads(decode_text(value))
+    columns = []
+    for kind, column in zip(document["kinds"], document["values"]):
+        decoder = COLUMN_DECODERS.get(kind)
+        columns.append([v if decoder is None or v is None else decoder(v) for v in column])
+    return {
+        "columns": document["columns"],
+        "rows": [tuple(row) for row in zip(*columns)],
+        "truncated": document["truncated"],
+        "query_ms": document["query_ms"],
+    }
+
+
+def remember(key: str, versions: Dict[str, int], encoded: bytes) -> None:
+    """
+    Keeps an encoded result in this container, evicting the least recently used ones beyond
+    ANALYTICS_RESULT_CACHE_BYTES.
+    - key: The cache key.
+    - versions: The table versions the result was read at.
+    - encoded: The result from encode_result.
+    """
+    global _entry_bytes
+    if key in _entries:
+        _entry_bytes -= len(_entries.pop(key)[1])
+    _entries[key] = (versions, encoded)
+    _entry_bytes += len(encoded)
+    limit = int(os.getenv("ANALYTICS_RESULT_CACHE_BYTES", str(16 * 1024 * 1024)))
+    while _entry_bytes > limit and _entries:
+        _entry_bytes -= len(_entries.popitem(last=False)[1][1])
+
+
+def log_shared_error(action: str, error: ClientError) -> None:
+    """
+    Logs why the shared copy in the context table could not be used, once per error code in a
+    container. Queries still run without it, but an AccessDeniedException needs fixing.
+    - action: What was attempted, "read" or "store".
+    - error: The error from DynamoDB.
+    """
+    code = error.response.get("Error", {}).get("Code", "Unknown")
+    if code not in _logged_errors:
+        _logged_errors.add(code)
+        logger.warning(f"Unable to {action} a shared query result: {error}", extra={"error_code": code})
+
+
+def lookup(
+    connection: Any,
+    dynamodb_client: Any,
+    table_name: Optional[str],
+    catalog: Dict[str, Any],
+    sql: str,
+    max_rows: int,
+) -> Dict[str, Any]:
+    """
+    Looks a query's result up in this container, then in the context table. An entry is only
+    used if every table the query reads is still at the version the result was read at.
+    - connection: A reader connection.
+    - dynamodb_client: The DynamoDB client.
+    - table_name: The context table name, or None to skip the shared copy.
+    - catalog: The catalog from schema_catalog.load_catalog.
+    - sql: A query checked by analytics.read_only_sql.
+    - max_rows: The row limit of the query.
+
+    Returns where the result came from ("memory", "shared", "miss" or "uncacheable"), the
+    result on a hit, and the key and versions that store needs on a miss.
+    """
+    tables = tables_read(catalog, sql)
+    if os.getenv("ANALYTICS_RESULT_CACHE", "true") == "false" or not tables or VOLATILE_SQL.search(sql):
+        return {"source": "uncacheable"}
+    versions = table_versions(connection, catalog["schema"], tables)
+    if versions is None:
+        return {"source": "uncacheable"}
+    key = cache_key(sql, max_rows)
+    entry = _entries.get(key)
+    if entry is not None and entry[0] == versions:
+        _entries.move_to_end(key)
+        return {"source": "memory", "result": decode_result(entry[1])}
+    if table_name:
+        try:
+            item = dynamodb_client.get_item(
+                TableName=table_name, Key={"PK": {"S": key}, "SK": {"N": str(RESULT_SK)}}
+            ).get("Item")
+            if (
+                item
+                and int(item["expires_at"]["N"]) > time.time()
+                and json.loads(item["versions"]["S"]) == versions
+            ):
+                remember(key, versions, item["result"]["B"])
+                return {"source": "shared", "result": decode_result(item["result"]["B"])}
+        except ClientError as e:
+            # Only a cache: the query can always be run
+            log_shared_error("read", e)
+    return {"source": "miss", "key": key, "versions": versions}
+
+
+def store(
+    dynamodb_client: Any,
+    table_name: Optional[str],
+    cached: Dict[str, Any],
+    result: Dict[str, Any],
+) -> None:
+    """
+    Stores a query result after a cache miss, in this container and in the context table.
+    - dynamodb_client: The DynamoDB client.
+    - table_name: The context table name, or None to skip the shared copy.
+    - cached: What lookup returned for the query.
+    - result: The result from analytics.run_query.
+    """
+    if cached["source"] != "miss":
+        return
+    encoded = encode_result(result)
+    remember(cached["key"], cached["versions"], encoded)
+    if table_name and len(encoded) <= MAX_ITEM_BYTES:
+        try:
+            dynamodb_client.put_item(
+                TableName=table_name,
+                Item={
+                    "PK": {"S": cached["key"]},
+                    "SK": {"N": str(RESULT_SK)},
+                    "versions": {"S": json.dumps(cached["versions"], sort_keys=True)},
+                    "result": {"B": encoded},
+                    "expires_at": {
+                        "N": str(int(time.time()) + int(os.getenv("ANALYTICS_RESULT_CACHE_TTL_SECONDS", "86400")))
+                    },
+                },
+            )
+        except ClientError as e:
+            log_shared_error("store", e)
@@ -0,0 +1,86 @@
+# Import necessary libraries
+import os
+from typing import Any, Dict, List, Tuple
+
+# Why the result list was cut where it was
+CUT_FLOOR = "floor"
+CUT_GAP = "gap"
+CUT_KNEE = "knee"
+CUT_MAX = "max"
+CUT_ALL = "all"
+CUT_UNSCORED = "unscored"
+CUT_EMPTY = "empty"
+
+
+def depth_settings() -> Dict[str, float]:
+    """
+    Returns the configured bounds and thresholds of adaptive retrieval. RETRIEVAL_FETCH_RESULTS
+    are fetched and at most RETRIEVAL_RESULTS of them kept, fewer where the scores drop; a
+    RETRIEVAL_MIN_RESULTS as large as RETRIEVAL_RESULTS keeps that many.
+    """
+    max_results = int(os.getenv("RETRIEVAL_RESULTS", "10"))
+    return {
+        "fetch_results": max(int(os.getenv("RETRIEVAL_FETCH_RESULTS", "20")), max_results),
+        "min_results": min(int(os.getenv("RETRIEVAL_MIN_RESULTS", "4")), max_results),
+        "max_results": max_results,
+        # Scores are on the scale of the vector store, so the floor is off until calibrated
+        "score_floor": float(os.getenv("RETRIEVAL_SCORE_FLOOR", "0")),
+        "relative_score": float(os.getenv("RETRIEVAL_RELATIVE_SCORE", "0.4")),
+        "score_gap": float(os.getenv("RETRIEVAL_SCORE_GAP", "0.15")),
+    }
+
+
+def cut_depth(scores: List[float], settings: Dict[str, float]) -> Tuple[int, str]:
+    """
+    Decides how many of the best results to keep, from their scores alone.
+    - scores: The results' scores, best first.
+    - settings: The bounds and thresholds, see depth_settings.
+
+    Returns the number of results to keep and why: nothing was retrieved, the best one is below
+    score_floor, a result fell below relative_score times the best one (the knee), the scores
+    dropped by score_gap times the best one (a gap), max_results was reached, or all results
+    were kept.
+    """
+    scores = scores[: settings["max_results"]]
+    if not scores:
+        return 0, CUT_EMPTY
+    # The floor only decides whether anything matches; below the best result the relative
+    # cuts decide
+    if scores[0] < settings["score_floor"]:
+        return 0, CUT_FLOOR
+    top = scores[0]
+    for k in range(min(settings["min_results"], len(scores)), len(scores)):
+        if settings["relative_score"] and scores[k] < settings["relative_score"] * top:
+            return k, CUT_KNEE
+        if settings["score_gap"] and scores[k - 1] - scores[k] >= settings["score_gap"] * top:
+            return k, CUT_GAP
+    if len(scores) == settings["max_results"]:
+        return len(scores), CUT_MAX
+    return len(scores), CUT_ALL
+
+
+def adapt_results(docs: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Cuts an over-fetched retrieve response down to the results that stand out, so a question
+    that matches one solicitation sharply gets a few documents and one that matches nothing
+    gets none.
+    - docs: The retrieve response, fetched with RETRIEVAL_FETCH_RESULTS results.
+
+    Returns the response with only the kept results, and the decision: results fetched and
+    kept, the reason, and the best score.
+    """
+    results = (docs or {}).get("retrievalResults", [])
+    settings = depth_settings()
+    if any(r.get("score") is None for r in results):
+        kept, reason = min(len(results), settings["max_results"]), CUT_UNSCORED
+        ranked = results
+    else:
+        ranked = sorted(results, key=lambda r: r["score"], reverse=True)
+        kept, reason = cut_depth([r["score"] for r in ranked], settings)
+    decision = {
+        "fetched": len(results),
+        "kept": kept,
+        "reason": reason,
+        "top_score": ranked[0].get("score") if ranked else None,
+    }
+    return dict(docs or {}, retrievalResults=ranked[:kept]), decision
@@ -0,0 +1,445 @@
+# Import necessary libraries
+import hashlib
+import json
+import os
+import re
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from botocore.exceptions import ClientError
+
+from history_codec import decode_text, encode_text
+from telemetry import logger
+
+# Catalogs share the context table with the conversation history, like request flights.
+# Connection IDs never contain "#", so these partition keys cannot collide with a session.
+CATALOG_PREFIX = "catalog#"
+CATALOG_SK = 0
+# Part of the version, so a change to what the catalog holds never reuses an old one
+CATALOG_FORMAT = 1
+# Items older than this are rebuilt, and old versions age out
+ITEM_TTL_SECONDS = 7 * 86400
+# Well below the DynamoDB item size limit
+MAX_ITEM_BYTES = 350_000
+
+TEXT_TYPES = ("text", "character varying", "character")
+TYPE_NAMES = {
+    "character varying": "varchar",
+    "character": "char",
+    "integer": "int",
+    "timestamp without time zone": "timestamp",
+    "timestamp with time zone": "timestamptz",
+    "double precision": "float8",
+}
+
+# Words that never decide which tables a question is about
+STOP_WORDS = {
+    "a", "all", "and", "any", "are", "by", "do", "does", "each", "every", "for", "from",
+    "has", "have", "how", "i", "id", "in", "is", "it", "its", "many", "me", "more", "most",
+    "much", "of", "on", "or", "per", "show", "than", "that", "the", "their", "there", "to",
+    "was", "were", "what", "which", "who", "whose", "with",
+}
+
+# Question words that point at a kind of column rather than at a name: (question stems,
+# column name stems, data type words). Names alone miss "sales" meaning a price column.
+COLUMN_CUES = (
+    (
+        {"sale", "revenue", "spent", "spend", "paid", "pay", "earn", "income", "cost", "price", "amount", "dollar"},
+        {"price", "total", "amount", "cost", "revenue"},
+        (),
+    ),
+    (
+        {"year", "month", "week", "day", "date", "when", "recent", "latest", "oldest", "quarter"},
+        set(),
+        ("date", "timestamp"),
+    ),
+    (
+        {"length", "long", "duration", "minute", "second", "hour"},
+        {"millisecond", "second", "duration", "length"},
+        ("interval",),
+    ),
+)
+
+# The catalog of the current schema version, kept across invocations
+_catalog: Dict[str, Any] = {}
+_checked_at = 0.0
+# Error codes of the shared copy already logged, so a missing permission is logged once per container
+_logged_errors: Set[str] = set()
+
+
+def stem(word: str) -> str:
+    """
+    Reduces a word to a crude stem, so "tracks" matches "Track" and "billed" matches "Billing".
+    - word: A lowercase word.
+    """
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        word = word[:-1]
+    for suffix in ("ing", "ed"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)]
+    return word
+
+
+def terms(text: str) -> Set[str]:
+    """
+    Returns the stems of the words in a question, value or identifier. Identifiers are split
+    at case changes and underscores, so "BillingCountry" gives "bill" and "country".
+    - text: The text to split.
+    """
+    words = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", text)
+    return {stem(w.lower()) for w in words if w.lower() not in STOP_WORDS}
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def schema_version(connection: Any, schema: str) -> str:
+    """
+    Fingerprints the tables, columns and constraints of a schema with one catalog query, so
+    the catalog is rebuilt as soon as the loader changes the schema.
+    - connection: A reader connection.
+    - schema: The schema the questions are about.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT md5(
+                string_agg(c.relname || '.' || a.attname || ' ' || format_type(a.atttypid, a.atttypmod),
+                           ',' ORDER BY c.relname, a.attnum)
+                || coalesce((SELECT string_agg(con.conname || ' ' || pg_get_constraintdef(con.oid),
+                                               ',' ORDER BY con.conname)
+                             FROM pg_constraint con WHERE con.connamespace = n.oid), ''))
+            FROM pg_namespace n
+            JOIN pg_class c ON c.relnamespace = n.oid AND c.relkind IN ('r', 'p', 'v', 'm')
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            WHERE n.nspname = %s
+            GROUP BY n.oid
+            """,
+            (schema,),
+        )
+        row = cursor.fetchone()
+    return f"{CATALOG_FORMAT}-{schema}-{row[0] if row else 'empty'}"
+
+
+def build_catalog(connection: Any, schema: str, version: str) -> Dict[str, Any]:
+    """
+    Introspects a schema: the columns and their types, primary and foreign keys, row counts,
+    and a few example values of each text column.
+    - connection: A reader connection.
+    - schema: The schema the questions are about.
+    - version: The schema_version the catalog is stored under.
+    """
+    tables: Dict[str, Dict[str, Any]] = {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT table_name, column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = %s
+            ORDER BY table_name, ordinal_position
+            """,
+            (schema,),
+        )
+        for table, column, data_type in cursor.fetchall():
+            entry = tables.setdefault(
+                table, {"rows": None, "columns": [], "primary_key": [], "foreign_keys": [], "samples": {}}
+            )
+            entry["columns"].append([column, data_type])
+
+        cursor.execute(
+            """
+            SELECT con.contype, cl.relname,
+                   array(SELECT a.attname FROM unnest(con.conkey) WITH ORDINALITY k(attnum, i)
+                         JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+                         ORDER BY k.i),
+                   ref.relname,
+                   array(SELECT a.attname FROM unnest(con.confkey) WITH ORDINALITY k(attnum, i)
+                         JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum
+                         ORDER BY k.i)
+            FROM pg_constraint con
+            JOIN pg_class cl ON cl.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = cl.relnamespace
+            LEFT JOIN pg_class ref ON ref.oid = con.confrelid
+            WHERE n.nspname = %s AND con.contype IN ('p', 'f')
+            ORDER BY con.conname
+            """,
+            (schema,),
+        )
+        for kind, table, columns, referenced_table, referenced_columns in cursor.fetchall():
+            if table not in tables:
+                continue
+            if kind == "p":
+                tables[table]["primary_key"] = list(columns)
+            else:
+                tables[table]["foreign_keys"].append(
+                    [list(columns), referenced_table, list(referenced_columns)]
+                )
+
+        # The planner's estimate, unless the table was never analyzed
+        cursor.execute(
+            """
+            SELECT c.relname, c.reltuples::bigint
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relkind IN ('r', 'p')
+            """,
+            (schema,),
+        )
+        for table, rows in cursor.fetchall():
+            if table in tables:
+                tables[table]["rows"] = rows if rows >= 0 else None
+
+        sample_rows = int(os.getenv("ANALYTICS_CATALOG_SAMPLE_ROWS", "100"))
+        samples = int(os.getenv("ANALYTICS_CATALOG_SAMPLES", "3"))
+        max_chars = int(os.getenv("ANALYTICS_CATALOG_SAMPLE_CHARS", "40"))
+        for table, entry in tables.items():
+            relation = f"{quote_identifier(schema)}.{quote_identifier(table)}"
+            if entry["rows"] is None:
+                cursor.execute(f"SELECT count(*) FROM {relation}")
+                entry["rows"] = cursor.fetchone()[0]
+            text_columns = [c for c, data_type in entry["columns"] if data_type in TEXT_TYPES]
+            if not text_columns or not samples:
+                continue
+            cursor.execute(
+                f"SELECT {', '.join(quote_identifier(c) for c in text_columns)} FROM {relation} LIMIT %s",
+                (sample_rows,),
+            )
+            rows = cursor.fetchall()
+            for i, column in enumerate(text_columns):
+                present = [row[i] for row in rows if row[i]]
+                # Values that repeat are categories worth showing; unique ones, such as
+                # addresses or phone numbers, are only kept for a table's single name column
+                if len(text_columns) > 1 and len(set(present)) == len(present):
+                    continue
+                values: List[str] = []
+                for value in present:
+                    if len(value) <= max_chars and value not in values:
+                        values.append(value)
+                        if len(values) == samples:
+                            break
+                if values:
+                    entry["samples"][column] = values
+    return {"version": version, "schema": schema, "tables": tables}
+
+
+def encode_catalog(catalog: Dict[str, Any]) -> bytes:
+    """
+    Serializes a catalog as compressed, compact JSON.
+    - catalog: The catalog from build_catalog.
+    """
+    return encode_text(json.dumps(catalog, separators=(",", ":"), ensure_ascii=False))
+
+
+def decode_catalog(value: bytes) -> Dict[str, Any]:
+    """
+    Reads a catalog serialized by encode_catalog.
+    - value: The tagged bytes.
+    """
+    return json.loads(decode_text(value))
+
+
+def log_shared_error(action: str, error: ClientError) -> None:
+    """
+    Logs why the shared copy in the context table could not be used, once per error code in a
+    container. The catalog still works without it, but every cold container then introspects
+    the database, so an AccessDeniedException needs fixing.
+    - action: What was attempted, "read" or "store".
+    - error: The error from DynamoDB.
+    """
+    code = error.response.get("Error", {}).get("Code", "Unknown")
+    if code not in _logged_errors:
+        _logged_errors.add(code)
+        logger.warning(f"Unable to {action} the shared schema catalog: {error}", extra={"error_code": code})
+
+
+def load_catalog(
+    connection: Any,
+    dynamodb_client: Any,
+    table_name: Optional[str],
+    schema: str,
+) -> Tuple[Dict[str, Any], str]:
+    """
+    Returns the catalog of the current schema version. The version is checked at most every
+    ANALYTICS_CATALOG_CHECK_SECONDS. A catalog is looked up in this container, then in the
+    context table, where the first container to build a version stores it for the others.
+    - connection: A reader connection.
+    - dynamodb_client: The DynamoDB client.
+    - table_name: The context table name, or None to skip the shared copy.
+    - schema: The schema the questions are about.
+
+    Returns the catalog and where it came from: "memory", "shared" or "database".
+    """
+    global _catalog, _checked_at
+    check_seconds = float(os.getenv("ANALYTICS_CATALOG_CHECK_SECONDS", "30"))
+    now = time.time()
+    if _catalog.get("schema") == schema and now - _checked_at < check_seconds:
+        return _catalog, "memory"
+    version = schema_version(connection, schema)
+    _checked_at = now
+    if _catalog.get("version") == version:
+        return _catalog, "memory"
+
+    key = {"PK": {"S": CATALOG_PREFIX + hashlib.sha256(version.encode("utf-8")).hexdigest()}, "SK": {"N": str(CATALOG_SK)}}
+    if table_name:
+        try:
+            item = dynamodb_client.get_item(TableName=table_name, Key=key).get("Item")
+            if item and int(item["expires_at"]["N"]) > now:
+                _catalog = decode_catalog(item["catalog"]["B"])
+                return _catalog, "shared"
+        except ClientError as e:
+            # Only a cache: the catalog can always be built from the database
+            log_shared_error("read", e)
+
+    _catalog = build_catalog(connection, schema, version)
+    encoded = encode_catalog(_catalog)
+    if table_name and len(encoded) <= MAX_ITEM_BYTES:
+        try:
+            dynamodb_client.put_item(
+                TableName=table_name,
+                Item=dict(
+                    key,
+                    catalog={"B": encoded},
+                    expires_at={"N": str(int(now) + ITEM_TTL_SECONDS)},
+                ),
+            )
+        except ClientError as e:
+            log_shared_error("store", e)
+    return _catalog, "database"
+
+
+def table_scores(catalog: Dict[str, Any], question: str) -> Dict[str, int]:
+    """
+    Scores each table by the question words found in its name, its columns and its example
+    values. Key columns are left out, since their names repeat the tables they point to.
+    - catalog: The catalog from load_catalog.
+    - question: The user's question.
+    """
+    question_terms = terms(question)
+    if re.search(r"\b(19|20)\d\d\b", question):
+        question_terms.add("year")
+    cues = [cue for cue in COLUMN_CUES if question_terms & cue[0]]
+    scores = {}
+    for table, entry in catalog["tables"].items():
+        keys = set(entry["primary_key"]) | {c for fk in entry["foreign_keys"] for c in fk[0]}
+        score = 3 * len(question_terms & terms(table))
+        for column, data_type in entry["columns"]:
+            if column in keys:
+                continue
+            column_terms = terms(column)
+            score += len(question_terms & column_terms)
+            score += sum(
+                1
+                for _, stems, types in cues
+                if column_terms & stems or any(t in data_type for t in types)
+            )
+            if any(question_terms & terms(value) for value in entry["samples"].get(column, [])):
+                score += 1
+        if score:
+            scores[table] = score
+    return scores
+
+
+def join_path(catalog: Dict[str, Any], start: str, end: str) -> List[str]:
+    """
+    Returns the tables on a shortest chain of foreign keys between two tables, both included.
+    - catalog: The catalog from load_catalog.
+    - start: The first table.
+    - end: The second table.
+    """
+    neighbours: Dict[str, Set[str]] = {table: set() for table in catalog["tables"]}
+    for table, entry in catalog["tables"].items():
+        for _, referenced_table, _ in entry["foreign_keys"]:
+            if referenced_table in neighbours:
+                neighbours[table].add(referenced_table)
+                neighbours[referenced_table].add(table)
+    previous = {start: None}
+    queue = deque([start])
+    while queue:
+        table = queue.popleft()
+        if table == end:
+            path = []
+            while table is not None:
+                path.append(table)
+                table = previous[table]
+            return path[::-1]
+        for neighbour in sorted(neighbours[table]):
+            if neighbour not in previous:
+                previous[neighbour] = table
+                queue.append(neighbour)
+    return []
+
+
+def relevant_tables(catalog: Dict[str, Any], question: str) -> Dict[str, str]:
+    """
+    Selects the tables a question needs. Tables matching the question are described in full;
+    tables that only join them are reduced to their keys.
+    - catalog: The catalog from load_catalog.
+    - question: The user's question.
+
+    Returns how each selected table is described, "full" or "keys", or every table in full
+    when nothing matches, so the model can still decide that the data does not cover it.
+    """
+    scores = table_scores(catalog, question)
+    if not scores:
+        return {table: "full" for table in catalog["tables"]}
+    max_tables = int(os.getenv("ANALYTICS_SCHEMA_MAX_TABLES", "8"))
+    matched = sorted(scores, key=lambda t: (-scores[t], t))[:max_tables]
+    selected = {table: "full" for table in matched}
+    for table in matched[1:]:
+        for step in join_path(catalog, matched[0], table):
+            selected.setdefault(step, "keys")
+    return selected
+
+
+def format_type(data_type: str) -> str:
+    return TYPE_NAMES.get(data_type, data_type)
+
+
+def render_schema(catalog: Dict[str, Any], tables: Optional[Dict[str, str]] = None) -> str:
+    """
+    Describes tables for the SQL prompt, one line per table.
+    - catalog: The catalog from load_catalog.
+    - tables: How to describe each table, from relevant_tables; all tables in full if omitted.
+    """
+    if tables is None:
+        tables = {table: "full" for table in catalog["tables"]}
+    lines = []
+    for table, entry in catalog["tables"].items():
+        detail = tables.get(table)
+        if detail is None:
+            continue
+        references = {}
+        for columns, referenced_table, referenced_columns in entry["foreign_keys"]:
+            for column, referenced_column in zip(columns, referenced_columns):
+                references[column] = f"{quote_identifier(referenced_table)}.{quote_identifier(referenced_column)}"
+        described = []
+        for column, data_type in entry["columns"]:
+            if detail == "keys" and column not in entry["primary_key"] and column not in references:
+                continue
+            text = f"{quote_identifier(column)} {format_type(data_type)}"
+            if column in entry["primary_key"]:
+                text += " PK"
+            if column in references:
+                text += f" -> {references[column]}"
+            if detail == "full" and column in entry["samples"]:
+                text += " e.g. " + ", ".join("'" + v.replace("'", "''") + "'" for v in entry["samples"][column])
+            described.append(text)
+        rows = f"~{entry['rows']} rows" if entry["rows"] is not None else "rows unknown"
+        omitted = ", other columns omitted" if detail == "keys" else ""
+        lines.append(f"{quote_identifier(table)} ({rows}{omitted}): {', '.join(described)}")
+    return "\n".join(lines)
+
+
+def schema_context(catalog: Dict[str, Any], question: str) -> str:
+    """
+    The schema description for a question's SQL prompt: only the relevant tables, unless
+    ANALYTICS_SCHEMA_FILTER is "false".
+    - catalog: The catalog from load_catalog.
+    - question: The user's question.
+    """
+    if os.getenv("ANALYTICS_SCHEMA_FILTER", "true") == "false":
+        return render_schema(catalog)
+    return render_schema(catalog, relevant_tables(catalog, question))
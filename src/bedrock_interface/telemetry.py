@@ -0,0 +1,163 @@
+# Import necessary libraries
+import math
+import os
+import time
+from typing import Dict, List, Optional
+
+from aws_lambda_powertools import Logger, Metrics, Tracer
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Configured through the POWERTOOLS_* environment variables set by InferenceStack.
+# POWERTOOLS_LOGGER_SAMPLE_RATE turns on debug logging for a fraction of invocations.
+logger = Logger()
+metrics = Metrics()
+tracer = Tracer()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate for prompt sizes; the model reports exact output counts.
+    - text: The text to estimate.
+    """
+    return len(text) // 4
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of a list of values.
+    - values: The samples, in any order.
+    - p: The percentile, between 0 and 100.
+    """
+    ordered = sorted(values)
+    rank = math.ceil(p / 100 * len(ordered))
+    return ordered[min(len(ordered), max(rank, 1)) - 1]
+
+
+class TurnMetrics:
+    """
+    Collects the timings of a single question and publishes them as EMF metrics.
+    All times are perf_counter() readings, taken relative to the start of the turn.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.model_invoked_at: Optional[float] = None
+        self.first_model_event_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.first_frame_at: Optional[float] = None
+        self.output_tokens: Optional[int] = None
+        self.post_latencies: List[float] = []
+
+    @staticmethod
+    def _ms(start: float, end: float) -> float:
+        return (end - start) * 1000
+
+    def add_duration(self, name: str, started_at: float) -> None:
+        """
+        Records the time since started_at as a millisecond metric.
+        - name: The metric name.
+        - started_at: The perf_counter() reading at the start of the measured step.
+        """
+        metrics.add_metric(
+            name=name,
+            unit=MetricUnit.Milliseconds,
+            value=self._ms(started_at, time.perf_counter()),
+        )
+
+    def add_prompt(self, prompt: str) -> None:
+        """
+        Records the size of the system prompt.
+        - prompt: The system prompt sent to the model.
+        """
+        metrics.add_metric(name="PromptCharacters", unit=MetricUnit.Count, value=len(prompt))
+        metrics.add_metric(
+            name="PromptTokensEstimated",
+            unit=MetricUnit.Count,
+            value=estimate_tokens(prompt),
+        )
+
+    def model_event(self) -> None:
+        """Marks that an event was received from the model stream."""
+        if self.first_model_event_at is None:
+            self.first_model_event_at = time.perf_counter()
+
+    def token(self) -> None:
+        """Marks that a text delta was received from the model stream."""
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_token_at = now
+
+    def restart_stream(self) -> None:
+        """Forgets the stream timings of an abandoned model invocation before a retry."""
+        self.first_model_event_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.output_tokens = None
+
+    def frame_posted(self, started_at: float) -> None:
+        """
+        Records a completed post_to_connection call.
+        - started_at: The perf_counter() reading before the call.
+        """
+        now = time.perf_counter()
+        if self.first_frame_at is None:
+            self.first_frame_at = now
+        self.post_latencies.append(self._ms(started_at, now))
+
+    def publish(self, full_response: str) -> Dict[str, float]:
+        """
+        Adds the per-turn metrics and returns them, for the debug log.
+        - full_response: The complete answer, used when the model did not report its token count.
+        """
+        finished_at = time.perf_counter()
+        values = {"TurnLatency": self._ms(self.started_at, finished_at)}
+        if self.model_invoked_at is not None and self.first_model_event_at is not None:
+            values["TimeToFirstModelEvent"] = self._ms(
+                self.model_invoked_at, self.first_model_event_at
+            )
+        if self.first_frame_at is not None:
+            values["TimeToFirstFrame"] = self._ms(self.started_at, self.first_frame_at)
+        if self.post_latencies:
+            # EMF allows at most 100 values per metric, and long answers post thousands of
+            # frames, so the distribution is summarized here rather than sent raw
+            values["PostToConnectionP50"] = percentile(self.post_latencies, 50)
+            values["PostToConnectionP90"] = percentile(self.post_latencies, 90)
+            values["PostToConnectionP99"] = percentile(self.post_latencies, 99)
+        for name, value in values.items():
+            metrics.add_metric(name=name, unit=MetricUnit.Milliseconds, value=value)
+
+        values["PostsPerTurn"] = len(self.post_latencies)
+        metrics.add_metric(
+            name="PostsPerTurn", unit=MetricUnit.Count, value=values["PostsPerTurn"]
+        )
+        output_tokens = self.output_tokens or estimate_tokens(full_response)
+        if self.first_token_at is not None and self.last_token_at > self.first_token_at:
+            values["OutputTokensPerSecond"] = output_tokens / (
+                self.last_token_at - self.first_token_at
+            )
+            metrics.add_metric(
+                name="OutputTokensPerSecond",
+                unit=MetricUnit.CountPerSecond,
+                value=values["OutputTokensPerSecond"],
+            )
+        return values
+
+
+def log_turn(full_response: str, values: Dict[str, float]) -> None:
+    """
+    Logs the answer and the turn's timings at debug level, so they only appear for
+    sampled invocations. Replaces logging every full response.
+    - full_response: The complete answer.
+    - values: The metrics returned by TurnMetrics.publish.
+    """
+    max_chars = int(os.getenv("DEBUG_RESPONSE_MAX_CHARS", "2000"))
+    logger.debug(
+        "Full response",
+        extra={
+            "response_characters": len(full_response),
+            "response": full_response[:max_chars],
+            **values,
+        },
+    )
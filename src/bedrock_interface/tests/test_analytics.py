@@ -0,0 +1,198 @@
+import datetime
+import decimal
+import json
+
+import pytest
+
+import analytics
+from analytics import (
+    FRAME_HEADER_BYTES,
+    UnsafeQueryError,
+    ndjson_frames,
+    read_only_sql,
+    run_query,
+    stream_batches,
+)
+
+FRAME_BYTES = 4096
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        'SELECT count(*) FROM "Track"',
+        'WITH sales AS (SELECT "Total" FROM "Invoice") SELECT sum("Total") FROM sales',
+        # Forbidden words are allowed inside literals, quoted identifiers and comments
+        "SELECT 'drop table' AS \"delete\" -- update\nFROM \"Genre\"",
+    ],
+)
+def test_select_queries_are_accepted(sql):
+    assert read_only_sql(sql + ";") == sql
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        'DELETE FROM "Track"',
+        'SELECT 1; DROP TABLE "Track"',
+        'WITH gone AS (DELETE FROM "Track" RETURNING *) SELECT * FROM gone',
+        "SELECT pg_sleep(10)",
+        "SELECT set_config('default_transaction_read_only', 'off', false)",
+        'EXPLAIN ANALYZE SELECT * FROM "Track"',
+    ],
+)
+def test_other_statements_are_refused(sql):
+    with pytest.raises(UnsafeQueryError):
+        read_only_sql(sql)
+
+
+def test_query_returns_columns_and_rows(reader):
+    result = run_query(reader, 'SELECT count(*) AS tracks FROM "Track"', max_rows=10)
+    assert result["columns"] == ["tracks"]
+    assert result["rows"] == [(3503,)]
+    assert not result["truncated"]
+
+
+def test_rows_over_the_limit_are_truncated(reader):
+    result = run_query(reader, 'SELECT "Name" FROM "Genre" ORDER BY "GenreId"', max_rows=5)
+    assert len(result["rows"]) == 5
+    assert result["truncated"]
+
+
+def test_session_is_read_only(reader):
+    # A write that gets past read_only_sql is still refused by the session
+    with pytest.raises(analytics.psycopg2.errors.ReadOnlySqlTransaction):
+        run_query(reader, "WITH gone AS (DELETE FROM \"Genre\" RETURNING *) SELECT * FROM gone", 10)
+
+
+def test_runaway_query_is_stopped_by_the_statement_timeout(analytics_dsn, monkeypatch):
+    monkeypatch.setenv("ANALYTICS_STATEMENT_TIMEOUT_MS", "200")
+    analytics.close_pool()
+    try:
+        with pytest.raises(analytics.psycopg2.errors.QueryCanceled):
+            with analytics.reader_connection() as connection:
+                run_query(connection, "SELECT pg_sleep(2)", 1)
+    finally:
+        analytics.close_pool()
+
+
+def test_questions_reuse_a_pooled_connection(analytics_dsn):
+    analytics.close_pool()
+    try:
+        with analytics.reader_connection() as connection:
+            first = connection.get_backend_pid()
+        with analytics.reader_connection() as connection:
+            assert connection.get_backend_pid() == first
+    finally:
+        analytics.close_pool()
+
+
+def parse(frames):
+    """Splits each frame into its header and rows."""
+    parsed = []
+    for frame in frames:
+        header, *lines = frame.rstrip("\n").split("\n")
+        parsed.append((json.loads(header), [json.loads(line) for line in lines]))
+    return parsed
+
+
+def frames_of(batches, max_rows=10_000, max_cell_bytes=1000):
+    return list(ndjson_frames(iter(batches), max_rows, FRAME_BYTES, max_cell_bytes))
+
+
+def test_frames_stay_under_the_limit_in_sequence():
+    rows = [(i, f"track {i}", "x" * 200) for i in range(300)]
+    frames = frames_of([(["id", "name", "text"], rows[:100]), (["id", "name", "text"], rows[100:])])
+    assert all(len(frame.encode("utf-8")) <= FRAME_BYTES for frame in frames)
+    parsed = parse(frames)
+    assert [header["seq"] for header, _ in parsed] == list(range(len(frames)))
+    assert parsed[0][0] == {"seq": 0, "type": "columns", "columns": ["id", "name", "text"]}
+    assert [row for header, body in parsed if header["type"] == "rows" for row in body] == [list(r) for r in rows]
+    assert all(header["count"] == len(body) for header, body in parsed if header["type"] == "rows")
+    assert parsed[-1][0] == {"seq": len(frames) - 1, "type": "end", "rows": 300, "truncated": False, "oversized": 0}
+
+
+def test_long_cells_are_cut_without_splitting_characters():
+    frames = frames_of([(["text"], [("é" * 1000,)])], max_cell_bytes=101)
+    (_, body) = parse(frames)[1]
+    assert body == [["é" * 50 + "…"]]
+
+
+def test_rows_that_cannot_fit_are_left_out_and_counted():
+    wide = tuple(range(2000))
+    frames = frames_of([(["id"], [(1,), wide, (2,)])])
+    parsed = parse(frames)
+    assert [row for header, body in parsed if header["type"] == "rows" for row in body] == [[1], [2]]
+    assert parsed[-1][0]["oversized"] == 1
+    assert parsed[-1][0]["rows"] == 2
+
+
+def test_rows_over_the_maximum_are_truncated():
+    frames = frames_of([(["id"], [(i,) for i in range(50)])], max_rows=20)
+    end = parse(frames)[-1][0]
+    assert end["rows"] == 20
+    assert end["truncated"]
+
+
+def test_values_json_cannot_hold_are_sent_as_text():
+    frames = frames_of([(["price", "day"], [(decimal.Decimal("0.99"), datetime.date(2010, 1, 1))])])
+    assert parse(frames)[1][1] == [["0.99", "2010-01-01"]]
+
+
+def test_columns_that_cannot_fit_end_the_stream_with_an_error():
+    columns = [f"column_{i}" for i in range(FRAME_BYTES // 8)]
+    frames = frames_of([(columns, [])])
+    assert len(frames) == 1
+    header, _ = parse(frames)[0]
+    assert header["type"] == "error"
+    assert len(frames[0].encode("utf-8")) <= FRAME_BYTES
+
+
+def test_failure_while_reading_ends_the_stream_with_an_error():
+    def batches():
+        yield ["id"], [(i,) for i in range(5)]
+        raise RuntimeError("canceling statement due to statement timeout")
+
+    frames = ndjson_frames(batches(), 100, FRAME_BYTES, 1000)
+    received = []
+    with pytest.raises(RuntimeError):
+        for frame in frames:
+            received.append(frame)
+    header, _ = parse(received)[-1]
+    assert header["type"] == "error"
+    assert "statement timeout" in header["message"]
+    # The buffered rows were never sent
+    assert header["rows"] == 0
+
+
+def test_header_fits_its_reserved_room():
+    header = analytics.ndjson_header(10**9, "rows", count=10**9)
+    assert len(header.encode("utf-8")) <= FRAME_HEADER_BYTES
+
+
+def test_rows_are_read_in_batches_through_a_server_side_cursor(reader):
+    batches = stream_batches(reader, 'SELECT "TrackId", "Name" FROM "Track" ORDER BY "TrackId"', 1000)
+    sizes = []
+    for columns, rows in batches:
+        assert columns == ["TrackId", "Name"]
+        sizes.append(len(rows))
+        with reader.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_cursors WHERE name LIKE 'analytics_%'")
+            assert cursor.fetchone()[0] == 1
+    assert sizes == [1000, 1000, 1000, 503]
+
+
+def test_closing_the_stream_closes_the_cursor(reader):
+    batches = stream_batches(reader, 'SELECT "TrackId" FROM "Track"', 100)
+    next(batches)
+    batches.close()
+    with reader.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM pg_cursors WHERE name LIKE 'analytics_%'")
+        assert cursor.fetchone()[0] == 0
+
+
+def test_streamed_result_frames_stay_under_the_limit(reader):
+    sql = 'SELECT t."TrackId", t."Name", t."Composer", t."UnitPrice" FROM "Track" t ORDER BY t."TrackId"'
+    frames = list(ndjson_frames(stream_batches(reader, sql, 500), 10_000, FRAME_BYTES, 1000))
+    assert all(len(frame.encode("utf-8")) <= FRAME_BYTES for frame in frames)
+    assert parse(frames)[-1][0] == {"seq": len(frames) - 1, "type": "end", "rows": 3503, "truncated": False, "oversized": 0}
@@ -0,0 +1,50 @@
+import base64
+
+import pytest
+
+from history_codec import (
+    CODEC_RAW,
+    CODEC_ZLIB,
+    decode_attribute,
+    decode_text,
+    encode_text,
+    encode_text_b64,
+)
+
+
+def test_short_text_is_stored_raw():
+    value = encode_text("Yes.")
+    assert value[0] == CODEC_RAW
+    assert decode_text(value) == "Yes."
+
+
+def test_long_text_is_compressed():
+    text = "The deadline for full proposals is the third Monday in May. " * 50
+    value = encode_text(text)
+    assert value[0] == CODEC_ZLIB
+    assert len(value) < len(text.encode("utf-8"))
+    assert decode_text(value) == text
+
+
+@pytest.mark.parametrize("text", ["", "Ünïcödé — “quotes” ✓", "## Heading\n- **item**: text\n" * 20])
+def test_round_trip(text):
+    assert decode_text(encode_text(text)) == text
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        decode_text(bytes([99]) + b"payload")
+
+
+def test_plain_string_items_from_before_compression_are_read():
+    assert decode_attribute({"S": "an old answer"}) == "an old answer"
+
+
+def test_binary_attributes_from_boto3_are_read():
+    assert decode_attribute({"B": encode_text("an answer " * 30)}) == "an answer " * 30
+
+
+def test_base64_attributes_from_the_state_machine_are_read():
+    encoded = encode_text_b64("an answer " * 30)
+    assert base64.b64decode(encoded) == encode_text("an answer " * 30)
+    assert decode_attribute({"B": encoded}) == "an answer " * 30
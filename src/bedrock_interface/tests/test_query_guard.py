@@ -0,0 +1,72 @@
+import pytest
+
+import analytics
+from analytics import run_query
+from query_guard import LARGE_QUERY, SMALL_QUERY, QueryBudgetError, guard_query
+
+MAX_ROWS = 500
+
+
+@pytest.fixture(autouse=True)
+def budgets(monkeypatch):
+    monkeypatch.setenv("ANALYTICS_MAX_QUERY_COST", "1000000")
+    monkeypatch.setenv("ANALYTICS_SMALL_QUERY_COST", "10000")
+    monkeypatch.setenv("ANALYTICS_SMALL_QUERY_TIMEOUT_MS", "1000")
+    monkeypatch.setenv("ANALYTICS_STATEMENT_TIMEOUT_MS", "3000")
+
+
+def statement_timeout(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW statement_timeout")
+        return cursor.fetchone()[0]
+
+
+def test_unbounded_cross_join_is_limited(reader):
+    guarded = guard_query(reader, 'SELECT * FROM "Track" CROSS JOIN "InvoiceLine" CROSS JOIN "Customer"', MAX_ROWS)
+    assert guarded["rewritten"]
+    assert guarded["sql"].endswith(f"LIMIT {MAX_ROWS + 1}")
+    assert guarded["class"] == SMALL_QUERY
+    result = run_query(reader, guarded["sql"], MAX_ROWS)
+    assert len(result["rows"]) == MAX_ROWS
+    assert result["truncated"]
+
+
+def test_sorted_cross_join_is_refused(reader):
+    # A limit does not help: every combination has to be sorted first
+    with pytest.raises(QueryBudgetError):
+        guard_query(
+            reader,
+            'SELECT * FROM "Track" t CROSS JOIN "InvoiceLine" l CROSS JOIN "Customer" c '
+            'ORDER BY t."Name", l."UnitPrice", c."Email"',
+            MAX_ROWS,
+        )
+
+
+def test_query_with_its_own_limit_is_left_alone(reader):
+    sql = 'SELECT "Name" FROM "Track" ORDER BY "Name" LIMIT 10'
+    guarded = guard_query(reader, sql, MAX_ROWS)
+    assert not guarded["rewritten"]
+    assert guarded["sql"] == sql
+
+
+def test_cheap_query_gets_the_small_timeout(reader):
+    guarded = guard_query(reader, 'SELECT "Name" FROM "Artist" WHERE "ArtistId" = 1', MAX_ROWS)
+    assert guarded["class"] == SMALL_QUERY
+    assert guarded["timeout_ms"] == 1000
+    assert statement_timeout(reader) == "1s"
+
+
+def test_expensive_query_gets_the_statement_timeout(reader):
+    guarded = guard_query(reader, 'SELECT count(*) FROM "Track" CROSS JOIN "InvoiceLine"', MAX_ROWS)
+    assert guarded["class"] == LARGE_QUERY
+    assert guarded["timeout_ms"] == 3000
+    assert statement_timeout(reader) == "3s"
+
+
+def test_misjudged_query_is_stopped_by_the_small_timeout(reader, monkeypatch):
+    monkeypatch.setenv("ANALYTICS_SMALL_QUERY_TIMEOUT_MS", "100")
+    # The planner expects pg_sleep to be cheap
+    guarded = guard_query(reader, "SELECT pg_sleep(1)", MAX_ROWS)
+    assert guarded["class"] == SMALL_QUERY
+    with pytest.raises(analytics.psycopg2.errors.QueryCanceled):
+        run_query(reader, guarded["sql"], MAX_ROWS)
@@ -0,0 +1,136 @@
+import threading
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from request_coalescing import FlightWriter, flight_key, follow_flight, join_flight
+
+TABLE_NAME = "aaa-context"
+LEASE_SECONDS = 60
+
+
+@pytest.fixture
+def dynamodb_client():
+    """A moto context table with the same key schema as ContextStack."""
+    with mock_aws():
+        client = boto3.client("dynamodb")
+        client.create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[
+                {"AttributeName": "PK", "KeyType": "HASH"},
+                {"AttributeName": "SK", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "PK", "AttributeType": "S"},
+                {"AttributeName": "SK", "AttributeType": "N"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield client
+
+
+def stream(dynamodb_client, flight, chunks, error=False):
+    writer = FlightWriter(dynamodb_client, TABLE_NAME, flight, flush_ms=0)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.finish(error=error)
+    return writer
+
+
+def test_trivially_different_questions_share_a_flight():
+    assert flight_key("What is the deadline for NSF 24-553?", [], "") == flight_key(
+        "  what is the   deadline for nsf 24-553", [], ""
+    )
+
+
+def test_history_is_part_of_the_flight():
+    history = [{"question": "Which solicitation?", "answer": "NSF 24-553"}]
+    assert flight_key("What is the deadline?", [], "") != flight_key("What is the deadline?", history, "")
+
+
+def test_second_request_follows_the_leader(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    leader = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    follower = join_flight(dynamodb_client, TABLE_NAME, key, "conn-2", LEASE_SECONDS)
+    assert leader == {"role": "leader", "key": key, "generation": 1}
+    assert follower == {"role": "follower", "key": key, "generation": 1}
+
+
+def test_expired_lease_is_taken_over(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    # A leader that died without finishing: its lease is already over
+    join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", -1)
+    flight = join_flight(dynamodb_client, TABLE_NAME, key, "conn-2", LEASE_SECONDS)
+    assert flight["role"] == "leader"
+    assert flight["generation"] == 2
+
+
+def test_finished_flight_releases_the_lease(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    first = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    writer = stream(dynamodb_client, first, ["The deadline ", "is May 1."])
+    assert not writer.failed
+    second = join_flight(dynamodb_client, TABLE_NAME, key, "conn-2", LEASE_SECONDS)
+    assert second["role"] == "leader"
+    assert second["generation"] == 2
+
+
+def test_follower_receives_the_chunks_in_order(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    flight = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    chunks = ["The ", "deadline ", "is ", "May 1."]
+    stream(dynamodb_client, flight, chunks)
+    received = []
+    answer = follow_flight(dynamodb_client, TABLE_NAME, flight, received.append, poll_ms=10, stall_seconds=1)
+    assert answer == "".join(chunks)
+    assert received == chunks
+
+
+def test_follower_tails_a_flight_while_it_streams(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    leader = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    follower = join_flight(dynamodb_client, TABLE_NAME, key, "conn-2", LEASE_SECONDS)
+    writer = FlightWriter(dynamodb_client, TABLE_NAME, leader, flush_ms=0)
+    received = []
+    thread = threading.Thread(
+        target=lambda: received.append(
+            follow_flight(dynamodb_client, TABLE_NAME, follower, lambda chunk: None, poll_ms=10, stall_seconds=2)
+        )
+    )
+    thread.start()
+    for chunk in ["The ", "deadline ", "is ", "May 1."]:
+        writer.write(chunk)
+    writer.finish()
+    thread.join()
+    assert received == ["The deadline is May 1."]
+
+
+def test_later_generation_does_not_replay_earlier_chunks(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    first = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    stream(dynamodb_client, first, ["an old answer"])
+    second = join_flight(dynamodb_client, TABLE_NAME, key, "conn-2", LEASE_SECONDS)
+    stream(dynamodb_client, second, ["a new answer"])
+    assert follow_flight(dynamodb_client, TABLE_NAME, second, lambda chunk: None, 10, 1) == "a new answer"
+
+
+def test_failure_before_any_text_lets_the_follower_answer_itself(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    flight = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    stream(dynamodb_client, flight, [], error=True)
+    assert follow_flight(dynamodb_client, TABLE_NAME, flight, lambda chunk: None, 10, 1) is None
+
+
+def test_failure_after_text_is_raised(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    flight = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    stream(dynamodb_client, flight, ["The deadline "], error=True)
+    with pytest.raises(RuntimeError):
+        follow_flight(dynamodb_client, TABLE_NAME, flight, lambda chunk: None, 10, 1)
+
+
+def test_stalled_leader_is_given_up_on(dynamodb_client):
+    key = flight_key("What is the deadline?", [], "")
+    flight = join_flight(dynamodb_client, TABLE_NAME, key, "conn-1", LEASE_SECONDS)
+    assert follow_flight(dynamodb_client, TABLE_NAME, flight, lambda chunk: None, 10, 0.1) is None
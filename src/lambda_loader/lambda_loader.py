@@ -1,22 +1,126 @@
 import os
-import json
 import boto3
 import psycopg2
+from psycopg2 import sql
 
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities import parameters
 
+try:
+    # Part of the Lambda Python runtime, for SnapStart runtime hooks
+    from snapshot_restore_py import register_after_restore, register_before_snapshot
+except ImportError:
+    register_before_snapshot = register_after_restore = None
+
 logger = Logger()
 
+# Built during init, so that the invocation only loads data
+s3 = boto3.client("s3")
+secrets_provider = parameters.SecretsProvider()
+
+# Analytic query results are cached by the versions of the tables they read, see
+# src/bedrock_interface/result_cache.py. A statement trigger bumps a table's version on any
+# write, so a load, or any other write, invalidates the results that read the table.
+TABLE_VERSIONS_SQL = """
+CREATE SCHEMA IF NOT EXISTS analytics_meta;
+CREATE TABLE IF NOT EXISTS analytics_meta.table_versions (
+    table_schema text NOT NULL,
+    table_name text NOT NULL,
+    version bigint NOT NULL DEFAULT 1,
+    changed_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_schema, table_name)
+);
+CREATE OR REPLACE FUNCTION analytics_meta.bump_table_version() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO analytics_meta.table_versions AS v (table_schema, table_name)
+    VALUES (TG_TABLE_SCHEMA, TG_TABLE_NAME)
+    ON CONFLICT (table_schema, table_name) DO UPDATE SET version = v.version + 1, changed_at = now();
+    RETURN NULL;
+END
+$$;
+"""
+
+# The database credentials and connection, fetched by prime()
+database = {"credentials": None, "connection": None}
+
+
+def get_credentials():
+    if database["credentials"] is None:
+        logger.info("Getting secrets...")
+        database["credentials"] = secrets_provider.get(
+            os.environ.get("AURORA_SECRET_NAME"), transform="json"
+        )
+    return database["credentials"]
+
+
+def get_connection():
+    if database["connection"] is None or database["connection"].closed:
+        value = get_credentials()
+        logger.info("Connecting to database...")
+        database["connection"] = psycopg2.connect(
+            database=value["dbname"],
+            user=value["username"],
+            password=value["password"],
+            host=value["host"],
+            port=value["port"],
+        )
+    return database["connection"]
+
+
+def track_table_versions(cur, schema):
+    # Tables created by the load get their trigger, and every table a new version
+    cur.execute(TABLE_VERSIONS_SQL)
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = %s", (schema,))
+    for (table,) in cur.fetchall():
+        relation = sql.SQL("{}.{}").format(sql.Identifier(schema), sql.Identifier(table))
+        cur.execute(
+            sql.SQL(
+                "CREATE OR REPLACE TRIGGER bump_table_version"
+                " AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {}"
+                " FOR EACH STATEMENT EXECUTE FUNCTION analytics_meta.bump_table_version()"
+            ).format(relation)
+        )
+        cur.execute(
+            """
+            INSERT INTO analytics_meta.table_versions AS v (table_schema, table_name)
+            VALUES (%s, %s)
+            ON CONFLICT (table_schema, table_name)
+            DO UPDATE SET version = v.version + 1, changed_at = now()
+            """,
+            (schema, table),
+        )
+
+
+def prime():
+    # A failure here is retried by the handler, where it is reported
+    try:
+        get_connection()
+    except Exception as e:
+        logger.warning(f"Unable to connect to the database during init: {e}")
+
+
+def release():
+    # Neither the secret nor a socket that is dead after restore belongs in the snapshot
+    if database["connection"] is not None:
+        database["connection"].close()
+    database["connection"] = None
+    database["credentials"] = None
+
+
+if os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE") == "snap-start":
+    if register_before_snapshot is not None:
+        register_before_snapshot(release)
+        register_after_restore(prime)
+elif os.environ.get("PRIME_ON_INIT", "false") == "true":
+    prime()
+
 
 @logger.inject_lambda_context(log_event=True)
 def handler(event, context):
     logger.info("Starting execution...")
-    secret_name = os.environ.get("AURORA_SECRET_NAME")
-    logger.info("Getting secrets...")
-    value = json.loads(parameters.get_secret(secret_name))
+    value = get_credentials()
     logger.info("Getting data to load...")
-    s3 = boto3.client("s3")
     analytic_data = s3.get_object(
         Bucket=os.environ.get("DATA_BUCKET"), Key=os.environ.get("DATA_FILE")
     )
@@ -30,24 +134,19 @@ def handler(event, context):
         "<update with secure password>", value["password"]
     )
     try:
-        logger.info("Connecting to database...")
-        conn = psycopg2.connect(
-            database=value["dbname"],
-            user=value["username"],
-            password=value["password"],
-            host=value["host"],
-            port=value["port"],
-        )
+        conn = get_connection()
         cur = conn.cursor()
         logger.info("Loading analytic data...")
         cur.execute(analytics_contents)
+        logger.info("Tracking table versions...")
+        track_table_versions(cur, os.environ.get("ANALYTICS_SCHEMA", "public"))
         conn.commit()
         logger.info("Configuring vector schema...")
         cur.execute(vector_schema_contents_replaced)
         conn.commit()
         logger.info("Closing connection to database...")
         cur.close()
-        conn.close()
+        release()
         logger.info("Done!")
     except Exception as e:
         logger.error(f"Unable to execute sql: {e}")